@@ -1,46 +1,102 @@
 from aiogram import Bot, types
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from database import get_all_users, get_support_requests, get_recommendation_count, get_support_request_count
+from callbacks import AdminCallback
+from broadcast import engine as broadcast_engine
+from database import aget_support_requests, acount_segment
+from segments import parse_spec, describe
+from stats import aget_counters, aget_breakdown, aget_daily, aget_rating_histogram
+
+SEGMENT_HELP = ("Кому отправить? Напишите «всем» или условия, по одному в строке:\n"
+                "город: Москва, Минск\n"
+                "пол: женский\n"
+                "возраст: 18-30\n"
+                "ароматы: Цитрусовые, Древесные (или «все ароматы: ...» — нужны все сразу)\n"
+                "неактивны: 7 — не получали рекомендаций 7 дней")
+
+class BroadcastStates(StatesGroup):
+    waiting_text = State()
+    waiting_segment = State()
 
 async def handle_admin_command(message: types.Message):
     keyboard = InlineKeyboardBuilder()
-    keyboard.button(text="Статистика", callback_data="admin_stats")
-    keyboard.button(text="Обращения в поддержку", callback_data="admin_support")
+    keyboard.button(text="Статистика", callback_data=AdminCallback(action="stats"))
+    keyboard.button(text="Обращения в поддержку", callback_data=AdminCallback(action="support"))
+    keyboard.button(text="Рассылка", callback_data=AdminCallback(action="broadcast"))
+    keyboard.button(text="Производительность", callback_data=AdminCallback(action="metrics"))
     keyboard.adjust(2)
     await message.answer("Выберите действие:", reply_markup=keyboard.as_markup())
 
-async def send_broadcast(bot: Bot, message: str, admin_chat_id: int):
-    await bot.send_message(chat_id=admin_chat_id, text="Введите текст для рассылки:")
+async def ask_broadcast_text(message: types.Message, state: FSMContext):
+    await state.set_state(BroadcastStates.waiting_text)
+    await message.answer("Введите текст для рассылки:")
+
+async def ask_broadcast_segment(message: types.Message, state: FSMContext):
+    await state.update_data(broadcast_text=message.text)
+    await state.set_state(BroadcastStates.waiting_segment)
+    await message.answer(SEGMENT_HELP)
+
+async def handle_broadcast_segment(bot: Bot, message: types.Message, state: FSMContext):
+    try:
+        segment = parse_spec(message.text)
+    except ValueError as e:
+        await message.answer(f"{e}\n\n{SEGMENT_HELP}")
+        return
+    count = await acount_segment(segment)
+    if not count:
+        await message.answer(f"Под условия ({describe(segment)}) не подходит ни один пользователь. Измените условия.")
+        return
+    text = (await state.get_data())['broadcast_text']
+    await state.clear()
+    await message.answer(f"Получателей: {count} ({describe(segment)}).")
+    await send_broadcast(bot, text, message.chat.id, segment)
 
-    # Note: The following part should be integrated into your main message handler
-    # This is just a placeholder for the logic
-    async def handle_broadcast_text(msg: types.Message):
-        broadcast_message = msg.text
-        users = get_all_users()
-        success_count = 0
-        for user in users:
-            try:
-                await bot.send_message(chat_id=int(user['id']), text=broadcast_message)
-                success_count += 1
-            except Exception as e:
-                print(f"Failed to send broadcast to user {user['id']}: {str(e)}")
+async def send_broadcast(bot: Bot, message: str, admin_chat_id: int, segment: dict = None) -> int:
+    # Рассылка идёт в фоне; прогресс обновляется в отдельном сообщении администратору
+    return await broadcast_engine.start(bot, admin_chat_id, message, segment)
 
-        await bot.send_message(chat_id=admin_chat_id, text=f"Рассылка завершена. Успешно отправлено: {success_count} из {len(users)} пользователей.")
+async def handle_broadcast_control(bot: Bot, action: str, broadcast_id: int) -> str:
+    if action == "pause":
+        await broadcast_engine.pause(broadcast_id)
+        return "Рассылка будет приостановлена."
+    if action == "resume":
+        await broadcast_engine.resume(bot, broadcast_id)
+        return "Рассылка продолжена."
+    if action == "retry":
+        count = await broadcast_engine.retry_failed(bot, broadcast_id)
+        return f"Повторная отправка: {count} получателей."
+    return "Неизвестное действие."
 
 async def get_bot_statistics():
-    total_users = len(get_all_users())
-    total_support_requests = get_support_request_count()
-    total_recommendations = get_recommendation_count()
-    
+    # Все числа берутся из счётчиков, которые ведут триггеры, — время ответа не зависит от размера таблиц
+    counters = await aget_counters()
+    fragrances = await aget_breakdown('fragrance', limit=5)
+    locations = await aget_breakdown('location', limit=5)
+    ratings = await aget_rating_histogram()
+    today = (await aget_daily(1) or [{}])[-1]
+    feedback_count = counters['feedback_count']
+
     stats = f"Статистика бота:\n\n"
-    stats += f"Всего пользователей: {total_users}\n"
-    stats += f"Всего обращений в поддержку: {total_support_requests}\n"
-    stats += f"Всего выданных рекомендаций: {total_recommendations}"
-    
-    return stats
+    stats += f"Всего пользователей: {counters['users']}\n"
+    stats += f"Заполнили профиль: {counters['users_completed']}\n"
+    stats += f"Всего обращений в поддержку: {counters['support_requests']}\n"
+    stats += f"Всего выданных рекомендаций: {counters['recommendations']}\n"
+    if feedback_count:
+        stats += f"Средняя оценка: {counters['feedback_sum'] / feedback_count:.2f} (всего оценок: {feedback_count})\n"
+        stats += "Оценки: " + ", ".join(f"{score}★ — {count}" for score, count in ratings.items()) + "\n"
+
+    stats += f"\nСегодня: новых пользователей {today.get('users', 0)}, "
+    stats += f"рекомендаций {today.get('recommendations', 0)}, обращений {today.get('support_requests', 0)}\n"
+    if fragrances:
+        stats += "\nПопулярные ароматы:\n" + "\n".join(f"{name}: {count}" for name, count in fragrances.items()) + "\n"
+    if locations:
+        stats += "\nГорода:\n" + "\n".join(f"{name}: {count}" for name, count in locations.items())
+
+    return stats.rstrip()
 
 async def get_support_requests_list():
-    requests = get_support_requests()
+    requests = await aget_support_requests()
     message = "Последние обращения в поддержку:\n\n"
     for req in requests:
         message += f"От: {req['user_id']}\n"
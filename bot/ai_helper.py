@@ -1,94 +1,561 @@
-from database import get_products_by_preferences
+from catalog import pick_products
+import sys
+import math
+import time
+import asyncio
 import logging
-from typing import Dict, Any, List
-from openai import AsyncOpenAI
-from config import OPENAI_API_KEY
+from collections import deque
+from typing import Dict, Any, List, AsyncIterator, Optional, Tuple, Callable, Awaitable
+from config import (OPENAI_API_KEY, LLM_CONCURRENCY, LLM_BATCH_CONCURRENCY, LLM_TOKENS_PER_MINUTE,
+                    LLM_INTERACTIVE_RESERVE, LLM_TIMEOUT, LLM_BATCH_TIMEOUT, LLM_HEDGE_DELAY,
+                    LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN, LLM_WORKERS, LLM_SHARED_SYNC_INTERVAL,
+                    TEMPLATE_MODE, TEMPLATE_LOAD_QUEUE)
+from database import aget_precomputed_recommendation
+from llm_cache import response_cache, make_key
+from ratelimit import TokenBucket
+from shared_state import backend as state_backend
+import templates
+from metrics import (registry, openai_seconds, openai_errors, openai_hedges, llm_fallbacks, template_renders,
+                     record_openai_usage, log_event)
 
 logging.basicConfig(level=logging.INFO)
 
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Клиент OpenAI создаётся при первом запросе или при прогреве после запуска:
+# импорт пакета openai — заметная часть времени старта бота
+client = None
+
+
+def get_client():
+    global client
+    if client is None:
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    return client
+
+MODEL = "gpt-4o-mini"
+MAX_TOKENS = 500
+# Увеличивается при изменении модели или промптов: сохранённые рекомендации старой версии не выдаются
+RECOMMENDATION_VERSION = 1
+SYSTEM_PROMPT = "Вы - эксперт по парфюмерии, который дает персонализированные рекомендации."
+SHOP_FOOTER = "\n\nВы можете приобрести любой из парфюмов у нас на сайте: edp.by"
+ERROR_MESSAGE = "Извините, произошла ошибка при генерации рекомендации. Пожалуйста, попробуйте позже."
+# Начало ответа, собранного без модели: такие ответы не кэшируются и не сохраняются как готовые рекомендации
+FALLBACK_NOTICE = "Сервис рекомендаций сейчас перегружен."
+RETRY_AFTER_DEFAULT = 5.0
+
+# Очереди запросов: интерактивные (ответ ждёт пользователь) и фоновые (рассылка, ночной пересчёт)
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+def _messages(prompt: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+async def _complete(prompt: str, usage: Dict[str, int]) -> str:
+    started = time.perf_counter()
+    try:
+        response = await get_client().chat.completions.create(
+            model=MODEL,
+            messages=_messages(prompt),
+            max_tokens=MAX_TOKENS
+        )
+    except Exception:
+        openai_errors.inc(kind='complete')
+        raise
+    finally:
+        openai_seconds.observe(time.perf_counter() - started, kind='complete')
+    _record_usage(getattr(response, 'usage', None), usage)
+    return response.choices[0].message.content.strip() + SHOP_FOOTER
+
+async def _stream_completion(prompt: str, usage: Dict[str, int]) -> AsyncIterator[str]:
+    # Время — до последнего фрагмента; расход токенов приходит последним пустым фрагментом (include_usage)
+    started = time.perf_counter()
+    try:
+        stream = await get_client().chat.completions.create(
+            model=MODEL,
+            messages=_messages(prompt),
+            max_tokens=MAX_TOKENS,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        started_text = False
+        async for chunk in stream:
+            _record_usage(getattr(chunk, 'usage', None), usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if not started_text:
+                delta = delta.lstrip()
+                started_text = bool(delta)
+            yield delta
+    except Exception:
+        openai_errors.inc(kind='stream')
+        raise
+    finally:
+        openai_seconds.observe(time.perf_counter() - started, kind='stream')
+    yield SHOP_FOOTER
+
+def _record_usage(response_usage, usage: Dict[str, int]):
+    if response_usage is not None:
+        record_openai_usage(response_usage)
+        usage['total'] = (response_usage.prompt_tokens or 0) + (response_usage.completion_tokens or 0)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class _NoCapacity(Exception):
+    # Дублирующий запрос не запускается, если для него нет свободного слота или бюджета
+    pass
+
+
+class CircuitBreaker:
+    # После threshold ошибок подряд запросы не отправляются cooldown секунд,
+    # затем один пробный запрос решает, замкнуть цепь или подождать ещё
+    def __init__(self, threshold: int = LLM_BREAKER_THRESHOLD, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if self._probing or time.monotonic() - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half-open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'half-open':
+            self._probing = True
+        return state != 'open'
+
+    def success(self):
+        if self.opened_at is not None:
+            logging.info("OpenAI circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def failure(self) -> bool:
+        # True — цепь только что разомкнулась (об этом сообщается другим процессам)
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            opened = self.opened_at is None
+            if opened:
+                logging.warning(f"OpenAI circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+            return opened
+        return False
+
+    def trip(self, seconds: float):
+        # Цепь разомкнул другой процесс: ждём оставшееся время, потом пробный запрос
+        if self.state == 'closed':
+            logging.warning("OpenAI circuit opened by another worker")
+            self.failures = self.threshold
+            self.opened_at = time.monotonic() - self.cooldown + seconds
+
+    def abandon(self):
+        # Запрос отменён: это не ответ сервиса, пробу можно повторить
+        self._probing = False
+
+
+class _Lanes:
+    # Слоты параллельных запросов: освободившийся слот сначала получает интерактивный запрос,
+    # фоновые занимают не больше batch_concurrency слотов
+    def __init__(self, concurrency: int, batch_concurrency: int):
+        self.concurrency = concurrency
+        self.limits = {INTERACTIVE: concurrency, BATCH: min(batch_concurrency, concurrency)}
+        self.active = {INTERACTIVE: 0, BATCH: 0}
+        self._waiters: Dict[str, deque] = {INTERACTIVE: deque(), BATCH: deque()}
+
+    def _can_start(self, lane: str) -> bool:
+        return sum(self.active.values()) < self.concurrency and self.active[lane] < self.limits[lane]
+
+    def _queued_before(self, lane: str) -> bool:
+        return bool(self._waiters[INTERACTIVE] or (lane == BATCH and self._waiters[BATCH]))
+
+    def try_acquire(self, lane: str) -> bool:
+        if self._queued_before(lane) or not self._can_start(lane):
+            return False
+        self.active[lane] += 1
+        return True
+
+    async def acquire(self, lane: str):
+        if self.try_acquire(lane):
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(lane)  # слот уже был передан этому запросу
+            elif waiter in self._waiters[lane]:
+                self._waiters[lane].remove(waiter)
+            raise
+
+    def release(self, lane: str):
+        self.active[lane] -= 1
+        for waiting_lane in (INTERACTIVE, BATCH):
+            waiters = self._waiters[waiting_lane]
+            while waiters and self._can_start(waiting_lane):
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    self.active[waiting_lane] += 1
+                    waiter.set_result(None)
+
+    def queued(self) -> int:
+        return len(self._waiters[INTERACTIVE]) + len(self._waiters[BATCH])
+
+
+class _OpenStream:
+    def __init__(self, chunks: AsyncIterator[str], first: str, finish: Callable[[Optional[BaseException]], None]):
+        self.chunks = chunks
+        self.first = first
+        self.finish = finish
+
+    async def close(self, error: BaseException = None):
+        await self.chunks.aclose()
+        self.finish(error)
+
+
+class LLMDispatcher:
+    # Все запросы к модели проходят здесь: приоритет интерактивных над фоновыми,
+    # бюджет токенов в минуту, таймауты, дублирование медленных интерактивных запросов
+    # и размыкатель цепи при деградации API.
+    # Лимиты заданы на весь бот и делятся поровну между workers процессами; размыкание цепи
+    # и пауза по 429 публикуются в общем хранилище состояния и применяются остальными процессами
+    def __init__(self, concurrency: int = LLM_CONCURRENCY, batch_concurrency: int = LLM_BATCH_CONCURRENCY,
+                 tokens_per_minute: float = LLM_TOKENS_PER_MINUTE, interactive_reserve: float = LLM_INTERACTIVE_RESERVE,
+                 hedge_delay: float = LLM_HEDGE_DELAY, workers: int = LLM_WORKERS, shared=state_backend):
+        tokens_per_minute /= workers
+        self.lanes = _Lanes(math.ceil(concurrency / workers), math.ceil(batch_concurrency / workers))
+        self.budget = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self.reserve = tokens_per_minute * interactive_reserve
+        self.timeouts = {INTERACTIVE: LLM_TIMEOUT, BATCH: LLM_BATCH_TIMEOUT}
+        self.hedge_delay = hedge_delay
+        self.breaker = CircuitBreaker()
+        self.shared = shared if workers > 1 else None
+        self._synced_at = 0.0
+        self._publishing: set = set()
+
+    async def _sync_shared(self):
+        # Чтение общего состояния не чаще раза в LLM_SHARED_SYNC_INTERVAL секунд
+        now = time.monotonic()
+        if self.shared is None or now - self._synced_at < LLM_SHARED_SYNC_INTERVAL:
+            return
+        self._synced_at = now
+        try:
+            circuit_until = await self.shared.get('llm:circuit_open_until')
+            paused_until = await self.shared.get('llm:paused_until')
+        except Exception as e:
+            logging.warning(f"Failed to read shared LLM state: {e}")
+            return
+        if circuit_until and circuit_until > time.time():
+            self.breaker.trip(circuit_until - time.time())
+        if paused_until and paused_until > time.time():
+            self.budget.pause(paused_until - time.time())
+
+    def _publish(self, key: str, seconds: float):
+        if self.shared is None:
+            return
+
+        async def publish():
+            try:
+                await self.shared.set(key, time.time() + seconds, ttl=seconds)
+            except Exception as e:
+                logging.warning(f"Failed to publish shared LLM state: {e}")
+        task = asyncio.create_task(publish())
+        self._publishing.add(task)
+        task.add_done_callback(self._publishing.discard)
+
+    @staticmethod
+    def _estimate(prompt: str) -> int:
+        # Грубая оценка до ответа; после ответа разница возвращается по фактическому расходу
+        return len(SYSTEM_PROMPT + prompt) // 3 + MAX_TOKENS
+
+    async def _admit(self, lane: str, tokens: int, wait: bool) -> int:
+        await self._sync_shared()
+        if not wait and self.breaker.state != 'closed':
+            raise _NoCapacity()
+        if wait:
+            await self.lanes.acquire(lane)
+        elif not self.lanes.try_acquire(lane):
+            raise _NoCapacity()
+        reserve = 0.0 if lane == INTERACTIVE else self.reserve
+        tokens = min(tokens, self.budget.capacity - reserve)
+        try:
+            while delay := self.budget.try_acquire(tokens, reserve):
+                if not wait:
+                    raise _NoCapacity()
+                await asyncio.sleep(delay)
+            if not self.breaker.allow():
+                self.budget.refund(tokens)
+                raise CircuitOpenError("OpenAI circuit is open")
+        except BaseException:
+            self.lanes.release(lane)
+            raise
+        return tokens
+
+    def _finish(self, lane: str, reserved: int, usage: Dict[str, int], error: Optional[BaseException]):
+        self.lanes.release(lane)
+        self.budget.refund(reserved - usage.get('total', reserved))
+        if error is None:
+            self.breaker.success()
+        elif isinstance(error, Exception):
+            if isinstance(error, TimeoutError):
+                openai_errors.inc(kind='timeout')
+            if _is_rate_limited(error):
+                retry_after = _retry_after(error)
+                self.budget.pause(retry_after)
+                self._publish('llm:paused_until', retry_after)
+            if self.breaker.failure():
+                self._publish('llm:circuit_open_until', self.breaker.cooldown)
+        else:
+            self.breaker.abandon()
+
+    async def _complete_attempt(self, prompt: str, lane: str, wait: bool) -> str:
+        reserved = await self._admit(lane, self._estimate(prompt), wait)
+        usage: Dict[str, int] = {}
+        error = None
+        try:
+            async with asyncio.timeout(self.timeouts[lane]):
+                return await _complete(prompt, usage)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._finish(lane, reserved, usage, error)
+
+    async def _open_stream(self, prompt: str, lane: str, wait: bool) -> _OpenStream:
+        reserved = await self._admit(lane, self._estimate(prompt), wait)
+        usage: Dict[str, int] = {}
+        chunks = _stream_completion(prompt, usage)
+        try:
+            async with asyncio.timeout(self.timeouts[lane]):
+                first = await chunks.__anext__()
+        except BaseException as e:
+            await chunks.aclose()
+            self._finish(lane, reserved, usage, e)
+            raise
+        return _OpenStream(chunks, first, lambda error: self._finish(lane, reserved, usage, error))
+
+    async def _hedged(self, start: Callable[[bool], Awaitable[Any]], lane: str,
+                      discard: Callable[[Any], Awaitable[None]] = None) -> Any:
+        # Если интерактивный запрос не ответил за hedge_delay, отправляется второй такой же;
+        # берётся первый успешный, второй отменяется
+        tasks = [asyncio.create_task(start(True))]
+        errors: List[BaseException] = []
+        try:
+            if lane == INTERACTIVE and self.hedge_delay > 0:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+                if not done:
+                    openai_hedges.inc()
+                    tasks.append(asyncio.create_task(start(False)))
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winners = []
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is None:
+                        winners.append(task.result())
+                    elif not isinstance(task.exception(), _NoCapacity):
+                        errors.append(task.exception())
+                if winners:
+                    # Оба ответа пришли одновременно: лишний закрывается
+                    for extra in winners[1:]:
+                        if discard:
+                            await discard(extra)
+                    return winners[0]
+            raise errors[0]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def complete(self, prompt: str, lane: str = INTERACTIVE) -> str:
+        return await self._hedged(lambda wait: self._complete_attempt(prompt, lane, wait), lane)
+
+    async def stream(self, prompt: str, lane: str = INTERACTIVE) -> AsyncIterator[str]:
+        opened = await self._hedged(lambda wait: self._open_stream(prompt, lane, wait), lane,
+                                    discard=lambda extra: extra.close())
+        error = None
+        try:
+            yield opened.first
+            while True:
+                try:
+                    async with asyncio.timeout(self.timeouts[lane]):
+                        chunk = await opened.chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            await opened.close(error)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'active': dict(self.lanes.active), 'queued': self.lanes.queued(), 'circuit': self.breaker.state}
+
+
+def _is_rate_limited(error: Exception) -> bool:
+    # Ошибка OpenAI возможна только после импорта openai, поэтому отдельно его не загружаем
+    openai = sys.modules.get('openai')
+    return openai is not None and isinstance(error, openai.RateLimitError)
+
+
+def _retry_after(error: Exception) -> float:
+    try:
+        return float(error.response.headers.get('retry-after', RETRY_AFTER_DEFAULT))
+    except (AttributeError, TypeError, ValueError):
+        return RETRY_AFTER_DEFAULT
+
+
+dispatcher = LLMDispatcher()
+registry.gauge('bot_llm_queued', "Запросы к модели в очереди диспетчера", func=dispatcher.lanes.queued)
+registry.gauge('bot_llm_circuit_open', "Цепь к OpenAI разомкнута", func=lambda: float(dispatcher.breaker.state != 'closed'))
+
+
+async def _prepare(user_data: Dict[str, Any], user_message: str) -> Tuple[Optional[str], Optional[str], Optional[str], List[Dict[str, Any]]]:
+    # Возвращает (ключ кэша, промпт, готовый ответ без обращения к модели, подобранные товары)
+    log_event('recommendation_requested', user_id=(user_data or {}).get('id'), question=bool(user_message))
 
-async def generate_recommendation(user_data: Dict[str, Any], user_message: str = "") -> str:
-    logging.info(f"Generating recommendation for user: {user_data}")
-    
     if not user_data:
-        return "Извините, но для получения рекомендации нужны данные пользователя. Пожалуйста, обновите ваши предпочтения."
-    
+        return None, None, "Извините, но для получения рекомендации нужны данные пользователя. Пожалуйста, обновите ваши предпочтения.", []
+
     gender = user_data.get('gender', '')
     preferences = user_data.get('preferred_fragrances', [])
-    
+
     if not gender or not preferences:
         logging.warning("Insufficient user data for recommendation")
-        return "Извините, но для получения рекомендации нужно указать пол и предпочитаемые ароматы. Пожалуйста, обновите ваши предпочтения."
-    
-    products = get_products_by_preferences(gender, preferences)
-    
+        return None, None, "Извините, но для получения рекомендации нужно указать пол и предпочитаемые ароматы. Пожалуйста, обновите ваши предпочтения.", []
+
+    products = await pick_products(gender, preferences)
+
     if not products:
         logging.warning("No matching products found")
-        return await generate_generic_recommendation(gender, preferences)
-    
+        return make_key("generic", MODEL, gender, preferences), _generic_prompt(gender, preferences), None, []
+
     product_info = "\n".join([f"- {p['name']} ({p['category']}): {p.get('description', 'Нет описания')}" for p in products])
-    
+
     prompt = f"""
     Пользователь:
     Пол: {gender}
     Предпочитаемые ароматы: {', '.join(preferences)}
-    
+
     На основе этой информации и следующих продуктов, предоставьте персонализированную рекомендацию:
 
     {product_info}
 
-    Опишите, почему эти ароматы подходят пользователю, учитывая его предпочтения и пол. 
+    Опишите, почему эти ароматы подходят пользователю, учитывая его предпочтения и пол.
     Дайте краткое описание каждого аромата и объясните, почему он может понравиться пользователю.
     """
+    if user_message:
+        prompt += f"\n    Вопрос пользователя: {user_message}\n"
+
+    return make_key("products", MODEL, gender, preferences, [p['id'] for p in products], user_message), prompt, None, products
 
+async def _fallback(user_data: Dict[str, Any], products: List[Dict[str, Any]]) -> str:
+    # Ответ без модели: последняя подготовленная рекомендация пользователя (даже устаревшая)
+    # или подборка подобранных товаров по шаблону
     try:
-        response = await client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Вы - эксперт по парфюмерии, который дает персонализированные рекомендации."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=500
-        )
-        
-        recommendation = response.choices[0].message.content.strip()
-        
-        recommendation += "\n\nВы можете приобрести любой из парфюмов у нас на сайте: edp.by"
-        
-        logging.info("Recommendation generated successfully")
+        stored = await aget_precomputed_recommendation(user_data['id'])
+    except Exception as e:
+        logging.error(f"Failed to load stored recommendation for fallback: {e}")
+        stored = None
+    if stored:
+        llm_fallbacks.inc(source='stored')
+        return f"{FALLBACK_NOTICE} Вот ваша последняя подготовленная рекомендация:\n\n{stored['recommendation']}"
+    if products:
+        llm_fallbacks.inc(source='template')
+        return f"{FALLBACK_NOTICE}\n\n" + templates.render(user_data['gender'], user_data['preferred_fragrances'], products) + SHOP_FOOTER
+    llm_fallbacks.inc(source='error')
+    return ERROR_MESSAGE
+
+def is_fallback(text: str) -> bool:
+    return text.startswith(FALLBACK_NOTICE)
+
+def is_recordable(text: str) -> bool:
+    # Ошибка и ответ без модели (при разомкнутой цепи или исчерпанном бюджете) — не новая
+    # рекомендация: в историю и статистику они не пишутся
+    return bool(text) and ERROR_MESSAGE not in text and not is_fallback(text)
+
+def _use_template(lane: str, user_message: str) -> bool:
+    # На вопрос пользователя шаблоном не ответить — он всегда уходит в модель
+    if user_message or TEMPLATE_MODE == 'off':
+        return False
+    if TEMPLATE_MODE == 'always':
+        return True
+    if TEMPLATE_MODE == 'batch':
+        return lane == BATCH
+    return dispatcher.lanes.queued() >= TEMPLATE_LOAD_QUEUE or dispatcher.breaker.state != 'closed'
+
+def _render_template(user_data: Dict[str, Any], products: List[Dict[str, Any]], lane: str) -> str:
+    template_renders.inc(lane=lane)
+    return templates.render(user_data['gender'], user_data['preferred_fragrances'], products) + SHOP_FOOTER
+
+async def generate_recommendation(user_data: Dict[str, Any], user_message: str = "", lane: str = INTERACTIVE) -> str:
+    key, prompt, reply, products = await _prepare(user_data, user_message)
+    if reply:
+        return reply
+    if _use_template(lane, user_message):
+        return _render_template(user_data, products, lane)
+    try:
+        recommendation = await response_cache.get_or_create(key, lambda: dispatcher.complete(prompt, lane))
+        log_event('recommendation_generated')
         return recommendation
     except Exception as e:
         logging.error(f"Error generating recommendation: {str(e)}")
-        return "Извините, произошла ошибка при генерации рекомендации. Пожалуйста, попробуйте позже."
+        # Фоновым задачам шаблон не нужен: пользователь получит рекомендацию при следующем запуске
+        return await _fallback(user_data, products) if lane == INTERACTIVE else ERROR_MESSAGE
 
-async def generate_generic_recommendation(gender: str, preferences: List[str]) -> str:
-    prompt = f"""
+async def stream_recommendation(user_data: Dict[str, Any], user_message: str = "", lane: str = INTERACTIVE) -> AsyncIterator[str]:
+    key, prompt, reply, products = await _prepare(user_data, user_message)
+    if reply:
+        yield reply
+        return
+    if _use_template(lane, user_message):
+        yield _render_template(user_data, products, lane)
+        return
+    produced = False
+    try:
+        async for chunk in response_cache.stream(key, lambda: dispatcher.stream(prompt, lane)):
+            produced = True
+            yield chunk
+        log_event('recommendation_streamed')
+    except Exception as e:
+        logging.error(f"Error streaming recommendation: {str(e)}")
+        if produced:
+            yield f"\n\n{ERROR_MESSAGE}"
+        else:
+            yield await _fallback(user_data, products) if lane == INTERACTIVE else ERROR_MESSAGE
+
+def _generic_prompt(gender: str, preferences: List[str]) -> str:
+    return f"""
     Пользователь:
     Пол: {gender}
     Предпочитаемые ароматы: {', '.join(preferences)}
-    
+
     Предоставьте общую рекомендацию по выбору парфюма, основываясь на предпочтениях пользователя и его поле.
     Опишите, какие ароматы могут подойти, и почему они могут понравиться пользователю.
     """
 
+async def generate_generic_recommendation(gender: str, preferences: List[str], lane: str = INTERACTIVE) -> str:
+    key = make_key("generic", MODEL, gender, preferences)
     try:
-        response = await client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Вы - эксперт по парфюмерии, который дает персонализированные рекомендации."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=500
-        )
-        
-        recommendation = response.choices[0].message.content.strip()
-        
-        recommendation += "\n\nВы можете приобрести любой из парфюмов у нас на сайте: edp.by"
-        
-        logging.info("Generic recommendation generated successfully")
+        recommendation = await response_cache.get_or_create(key, lambda: dispatcher.complete(_generic_prompt(gender, preferences), lane))
+        log_event('generic_recommendation_generated')
         return recommendation
     except Exception as e:
         logging.error(f"Error generating generic recommendation: {str(e)}")
-        return "Извините, произошла ошибка при генерации рекомендации. Пожалуйста, попробуйте позже."
-
+        return ERROR_MESSAGE
@@ -0,0 +1,308 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, Any, List
+
+# Нагрузочный стенд: прогоняет синтетические апдейты через настоящий dp из main.py.
+# Telegram Bot API и OpenAI заменены локальными заглушками с настраиваемыми
+# задержкой и долей ошибок, поэтому результаты сравнимы между коммитами.
+#
+#   python benchmark.py --users 200 --concurrency 50 --output bench.json
+#   python benchmark.py --compare bench.json
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота")
+    parser.add_argument('--users', type=int, default=100, help="число виртуальных пользователей")
+    parser.add_argument('--concurrency', type=int, default=20, help="одновременно активных пользователей")
+    parser.add_argument('--telegram-latency', type=float, default=0.03, help="задержка Bot API, с")
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0)
+    parser.add_argument('--openai-latency', type=float, default=0.5, help="время генерации ответа, с")
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', help="путь к SQLite (по умолчанию временный файл)")
+    parser.add_argument('--output', help="сохранить результаты в JSON")
+    parser.add_argument('--compare', help="сравнить с ранее сохранёнными результатами")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="допустимый рост p95 при сравнении (доля)")
+    return parser.parse_args(argv)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class FakeChatCompletions:
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+
+    async def create(self, model: str, messages: List[Dict[str, str]], max_tokens: int = 500, stream: bool = False, **kwargs):
+        self.calls += 1
+        if random.random() < self.error_rate:
+            await asyncio.sleep(self.latency / 10)
+            raise RuntimeError("fake OpenAI error")
+        words = ["Этот", "аромат", "подойдёт", "вам", "благодаря", "нотам", "кедра", "и", "ванили."] * 12
+        usage = SimpleNamespace(prompt_tokens=len(messages[-1]['content']) // 4, completion_tokens=len(words), total_tokens=0)
+        if not stream:
+            await asyncio.sleep(self.latency)
+            message = SimpleNamespace(content=" ".join(words))
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+        async def chunks():
+            delay = self.latency / len(words)
+            for word in words:
+                await asyncio.sleep(delay)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word + " "))], usage=None)
+            if (kwargs.get('stream_options') or {}).get('include_usage'):
+                yield SimpleNamespace(choices=[], usage=usage)
+        return chunks()
+
+
+def make_fake_telegram_session(latency: float, error_rate: float):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.exceptions import TelegramNetworkError
+    from aiogram.methods import GetMe
+    from aiogram.types import Message, Chat, User
+
+    class FakeTelegramSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.requests = 0
+            self._message_id = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            self.requests += 1
+            await asyncio.sleep(latency)
+            if random.random() < error_rate:
+                raise TelegramNetworkError(method, "fake network error")
+            if isinstance(method, GetMe):
+                return User(id=bot.id, is_bot=True, first_name="bench", username="bench_bot")
+            if method.__returning__ is bool:
+                return True
+            self._message_id += 1
+            chat_id = getattr(method, 'chat_id', None) or 0
+            return Message(message_id=self._message_id, date=datetime.now(),
+                           chat=Chat(id=int(chat_id), type='private'), text=getattr(method, 'text', None)).as_(bot)
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return FakeTelegramSession()
+
+
+class UpdateFactory:
+    def __init__(self, bot_id: int):
+        from aiogram.types import Update, Message, CallbackQuery, Chat, User
+        self.Update, self.Message, self.CallbackQuery, self.Chat, self.User = Update, Message, CallbackQuery, Chat, User
+        self.bot_id = bot_id
+        self._update_id = 0
+        self._message_id = 0
+
+    def _user(self, user_id: int):
+        return self.User(id=user_id, is_bot=False, first_name=f"user{user_id}", last_name="bench")
+
+    def _message(self, user_id: int, text: str, from_bot: bool = False):
+        self._message_id += 1
+        sender = self.User(id=self.bot_id, is_bot=True, first_name="bench") if from_bot else self._user(user_id)
+        return self.Message(message_id=self._message_id, date=datetime.now(),
+                            chat=self.Chat(id=user_id, type='private'), from_user=sender, text=text)
+
+    def message(self, user_id: int, text: str):
+        self._update_id += 1
+        return self.Update(update_id=self._update_id, message=self._message(user_id, text))
+
+    def callback(self, user_id: int, data: str):
+        self._update_id += 1
+        query = self.CallbackQuery(id=str(self._update_id), from_user=self._user(user_id), chat_instance="bench",
+                                   data=data, message=self._message(user_id, "кнопки", from_bot=True))
+        return self.Update(update_id=self._update_id, callback_query=query)
+
+
+def scenario(factory: UpdateFactory, user_id: int, admin_id: int):
+    from callbacks import MenuCallback, GenderCallback, FragranceCallback, LocationCallback, FeedbackCallback, AdminCallback
+    # (тип апдейта для отчёта, апдейт)
+    steps = [
+        ('start', factory.message(user_id, "/start")),
+        ('survey', factory.callback(user_id, MenuCallback(action="survey").pack())),
+        ('survey', factory.message(user_id, str(random.randint(18, 60)))),
+        ('survey', factory.callback(user_id, GenderCallback(gender=random.choice(["мужской", "женский", "другой"])).pack())),
+    ]
+    for fragrance in random.sample(range(5), 2):
+        steps.append(('survey', factory.callback(user_id, FragranceCallback(action="pick", value=fragrance).pack())))
+    steps += [
+        ('survey', factory.callback(user_id, FragranceCallback(action="done").pack())),
+        ('survey', factory.callback(user_id, LocationCallback(city=random.choice(["Москва", "Казань", "Самара"])).pack())),
+        ('recommendation', factory.callback(user_id, MenuCallback(action="recommend").pack())),
+        ('feedback', factory.callback(user_id, FeedbackCallback(rating=random.randint(1, 5)).pack())),
+    ]
+    if random.random() < 0.05:
+        steps.append(('admin_stats', factory.callback(admin_id, AdminCallback(action="stats").pack())))
+    return steps
+
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    import database
+    db_time = [0.0]
+    run_db = database.run_db
+
+    async def timed_run_db(func, *a, **kw):
+        started = time.perf_counter()
+        try:
+            return await run_db(func, *a, **kw)
+        finally:
+            db_time[0] += time.perf_counter() - started
+    # Подменяем до импорта остальных модулей, которые импортируют run_db по имени
+    database.run_db = timed_run_db
+
+    import main
+    import ai_helper
+    from config import ADMIN_USER_IDS
+    from catalog import catalog
+    from product_import import import_products_from_csv
+    from profile_cache import profiles
+    import security
+
+    session = make_fake_telegram_session(args.telegram_latency, args.telegram_error_rate)
+    main.bot.session = session
+    completions = FakeChatCompletions(args.openai_latency, args.openai_error_rate)
+    ai_helper.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    database.init_db()
+    import_products_from_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'edpby.csv'))
+    catalog.load()
+    # Как в main.warm_up: холодный импорт cryptography и полная сборка мусора
+    # по объектам запуска не должны попадать в замеры обработчиков
+    security.warm_up()
+    main.freeze_startup_objects()
+
+    factory = UpdateFactory(main.bot.id)
+    admin_id = int(ADMIN_USER_IDS[0])
+    latencies: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_user(user_id: int):
+        async with semaphore:
+            for kind, update in scenario(factory, user_id, admin_id):
+                started = time.perf_counter()
+                try:
+                    await main.dp.feed_update(main.bot, update)
+                except Exception:
+                    errors[kind] = errors.get(kind, 0) + 1
+                latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+    db_time[0] = 0.0
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(10_000_000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    await profiles.close()
+
+    total_updates = sum(len(v) for v in latencies.values())
+    handler_time = sum(sum(v) for v in latencies.values())
+    return {
+        'commit': _git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'db')},
+        'updates': total_updates,
+        'elapsed_s': elapsed,
+        'updates_per_s': total_updates / elapsed,
+        'db_time_share': db_time[0] / handler_time if handler_time else 0.0,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'telegram_requests': session.requests,
+        'openai_calls': completions.calls,
+        'handlers': {
+            kind: {
+                'count': len(values),
+                'errors': errors.get(kind, 0),
+                'p50_ms': percentile(values, 50) * 1000,
+                'p95_ms': percentile(values, 95) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+                'mean_ms': statistics.fmean(values) * 1000,
+            }
+            for kind, values in sorted(latencies.items())
+        },
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def print_report(result: Dict[str, Any]):
+    print(f"commit {result['commit']}  updates {result['updates']}  {result['updates_per_s']:.1f} updates/s  "
+          f"db share {result['db_time_share']:.1%}  max RSS {result['max_rss_mb']:.0f} MB")
+    print(f"{'handler':<16}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, h in result['handlers'].items():
+        print(f"{kind:<16}{h['count']:>7}{h['errors']:>8}{h['p50_ms']:>10.1f}{h['p95_ms']:>10.1f}{h['p99_ms']:>10.1f}")
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> bool:
+    ok = True
+    print(f"\nсравнение с {baseline.get('commit') or 'baseline'}:")
+    print(f"  updates/s: {baseline['updates_per_s']:.1f} -> {result['updates_per_s']:.1f}")
+    for kind, h in result['handlers'].items():
+        old = baseline['handlers'].get(kind)
+        # На малых выборках p95 слишком шумный, чтобы считать его регрессией
+        if not old or not old['p95_ms'] or min(h['count'], old['count']) < 20:
+            continue
+        change = h['p95_ms'] / old['p95_ms'] - 1
+        mark = ""
+        if change > max_regression:
+            mark = "  <-- регрессия"
+            ok = False
+        print(f"  {kind:<16} p95 {old['p95_ms']:.1f} -> {h['p95_ms']:.1f} ms ({change:+.0%}){mark}")
+    return ok
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    tmpdir = None
+    if not args.db:
+        tmpdir = tempfile.TemporaryDirectory()
+        args.db = os.path.join(tmpdir.name, 'bench.db')
+    # Окружение задаётся до импорта config: заглушки не должны трогать боевые БД и ключи
+    os.environ['DATABASE_URL'] = args.db
+    os.environ['TELEGRAM_TOKEN'] = '123456:BENCHMARKbenchmarkBENCHMARKbenchmark'
+    os.environ['OPENAI_API_KEY'] = 'sk-benchmark'
+    os.environ.setdefault('ENCRYPTION_KEY', 'YmVuY2htYXJrYmVuY2htYXJrYmVuY2htYXJrMTIzNDU=')
+
+    result = asyncio.run(run_benchmark(args))
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    ok = True
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            ok = compare(result, json.load(f), args.max_regression)
+    if tmpdir:
+        tmpdir.cleanup()
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+from typing import Dict, Any, List, Optional
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from config import BROADCAST_CONCURRENCY, BROADCAST_LEASE_TTL, BROADCAST_CLAIM_TTL
+from database import (run_db, create_broadcast, get_broadcast, get_unfinished_broadcasts, set_broadcast_status,
+                      pause_broadcast, set_broadcast_progress_message, claim_recipients, count_outstanding_recipients,
+                      release_recipients, mark_deliveries, get_broadcast_counts, reset_failed_deliveries)
+from shared_state import backend as state_backend
+from ratelimit import TelegramSender, SendError
+from callbacks import BroadcastCallback
+
+RECIPIENTS_CHUNK_SIZE = 1000
+RESULTS_FLUSH_SIZE = 200
+PROGRESS_INTERVAL = 3.0
+
+
+def _controls(broadcast_id: int, status: str, failed: int) -> InlineKeyboardMarkup:
+    keyboard = InlineKeyboardBuilder()
+    if status == 'running':
+        keyboard.button(text="Пауза", callback_data=BroadcastCallback(action="pause", broadcast_id=broadcast_id))
+    elif status == 'paused':
+        keyboard.button(text="Продолжить", callback_data=BroadcastCallback(action="resume", broadcast_id=broadcast_id))
+    if status != 'running' and failed:
+        keyboard.button(text="Повторить неудачные", callback_data=BroadcastCallback(action="retry", broadcast_id=broadcast_id))
+    keyboard.adjust(1)
+    return keyboard.as_markup()
+
+
+def _progress_text(broadcast_id: int, status: str, counts: Dict[str, int], rate: float) -> str:
+    total = sum(counts.values())
+    titles = {'running': "идёт", 'paused': "на паузе", 'done': "завершена"}
+    text = f"Рассылка #{broadcast_id} ({titles.get(status, status)})\n\n"
+    text += f"Отправлено: {counts['sent']} из {total}\n"
+    text += f"Ошибок: {counts['failed']}\n"
+    text += f"Осталось: {counts['pending']}"
+    if status == 'running':
+        text += f"\nСкорость: {rate:.1f} сообщ./с"
+    return text
+
+
+def _lease_name(broadcast_id: int) -> str:
+    return f"broadcast:{broadcast_id}"
+
+
+class BroadcastEngine:
+    # Рассылку отправляет один процесс — владелец аренды broadcast:<id> в общем хранилище
+    # состояния. Остальные (новый лидер, другой webhook-воркер) ждут, пока аренда освободится.
+    def __init__(self):
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._paused: Dict[int, asyncio.Event] = {}
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    @property
+    def running_count(self) -> int:
+        return len(self._tasks)
+
+    async def start(self, bot: Bot, admin_chat_id: int, text: str, segment: Optional[Dict[str, Any]] = None) -> int:
+        broadcast_id = await run_db(create_broadcast, admin_chat_id, text, segment)
+        logging.info(f"Broadcast {broadcast_id} created by {admin_chat_id} for segment {segment or 'all'}")
+        self._launch(bot, broadcast_id)
+        return broadcast_id
+
+    async def pause(self, broadcast_id: int):
+        if broadcast_id in self._paused:
+            self._paused[broadcast_id].set()
+        else:
+            await run_db(pause_broadcast, broadcast_id)
+
+    async def resume(self, bot: Bot, broadcast_id: int):
+        task = self._tasks.get(broadcast_id)
+        if task is not None:
+            if not self._paused[broadcast_id].is_set():
+                return
+            # Пауза ещё применяется: дожидаемся остановки и запускаем заново
+            await task
+        await run_db(set_broadcast_status, broadcast_id, 'running')
+        self._launch(bot, broadcast_id)
+
+    async def retry_failed(self, bot: Bot, broadcast_id: int) -> int:
+        if broadcast_id in self._tasks and not self._paused[broadcast_id].is_set():
+            return 0
+        count = await run_db(reset_failed_deliveries, broadcast_id)
+        if count:
+            await self.resume(bot, broadcast_id)
+        return count
+
+    async def resume_unfinished(self, bot: Bot):
+        for broadcast_id in await run_db(get_unfinished_broadcasts):
+            if broadcast_id in self._tasks:
+                continue
+            logging.info(f"Resuming broadcast {broadcast_id}")
+            self._launch(bot, broadcast_id)
+
+    def _launch(self, bot: Bot, broadcast_id: int):
+        self._paused[broadcast_id] = asyncio.Event()
+        task = asyncio.create_task(self._run(bot, broadcast_id))
+        self._tasks[broadcast_id] = task
+
+        def cleanup(_):
+            if self._tasks.get(broadcast_id) is task:
+                del self._tasks[broadcast_id]
+                del self._paused[broadcast_id]
+        task.add_done_callback(cleanup)
+
+    async def _acquire(self, broadcast_id: int) -> bool:
+        # Пока аренду держит другой процесс, рассылку не трогаем: ждём, пока он её закончит,
+        # поставит на паузу или перестанет продлевать аренду
+        while not await state_backend.acquire_lease(_lease_name(broadcast_id), self.owner, BROADCAST_LEASE_TTL):
+            broadcast = await run_db(get_broadcast, broadcast_id)
+            if broadcast is None or broadcast['status'] != 'running':
+                return False
+            await asyncio.sleep(PROGRESS_INTERVAL)
+        return True
+
+    async def _run(self, bot: Bot, broadcast_id: int):
+        if not await self._acquire(broadcast_id):
+            return
+        try:
+            await self._send(bot, broadcast_id)
+        finally:
+            await run_db(release_recipients, broadcast_id, self.owner)
+            await state_backend.release_lease(_lease_name(broadcast_id), self.owner)
+
+    async def _send(self, bot: Bot, broadcast_id: int):
+        broadcast = await run_db(get_broadcast, broadcast_id)
+        paused = self._paused[broadcast_id]
+        counts = await run_db(get_broadcast_counts, broadcast_id)
+        # Каждому получателю уходит одно сообщение, поэтому ограничиваем только общую скорость
+        sender = TelegramSender(bot, per_chat_interval=0)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=RECIPIENTS_CHUNK_SIZE)
+        results: List[tuple] = []
+        started = time.monotonic()
+        delivered = 0
+        lost = False
+
+        progress_message_id = broadcast['progress_message_id']
+        if progress_message_id is None:
+            message = await bot.send_message(broadcast['admin_chat_id'],
+                                             _progress_text(broadcast_id, 'running', counts, 0.0),
+                                             reply_markup=_controls(broadcast_id, 'running', 0))
+            progress_message_id = message.message_id
+            await run_db(set_broadcast_progress_message, broadcast_id, progress_message_id)
+
+        async def flush():
+            nonlocal results
+            if results:
+                batch, results = results, []
+                await run_db(mark_deliveries, broadcast_id, batch)
+
+        async def show(status: str):
+            rate = delivered / max(time.monotonic() - started, 1e-9)
+            try:
+                await bot.edit_message_text(_progress_text(broadcast_id, status, counts, rate),
+                                            chat_id=broadcast['admin_chat_id'], message_id=progress_message_id,
+                                            reply_markup=_controls(broadcast_id, status, counts['failed']))
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    logging.warning(f"Failed to update broadcast progress: {e}")
+
+        async def produce():
+            while not paused.is_set():
+                recipients = await run_db(claim_recipients, broadcast_id, self.owner, RECIPIENTS_CHUNK_SIZE, BROADCAST_CLAIM_TTL)
+                if not recipients:
+                    if not await run_db(count_outstanding_recipients, broadcast_id, self.owner):
+                        break
+                    # Часть получателей ещё захвачена прежним владельцем: ждём отправки, возврата
+                    # или истечения захвата
+                    await asyncio.sleep(PROGRESS_INTERVAL)
+                    continue
+                for user_id in recipients:
+                    await queue.put(user_id)
+            for _ in range(BROADCAST_CONCURRENCY):
+                await queue.put(None)
+
+        async def deliver():
+            nonlocal delivered
+            while (user_id := await queue.get()) is not None:
+                if paused.is_set():
+                    continue
+                try:
+                    await sender.send_message(user_id, broadcast['text'])
+                    results.append((user_id, 'sent', None))
+                    counts['sent'] += 1
+                    delivered += 1
+                except SendError as e:
+                    results.append((user_id, 'failed', str(e)))
+                    counts['failed'] += 1
+                except Exception as e:
+                    logging.error(f"Failed to send broadcast to user {user_id}: {str(e)}")
+                    results.append((user_id, 'failed', str(e)))
+                    counts['failed'] += 1
+                counts['pending'] -= 1
+                if len(results) >= RESULTS_FLUSH_SIZE:
+                    await flush()
+
+        async def report():
+            nonlocal lost
+            while True:
+                await asyncio.sleep(PROGRESS_INTERVAL)
+                if not await state_backend.acquire_lease(_lease_name(broadcast_id), self.owner, BROADCAST_LEASE_TTL):
+                    # Аренду забрал другой процесс (например, после долгой остановки цикла событий): прекращаем отправку
+                    logging.warning(f"Broadcast {broadcast_id} lease lost by {self.owner}")
+                    lost = True
+                    paused.set()
+                    return
+                # Пауза могла быть нажата в другом процессе (webhook-воркере) — она приходит через статус в базе
+                if (await run_db(get_broadcast, broadcast_id))['status'] == 'paused':
+                    paused.set()
+                await show('running')
+
+        reporter = asyncio.create_task(report())
+        try:
+            await asyncio.gather(produce(), *(deliver() for _ in range(BROADCAST_CONCURRENCY)))
+        finally:
+            reporter.cancel()
+            await flush()
+
+        if lost:
+            return
+        status = 'paused' if paused.is_set() and counts['pending'] else 'done'
+        await run_db(set_broadcast_status, broadcast_id, status)
+        await show(status)
+        logging.info(f"Broadcast {broadcast_id} {status}: {counts}")
+
+
+engine = BroadcastEngine()
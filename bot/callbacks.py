@@ -0,0 +1,35 @@
+from typing import Optional
+from aiogram.filters.callback_data import CallbackData
+
+# Данные inline-кнопок: у каждого вида кнопок свой префикс, поля упаковываются
+# в строку "префикс:поле:..." и разбираются обратно в типизированный объект.
+
+
+class MenuCallback(CallbackData, prefix="menu"):
+    action: str  # recommend, survey, admin
+
+
+class GenderCallback(CallbackData, prefix="gender"):
+    gender: str
+
+
+class FragranceCallback(CallbackData, prefix="fragrance"):
+    action: str  # pick — value это номер аромата в FRAGRANCE_FAMILIES, page — номер страницы, done
+    value: int = 0
+
+
+class LocationCallback(CallbackData, prefix="location"):
+    city: Optional[str] = None  # None — "Другой город", название вводится текстом
+
+
+class FeedbackCallback(CallbackData, prefix="feedback"):
+    rating: int
+
+
+class AdminCallback(CallbackData, prefix="admin"):
+    action: str  # stats, support, broadcast
+
+
+class BroadcastCallback(CallbackData, prefix="broadcast"):
+    action: str  # pause, resume, retry
+    broadcast_id: int
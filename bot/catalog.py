@@ -0,0 +1,138 @@
+import sys
+import random
+import logging
+import threading
+from array import array
+from itertools import accumulate
+from typing import Dict, Any, List, Optional, Tuple
+from database import read_cursor, on_products_imported, aget_products_by_preferences
+from popularity import load_product_scores, on_popularity_updated
+from fragrances import FRAGRANCE_FAMILIES, FRAGRANCE_KEYWORDS, GENDER_CATEGORIES, stem
+
+
+class Product:
+    __slots__ = ('id', 'name', 'url', 'category', 'description')
+
+    def __init__(self, id: str, name: str, url: str, category: str, description: str):
+        self.id = id
+        self.name = name
+        self.url = url
+        self.category = category
+        self.description = description
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'id': self.id, 'name': self.name, 'url': self.url,
+                'category': self.category, 'description': self.description}
+
+
+class _Snapshot:
+    __slots__ = ('products', 'by_id', 'popularity', 'postings', 'by_family', 'by_category')
+
+    def __init__(self, products: List[Product], popularity: Dict[str, float]):
+        # Товары упорядочены по убыванию популярности, поэтому и все списки индексов ниже
+        # уже отсортированы: лучшие кандидаты — в начале каждого списка
+        products = sorted(products, key=lambda p: -popularity.get(p.id, 0.0))
+        self.products = products
+        self.by_id = {product.id: product for product in products}
+        self.popularity = [popularity.get(product.id, 0.0) for product in products]
+        # (семейство, раздел) -> индексы товаров
+        self.postings: Dict[Tuple[str, str], array] = {}
+        self.by_family: Dict[str, array] = {family: array('I') for family in FRAGRANCE_FAMILIES}
+        self.by_category: Dict[str, array] = {}
+        terms = {family: [stem(family)] + FRAGRANCE_KEYWORDS.get(family, []) for family in FRAGRANCE_FAMILIES}
+        for index, product in enumerate(products):
+            self.by_category.setdefault(product.category, array('I')).append(index)
+            text = f"{product.name} {product.url} {product.description}".lower()
+            for family, family_terms in terms.items():
+                if any(term in text for term in family_terms):
+                    self.by_family[family].append(index)
+                    self.postings.setdefault((family, product.category), array('I')).append(index)
+
+
+class Catalog:
+    def __init__(self):
+        self._snapshot: Optional[_Snapshot] = None
+        self._reload_lock = threading.Lock()
+        self._hooked = False
+
+    @property
+    def loaded(self) -> bool:
+        return self._snapshot is not None
+
+    def __len__(self) -> int:
+        return len(self._snapshot.products) if self._snapshot else 0
+
+    def load(self):
+        with read_cursor() as c:
+            c.execute("SELECT id, name, url, category, description FROM products")
+            products = [Product(p[0], p[1] or '', p[2] or '', p[3] or '', p[4] or '') for p in c.fetchall()]
+        snapshot = _Snapshot(products, load_product_scores())
+        with self._reload_lock:
+            # Снимок заменяется целиком, читатели никогда не видят частично построенный индекс
+            self._snapshot = snapshot
+            if not self._hooked:
+                on_products_imported(self.reload)
+                on_popularity_updated(self.reload)
+                self._hooked = True
+        logging.info(f"Catalog loaded: {len(products)} products")
+
+    def reload(self):
+        self.load()
+
+    def get_many(self, product_ids: List[str]) -> List[Dict[str, Any]]:
+        snapshot = self._snapshot
+        if snapshot is None:
+            return []
+        return [snapshot.by_id[i].as_dict() for i in product_ids if i in snapshot.by_id]
+
+    def sample(self, gender: str, fragrances: List[str], limit: int = 5) -> List[Dict[str, Any]]:
+        snapshot = self._snapshot
+        if snapshot is None or not snapshot.products:
+            return []
+        category = GENDER_CATEGORIES.get((gender or '').lower())
+        lists = [snapshot.postings.get((f, category)) for f in fragrances] if category else []
+        lists = [p for p in lists if p]
+        if not lists:
+            lists = [p for p in (snapshot.by_family.get(f) for f in fragrances) if p]
+        if not lists:
+            lists = [snapshot.by_category.get(category) or range(len(snapshot.products))]
+
+        if snapshot.popularity[0] > 0:
+            # Есть данные о популярности: берём самые популярные из начала каждого списка
+            candidates = {i for postings in lists for i in postings[:limit]}
+            return [snapshot.products[i].as_dict() for i in sorted(candidates)[:limit]]
+
+        # Без данных о популярности — выбор списка пропорционально его длине и случайного
+        # элемента в нём: O(limit) вместо сортировки всех совпадений.
+        cum_weights = list(accumulate(len(p) for p in lists))
+        total = cum_weights[-1]
+        picked: Dict[int, None] = {}
+        attempts = 0
+        while len(picked) < min(limit, total) and attempts < limit * 4:
+            attempts += 1
+            postings = random.choices(lists, cum_weights=cum_weights)[0]
+            picked[postings[random.randrange(len(postings))]] = None
+        return [snapshot.products[i].as_dict() for i in picked]
+
+
+catalog = Catalog()
+
+
+def _vector_index():
+    # Модуль vectors (и numpy) импортируется при прогреве после запуска; до этого векторного поиска нет
+    vectors = sys.modules.get('vectors')
+    return vectors.vector_index if vectors is not None and vectors.vector_index.loaded else None
+
+
+async def pick_products(gender: str, fragrances: List[str], limit: int = 5) -> List[Dict[str, Any]]:
+    vector_index = _vector_index()
+    if catalog.loaded and vector_index is not None:
+        # Ближайшие по смыслу товары из векторного индекса, иначе — случайная выборка по ключевым словам
+        products = catalog.get_many([product_id for product_id, _ in vector_index.search(gender, fragrances, limit)])
+        if products:
+            return products
+    if catalog.loaded:
+        products = catalog.sample(gender, fragrances, limit)
+        if products:
+            return products
+    return await aget_products_by_preferences(gender, fragrances, limit)
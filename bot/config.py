@@ -10,6 +10,101 @@ ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY")
 GOOGLE_SHEETS_CREDENTIALS = os.getenv("GOOGLE_SHEETS_CREDENTIALS")
 GOOGLE_SHEETS_ID = os.getenv("GOOGLE_SHEETS_ID")
 
+# Количество потоков/соединений SQLite для неблокирующих запросов
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+# Кэш ответов OpenAI: размер (записей), время жизни (секунды), хранение в SQLite
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "21600"))
+LLM_CACHE_PERSISTENT = os.getenv("LLM_CACHE_PERSISTENT", "1") == "1"
+
+# Минимальный интервал между правками сообщения при потоковом выводе ответа (секунды)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+# Ежедневная рассылка рекомендаций: число параллельных генераций и лимиты Telegram
+RECOMMENDATION_CONCURRENCY = int(os.getenv("RECOMMENDATION_CONCURRENCY", "8"))
+# Пропускать тех, кто получал рекомендацию за последние N дней (0 — отправлять всем)
+RECOMMENDATION_INACTIVE_DAYS = int(os.getenv("RECOMMENDATION_INACTIVE_DAYS", "0"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_PER_CHAT_INTERVAL = float(os.getenv("TELEGRAM_PER_CHAT_INTERVAL", "1.0"))
+
+# Кэш профилей пользователей: лимит памяти (байты) и период сброса изменений в БД (секунды)
+PROFILE_CACHE_MAX_BYTES = int(os.getenv("PROFILE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+PROFILE_FLUSH_INTERVAL = float(os.getenv("PROFILE_FLUSH_INTERVAL", "5"))
+
+# Шифрование персональных данных: лимит памяти кэша расшифрованных значений (байты),
+# потоки для расшифровки больших пачек (0 — в вызывающем потоке) и минимальный размер такой пачки,
+# размер порции при миграции существующих записей
+PII_CACHE_MAX_BYTES = int(os.getenv("PII_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))
+PII_CRYPTO_WORKERS = int(os.getenv("PII_CRYPTO_WORKERS", "0"))
+PII_PARALLEL_MIN = int(os.getenv("PII_PARALLEL_MIN", "512"))
+PII_MIGRATION_CHUNK = int(os.getenv("PII_MIGRATION_CHUNK", "500"))
+
+# Рассылки администратора: число одновременных отправок
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "30"))
+# Аренда рассылки одним процессом (с) и срок захвата пачки получателей (с): если процесс
+# упал, не отправив захваченных, их заберёт другой процесс по истечении захвата
+BROADCAST_LEASE_TTL = float(os.getenv("BROADCAST_LEASE_TTL", "30"))
+BROADCAST_CLAIM_TTL = float(os.getenv("BROADCAST_CLAIM_TTL", "600"))
+
+# Векторный индекс товаров: каталог с файлами индекса и размерность векторов.
+# Относительный путь считается от каталога базы данных, а не от текущего каталога процесса
+_DATA_DIR = os.path.dirname(os.path.abspath(DATABASE_URL)) if DATABASE_URL else os.path.dirname(os.path.abspath(__file__))
+VECTOR_INDEX_DIR = os.path.join(_DATA_DIR, os.getenv("VECTOR_INDEX_DIR", "vector_index"))
+VECTOR_DIMENSIONS = int(os.getenv("VECTOR_DIMENSIONS", "64"))
+
+# Популярность товаров по логу событий: период полураспада веса события (дни)
+POPULARITY_HALF_LIFE_DAYS = float(os.getenv("POPULARITY_HALF_LIFE_DAYS", "30"))
+
+# Заранее подготовленные рекомендации: срок годности (секунды), час ночного пересчёта (местное время)
+# и число параллельных генераций при пересчёте
+RECOMMENDATION_TTL = float(os.getenv("RECOMMENDATION_TTL", str(7 * 24 * 3600)))
+PRECOMPUTE_HOUR = int(os.getenv("PRECOMPUTE_HOUR", "4"))
+PRECOMPUTE_CONCURRENCY = int(os.getenv("PRECOMPUTE_CONCURRENCY", "4"))
+
+# Режим webhook: публичный адрес, путь и секрет для Telegram, адрес локального сервера и число процессов
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+
+# Общее состояние процессов (FSM, аренды): memory — в памяти процесса, sqlite — в общей базе
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+
+# Диспетчер запросов к OpenAI: общий лимит параллельных запросов и лимит для фоновых задач,
+# бюджет токенов в минуту и доля бюджета, которую фоновые задачи не трогают,
+# таймауты (секунды), задержка дублирующего запроса для интерактивных ответов (0 — выключено),
+# число ошибок подряд до размыкания и пауза до пробного запроса
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_BATCH_CONCURRENCY = int(os.getenv("LLM_BATCH_CONCURRENCY", "4"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "200000"))
+LLM_INTERACTIVE_RESERVE = float(os.getenv("LLM_INTERACTIVE_RESERVE", "0.2"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_BATCH_TIMEOUT = float(os.getenv("LLM_BATCH_TIMEOUT", "90"))
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "5"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+# Лимиты выше заданы на весь бот; процессов, которые их делят, столько (webhook.py выставляет
+# число воркеров сам). Размыкание цепи и пауза по 429 передаются между процессами через
+# общее хранилище состояния, не чаще раза в LLM_SHARED_SYNC_INTERVAL секунд
+LLM_WORKERS = max(1, int(os.getenv("LLM_WORKERS", "1")))
+LLM_SHARED_SYNC_INTERVAL = float(os.getenv("LLM_SHARED_SYNC_INTERVAL", "1"))
+
+# Рекомендации по шаблону без запроса к модели: off — никогда, batch — для фоновых задач,
+# load — когда в очереди диспетчера не меньше TEMPLATE_LOAD_QUEUE запросов или цепь разомкнута,
+# always — для всех запросов без вопроса пользователя
+TEMPLATE_MODE = os.getenv("TEMPLATE_MODE", "load")
+TEMPLATE_LOAD_QUEUE = int(os.getenv("TEMPLATE_LOAD_QUEUE", "4"))
+
+# Метрики: адрес локального HTTP-сервера с /metrics (порт 0 — выключено; в режиме webhook
+# воркер N слушает METRICS_PORT + N) и доля частых событий, попадающих в лог
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+
 # Добавьте список ID администраторов (замените на реальные ID)
 ADMIN_USER_IDS = ["6306428168"]
 
@@ -1,27 +1,155 @@
+import sys
+import asyncio
+import logging
+import argparse
+import numpy as np
 import pandas as pd
-import sqlite3
-from typing import Dict, Any, List
-from config import DATABASE_URL
+from typing import Dict, Any, List, Iterator, Iterable
+from database import init_db, read_cursor, write_cursor
+
+# Аналитика заказов по частям: заказы читаются порциями (из SQLite по первичному ключу
+# или из снимка Parquet), каждая порция сворачивается векторно и прибавляется к агрегатам
+# в базе вместе с номером последнего учтённого заказа. Следующий запуск обрабатывает только новые заказы.
+CHUNK_SIZE = 50000
+IN_BATCH_SIZE = 500
+ORDER_COLUMNS = ['id', 'user_id', 'product']
+STATE_SOURCE = 'orders'
 
 def analyze_user_data(user_data: Dict[str, Any]) -> Dict[str, Any]:
     # Здесь будет код для анализа данных пользователя
     # и генерации рекомендаций на основе истории покупок
     return user_data
 
-def load_order_history() -> pd.DataFrame:
-    conn = sqlite3.connect(DATABASE_URL)
-    df = pd.read_sql_query("SELECT * FROM orders", conn)
-    conn.close()
-    return df
+def get_order_watermark() -> int:
+    with read_cursor() as c:
+        c.execute("SELECT last_order_id FROM order_analytics_state WHERE source = ?", (STATE_SOURCE,))
+        row = c.fetchone()
+    return row[0] if row else 0
+
+def iter_order_chunks(after_id: int = 0, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    # Постраничное чтение по первичному ключу: в памяти не больше одной порции
+    last_id = after_id
+    while True:
+        with read_cursor() as c:
+            c.execute("SELECT id, user_id, product FROM orders WHERE id > ? ORDER BY id LIMIT ?", (last_id, chunk_size))
+            rows = c.fetchall()
+        if not rows:
+            return
+        yield pd.DataFrame.from_records(rows, columns=ORDER_COLUMNS)
+        last_id = rows[-1][0]
+
+def iter_parquet_chunks(path: str, after_id: int = 0, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    # Снимок заказов в Parquet читается по группам строк и только нужные колонки
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Для чтения Parquet нужен пакет pyarrow")
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=ORDER_COLUMNS):
+        df = batch.to_pandas()
+        df = df[df['id'] > after_id]
+        if len(df):
+            yield df
+
+def _existing_products(c, user_ids: List[int]) -> pd.DataFrame:
+    rows = []
+    for start in range(0, len(user_ids), IN_BATCH_SIZE):
+        batch = user_ids[start:start + IN_BATCH_SIZE]
+        c.execute(f"SELECT user_id, product FROM order_customer_products WHERE user_id IN ({','.join('?' * len(batch))})", batch)
+        rows.extend(c.fetchall())
+    return pd.DataFrame.from_records(rows, columns=['user_id', 'product'])
+
+def _pair_counts(new: pd.DataFrame, existing: pd.DataFrame) -> pd.DataFrame:
+    # Пара считается один раз на покупателя: новый товар × уже купленные им раньше
+    # плюс новые товары одной порции между собой (a < b)
+    old_pairs = new.merge(existing, on='user_id', suffixes=('_a', '_b'))
+    new_pairs = new.merge(new, on='user_id', suffixes=('_a', '_b'))
+    new_pairs = new_pairs[new_pairs['product_a'] < new_pairs['product_b']]
+    pairs = pd.concat([old_pairs, new_pairs], ignore_index=True)
+    if pairs.empty:
+        return pd.DataFrame(columns=['product_a', 'product_b', 'customers'])
+    a = pairs['product_a'].to_numpy()
+    b = pairs['product_b'].to_numpy()
+    swap = a > b
+    ordered = pd.DataFrame({'product_a': np.where(swap, b, a), 'product_b': np.where(swap, a, b)})
+    return ordered.groupby(['product_a', 'product_b'], sort=False).size().reset_index(name='customers')
+
+def _save_watermark(c, last_order_id: int):
+    c.execute('''INSERT INTO order_analytics_state (source, last_order_id, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                 ON CONFLICT(source) DO UPDATE SET last_order_id = MAX(last_order_id, excluded.last_order_id),
+                                                   updated_at = excluded.updated_at''',
+              (STATE_SOURCE, last_order_id))
 
-def analyze_order_history(df: pd.DataFrame) -> Dict[str, Any]:
-    # Анализ истории заказов
-    # Здесь вы можете использовать различные методы анализа данных
-    # например, корреляционный анализ, кластеризацию и т.д.
+def _apply_chunk(chunk: pd.DataFrame) -> Dict[str, int]:
+    # Отметка считается по всей порции: строки без покупателя или товара тоже учтены
+    # (пропущены), иначе они читались бы заново при каждом запуске
+    watermark = int(chunk['id'].max())
+    df = chunk.dropna(subset=['user_id', 'product'])
+    if df.empty:
+        with write_cursor() as c:
+            _save_watermark(c, watermark)
+        return {'orders': 0, 'pairs': 0}
+    df = df.astype({'user_id': 'int64', 'product': 'str'})
+    products = df['product'].value_counts()
+    customers = df['user_id'].value_counts()
+    bought = df[['user_id', 'product']].drop_duplicates()
+
+    with write_cursor() as c:
+        existing = _existing_products(c, bought['user_id'].unique().tolist())
+        # Товары, которые покупатель уже брал раньше, новых пар не дают
+        new = bought.merge(existing, on=['user_id', 'product'], how='left', indicator=True)
+        new = new[new['_merge'] == 'left_only'][['user_id', 'product']]
+        pairs = _pair_counts(new, existing)
+
+        c.executemany('''INSERT INTO order_product_counts (product, orders) VALUES (?, ?)
+                         ON CONFLICT(product) DO UPDATE SET orders = orders + excluded.orders''',
+                      zip(products.index.tolist(), products.tolist()))
+        c.executemany('''INSERT INTO order_customer_counts (user_id, orders) VALUES (?, ?)
+                         ON CONFLICT(user_id) DO UPDATE SET orders = orders + excluded.orders''',
+                      zip(customers.index.tolist(), customers.tolist()))
+        c.executemany("INSERT INTO order_customer_products (user_id, product) VALUES (?, ?)",
+                      new.itertuples(index=False, name=None))
+        c.executemany('''INSERT INTO order_pairs (product_a, product_b, customers) VALUES (?, ?, ?)
+                         ON CONFLICT(product_a, product_b) DO UPDATE SET customers = customers + excluded.customers''',
+                      pairs.itertuples(index=False, name=None))
+        # Отметка сохраняется в той же транзакции, что и агрегаты: порция учитывается ровно один раз
+        _save_watermark(c, watermark)
+    return {'orders': len(df), 'pairs': len(pairs)}
+
+def update_order_aggregates(chunks: Iterable[pd.DataFrame] = None) -> Dict[str, int]:
+    stats = {'chunks': 0, 'orders': 0, 'pairs': 0}
+    if chunks is None:
+        chunks = iter_order_chunks(get_order_watermark())
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        result = _apply_chunk(chunk.sort_values('id'))
+        stats['chunks'] += 1
+        stats['orders'] += result['orders']
+        stats['pairs'] += result['pairs']
+    logging.info(f"Order analytics updated: {stats}")
+    return stats
+
+async def aupdate_order_aggregates() -> Dict[str, int]:
+    # pandas держит поток надолго, поэтому не в пуле соединений БД
+    return await asyncio.to_thread(update_order_aggregates)
+
+def analyze_order_history(limit: int = 10) -> Dict[str, Any]:
+    # Ответ собирается из накопленных агрегатов, сами заказы не читаются
+    with read_cursor() as c:
+        c.execute("SELECT product, orders FROM order_product_counts ORDER BY orders DESC LIMIT ?", (limit,))
+        top_products = dict(c.fetchall())
+        c.execute("SELECT COALESCE(SUM(orders), 0), COUNT(*) FROM order_customer_counts")
+        total_orders, unique_customers = c.fetchone()
+        c.execute("SELECT user_id, orders FROM order_customer_counts ORDER BY orders DESC LIMIT ?", (limit,))
+        top_customers = dict(c.fetchall())
+        c.execute("SELECT product_a, product_b, customers FROM order_pairs ORDER BY customers DESC LIMIT ?", (limit,))
+        top_pairs = [{'products': (a, b), 'customers': n} for a, b, n in c.fetchall()]
     analysis_results = {
-        'top_products': df['product'].value_counts().head(10).to_dict(),
-        'total_orders': len(df),
-        'unique_customers': df['user_id'].nunique()
+        'top_products': top_products,
+        'total_orders': total_orders,
+        'unique_customers': unique_customers,
+        'top_customers': top_customers,
+        'top_pairs': top_pairs,
     }
     return analysis_results
 
@@ -35,3 +163,20 @@ def get_special_offers() -> List[str]:
     # Например, на основе текущих акций в магазине
     return ["Скидка 20% на все ароматы Chanel", "Подарок при покупке парфюма от Dior"]
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Инкрементальная аналитика заказов")
+    parser.add_argument('--parquet', help="снимок заказов в Parquet (колонки id, user_id, product) вместо таблицы orders")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    init_db()
+    watermark = get_order_watermark()
+    if args.parquet:
+        chunks = iter_parquet_chunks(args.parquet, watermark, args.chunk_size)
+    else:
+        chunks = iter_order_chunks(watermark, args.chunk_size)
+    print(update_order_aggregates(chunks))
+    print(analyze_order_history())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,243 +1,918 @@
+import math
 import sqlite3
-import csv
-import os
 import json
 import random
+import asyncio
+import functools
 import logging
-from typing import Dict, Any, List
-from config import DATABASE_URL
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Any, List, Callable, Iterator, Optional, TypeVar
+from config import DATABASE_URL, DB_POOL_SIZE, PII_MIGRATION_CHUNK
+from fragrances import FRAGRANCE_FAMILIES, FRAGRANCE_BITS, GENDER_CATEGORIES, search_terms, fragrance_mask, fragrances_from_mask
+from metrics import record_db_call, log_event
+from segments import compile_spec
+from security import (encrypt_many, decrypt_many, decrypt_value, reencrypt_value, location_key, location_key_id,
+                      encryption_enabled)
 
 logging.basicConfig(level=logging.INFO)
 
+T = TypeVar("T")
+
+USER_FIELDS = ('first_name', 'last_name', 'age', 'gender', 'preferred_fragrances', 'location')
+# Колонки users, которые хранятся зашифрованными (security.py)
+PII_FIELDS = ('first_name', 'last_name', 'location')
+# Профиль читается явным списком колонок: порядок колонок в SELECT * зависит от того,
+# в каком порядке база проходила миграции _add_columns
+_USER_COLUMNS = ('id', 'first_name', 'last_name', 'age', 'gender', 'fragrance_mask', 'location')
+_USER_SELECT = "SELECT " + ", ".join(f"users.{column}" for column in _USER_COLUMNS) + " FROM users"
+_PII_POSITIONS = tuple(_USER_COLUMNS.index(field) for field in PII_FIELDS)
+
+# Пул соединений: у каждого потока своё долгоживущее соединение (WAL позволяет
+# читать параллельно), запись сериализуется через _write_lock.
+# sqlite3 кэширует подготовленные выражения на уровне соединения, поэтому
+# SQL-строки ниже — константы и переиспользуются между вызовами.
+_local = threading.local()
+_connections: List[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+_write_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+_fts_enabled = None
+_products_listeners: List[Callable[[], None]] = []
+
+
+def get_connection() -> sqlite3.Connection:
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_URL, timeout=30, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.create_function('location_hash', 1, _location_hash, deterministic=True)
+        conn.create_function('logaddexp2', 2, logaddexp2, deterministic=True)
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+@contextmanager
+def read_cursor() -> Iterator[sqlite3.Cursor]:
+    cursor = get_connection().cursor()
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+
+
+@contextmanager
+def write_cursor() -> Iterator[sqlite3.Cursor]:
+    conn = get_connection()
+    with _write_lock, conn:
+        cursor = conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+
+def close_connections():
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+    _local.__dict__.clear()
+
+
+def _timed_call(func: Callable[..., T], *args, **kwargs) -> T:
+    # Время считается внутри потока пула: ожидание свободного потока видно по db_queue_depth
+    started = time.perf_counter()
+    failed = True
+    try:
+        result = func(*args, **kwargs)
+        failed = False
+        return result
+    finally:
+        record_db_call(getattr(func, '__name__', 'unknown'), time.perf_counter() - started, failed)
+
+
+async def run_db(func: Callable[..., T], *args, **kwargs) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(_timed_call, func, *args, **kwargs))
+
+
+def db_queue_depth() -> int:
+    return _executor._work_queue.qsize()
+
+
+def logaddexp2(a: Optional[float], b: Optional[float]) -> Optional[float]:
+    # log2(2**a + 2**b) без переполнения: сами веса популярности за пределами float
+    if a is None:
+        return b
+    if b is None:
+        return a
+    high, low = (a, b) if a >= b else (b, a)
+    return high + math.log2(1.0 + 2.0 ** (low - high))
+
+
+def _location_hash(value: Optional[str]) -> Optional[str]:
+    return location_key(decrypt_value(value))
+
+
+def _user_from_row(user, first_name: str, last_name: str, location: str) -> Dict[str, Any]:
+    return {
+        'id': user[0],
+        'first_name': first_name,
+        'last_name': last_name,
+        'age': user[3],
+        'gender': user[4],
+        'preferred_fragrances': fragrances_from_mask(user[5]),
+        'location': location
+    }
+
+
+def _users_from_rows(rows: List[tuple]) -> List[Dict[str, Any]]:
+    # Персональные поля всех строк расшифровываются одной пачкой
+    plain = decrypt_many([row[i] for row in rows for i in _PII_POSITIONS])
+    width = len(_PII_POSITIONS)
+    return [_user_from_row(row, *plain[n * width:(n + 1) * width]) for n, row in enumerate(rows)]
+
+
+def _product_from_row(p) -> Dict[str, Any]:
+    return {'id': p[0], 'name': p[1], 'url': p[2], 'category': p[3], 'description': p[4] or ''}
+
+
 def init_db():
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, 
-                  age TEXT, gender TEXT, preferred_fragrances TEXT, location TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS feedback
-                 (user_id INTEGER, score INTEGER, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS products
-                 (id TEXT PRIMARY KEY, name TEXT, url TEXT, category TEXT, description TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS support_requests
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, message TEXT, photo_id TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS recommendations
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, recommendation TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
+    with write_cursor() as c:
+        c.execute('''CREATE TABLE IF NOT EXISTS users
+                     (id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT,
+                      age TEXT, gender TEXT, preferred_fragrances TEXT, location TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS feedback
+                     (user_id INTEGER, score INTEGER, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS products
+                     (id TEXT PRIMARY KEY, name TEXT, url TEXT, category TEXT, description TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS support_requests
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, message TEXT, photo_id TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS recommendations
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, recommendation TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                      precomputed INTEGER NOT NULL DEFAULT 0, version INTEGER, fingerprint TEXT, expires_at REAL)''')
+        _add_columns(c, 'recommendations', {'precomputed': 'INTEGER NOT NULL DEFAULT 0', 'version': 'INTEGER',
+                                            'fingerprint': 'TEXT', 'expires_at': 'REAL'})
+        # Заранее подготовленные рекомендации: не больше одной на пользователя
+        c.execute("CREATE INDEX IF NOT EXISTS idx_recommendations_precomputed ON recommendations (user_id) WHERE precomputed = 1")
+        c.execute('''CREATE TABLE IF NOT EXISTS llm_cache
+                     (key TEXT PRIMARY KEY, response TEXT, created_at REAL)''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_created_at ON llm_cache (created_at)")
+        c.execute('''CREATE TABLE IF NOT EXISTS broadcasts
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT, admin_chat_id INTEGER, text TEXT, status TEXT,
+                      progress_message_id INTEGER, created_at DATETIME DEFAULT CURRENT_TIMESTAMP, segment TEXT)''')
+        _add_columns(c, 'broadcasts', {'segment': 'TEXT'})
+        c.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries
+                     (broadcast_id INTEGER, user_id INTEGER, status TEXT, error TEXT, updated_at DATETIME,
+                      PRIMARY KEY (broadcast_id, user_id)) WITHOUT ROWID''')
+        _add_columns(c, 'broadcast_deliveries', {'owner': 'TEXT', 'claimed_until': 'REAL'})
+        c.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status ON broadcast_deliveries (broadcast_id, status, user_id)")
+        c.execute('''CREATE TABLE IF NOT EXISTS import_state
+                     (source TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT, imported_at DATETIME)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS product_popularity
+                     (product_id TEXT PRIMARY KEY, score REAL NOT NULL, events REAL NOT NULL) WITHOUT ROWID''')
+        c.execute('''CREATE TABLE IF NOT EXISTS category_popularity
+                     (category TEXT PRIMARY KEY, score REAL NOT NULL, events REAL NOT NULL) WITHOUT ROWID''')
+        _init_popularity(c)
+        c.execute('''CREATE TABLE IF NOT EXISTS popularity_state
+                     (source TEXT PRIMARY KEY, last_event_id INTEGER, updated_at DATETIME)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS shared_state
+                     (key TEXT PRIMARY KEY, value TEXT, expires_at REAL) WITHOUT ROWID''')
+        c.execute('''CREATE TABLE IF NOT EXISTS leases
+                     (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS export_state
+                     (target TEXT PRIMARY KEY, last_day TEXT, next_row INTEGER, updated_at DATETIME)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS job_checkpoints
+                     (job TEXT PRIMARY KEY, last_user_id INTEGER, updated_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS orders
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, product TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+        # Накопленные агрегаты по заказам (data_analysis.py): каждый запуск дочитывает заказы после last_order_id
+        c.execute('''CREATE TABLE IF NOT EXISTS order_product_counts
+                     (product TEXT PRIMARY KEY, orders INTEGER NOT NULL) WITHOUT ROWID''')
+        c.execute('''CREATE TABLE IF NOT EXISTS order_customer_counts
+                     (user_id INTEGER PRIMARY KEY, orders INTEGER NOT NULL) WITHOUT ROWID''')
+        c.execute('''CREATE TABLE IF NOT EXISTS order_customer_products
+                     (user_id INTEGER, product TEXT, PRIMARY KEY (user_id, product)) WITHOUT ROWID''')
+        c.execute('''CREATE TABLE IF NOT EXISTS order_pairs
+                     (product_a TEXT, product_b TEXT, customers INTEGER NOT NULL,
+                      PRIMARY KEY (product_a, product_b)) WITHOUT ROWID''')
+        c.execute('''CREATE TABLE IF NOT EXISTS order_analytics_state
+                     (source TEXT PRIMARY KEY, last_order_id INTEGER, updated_at DATETIME)''')
+        _init_products_fts(c)
+        _init_fragrances(c)
+        _init_segments(c)
+        rehashed = _init_pii(c)
+        _init_stats(c, rebuild=rehashed)
     logging.info("Database initialized")
 
-def add_user(user_id: int, first_name: str, last_name: str):
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO users (id, first_name, last_name) VALUES (?, ?, ?)",
-              (user_id, first_name, last_name))
-    conn.commit()
-    conn.close()
-    logging.info(f"User added/updated: {user_id}")
+def _add_columns(c: sqlite3.Cursor, table: str, columns: Dict[str, str]) -> List[str]:
+    # Миграция существующих баз: CREATE TABLE IF NOT EXISTS не добавляет новые колонки
+    c.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in c.fetchall()}
+    added = []
+    for name, definition in columns.items():
+        if name not in existing:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+            added.append(name)
+    return added
 
-def update_user(user_id: int, field: str, value: Any):
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-    if not c.fetchone():
-        c.execute("INSERT INTO users (id) VALUES (?)", (user_id,))
-        logging.info(f"New user created: {user_id}")
-    if isinstance(value, list):
-        value = json.dumps(value)
-    c.execute(f"UPDATE users SET {field} = ? WHERE id = ?", (value, user_id))
-    conn.commit()
-    conn.close()
-    logging.info(f"User {user_id} updated: {field} = {value}")
+def _init_popularity(c: sqlite3.Cursor):
+    # Популярность хранится как log2 суммы весов (log_score): вес события растёт как
+    # 2 ** (дни / период полураспада) и быстро выходит за пределы float. score — прежняя
+    # линейная сумма, больше не обновляется; при добавлении колонки она переводится в log_score
+    for table in ('product_popularity', 'category_popularity'):
+        if _add_columns(c, table, {'log_score': 'REAL'}):
+            key = 'product_id' if table == 'product_popularity' else 'category'
+            c.execute(f"SELECT {key}, score FROM {table} WHERE score > 0")
+            c.executemany(f"UPDATE {table} SET log_score = ? WHERE {key} = ?",
+                          [(math.log2(score), name) for name, score in c.fetchall()])
+
+def _init_fragrances(c: sqlite3.Cursor):
+    # Предпочтения хранятся дважды: битовая маска users.fragrance_mask (бит = номер
+    # в FRAGRANCE_FAMILIES) для чтения профиля без разбора JSON и таблица user_fragrances
+    # с первичным ключом (fragrance_id, user_id) для выборок «кто любит X».
+    # Таблица ведётся триггерами по маске, маску пишут update_user и save_users.
+    added = _add_columns(c, 'users', {'fragrance_mask': 'INTEGER NOT NULL DEFAULT 0'})
+    c.execute('''CREATE TABLE IF NOT EXISTS fragrance_families
+                 (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)''')
+    c.executemany('''INSERT INTO fragrance_families (id, name) VALUES (?, ?)
+                     ON CONFLICT(id) DO UPDATE SET name = excluded.name''', list(enumerate(FRAGRANCE_FAMILIES)))
+    c.execute('''CREATE TABLE IF NOT EXISTS user_fragrances
+                 (fragrance_id INTEGER, user_id INTEGER, PRIMARY KEY (fragrance_id, user_id)) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_fragrances_user ON user_fragrances (user_id)")
+    for suffix in ('ai', 'ad', 'au'):
+        c.execute(f"DROP TRIGGER IF EXISTS users_fragrances_{suffix}")
+    insert_bits = '''INSERT INTO user_fragrances (fragrance_id, user_id)
+                     SELECT id, new.id FROM fragrance_families WHERE (new.fragrance_mask >> id) & 1;'''
+    c.execute(f'''CREATE TRIGGER users_fragrances_ai AFTER INSERT ON users WHEN new.fragrance_mask != 0 BEGIN
+                      {insert_bits}
+                  END''')
+    c.execute('''CREATE TRIGGER users_fragrances_ad AFTER DELETE ON users BEGIN
+                     DELETE FROM user_fragrances WHERE user_id = old.id;
+                 END''')
+    c.execute(f'''CREATE TRIGGER users_fragrances_au AFTER UPDATE OF fragrance_mask ON users
+                  WHEN old.fragrance_mask IS NOT new.fragrance_mask BEGIN
+                      DELETE FROM user_fragrances WHERE user_id = old.id;
+                      {insert_bits}
+                  END''')
+    if 'fragrance_mask' in added:
+        # Разовый перенос из JSON: маска считается в SQL, user_fragrances заполняет триггер
+        c.execute(f'''UPDATE users SET fragrance_mask = (
+                          SELECT COALESCE(SUM(1 << f.id), 0) FROM fragrance_families f
+                          WHERE f.name IN (SELECT value FROM {_FRAGRANCES.format('users')}))
+                      WHERE preferred_fragrances IS NOT NULL AND preferred_fragrances NOT IN ('', '[]')''')
+        logging.info(f"Fragrance preferences migrated for {c.rowcount} users")
+
+def _init_segments(c: sqlite3.Cursor):
+    # Индексы под условия сегментов (segments.py). Время последней выданной рекомендации
+    # хранится в users и обновляется триггером, чтобы «давно не получали» не требовало
+    # подзапроса к recommendations для каждого пользователя.
+    added = _add_columns(c, 'users', {'last_recommendation_at': 'DATETIME'})
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_gender ON users (gender)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_age ON users (CAST(age AS INTEGER))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_last_recommendation ON users (last_recommendation_at)")
+    c.execute("DROP TRIGGER IF EXISTS recommendations_last_ai")
+    c.execute('''CREATE TRIGGER recommendations_last_ai AFTER INSERT ON recommendations WHEN new.precomputed = 0 BEGIN
+                     UPDATE users SET last_recommendation_at = COALESCE(new.timestamp, CURRENT_TIMESTAMP) WHERE id = new.user_id;
+                 END''')
+    if 'last_recommendation_at' in added:
+        c.execute('''UPDATE users SET last_recommendation_at = (
+                         SELECT MAX(timestamp) FROM recommendations r WHERE r.user_id = users.id AND r.precomputed = 0)''')
+
+def _init_pii(c: sqlite3.Cursor) -> bool:
+    # Город зашифрован, поэтому поиск и статистика по городам идут по слепому индексу
+    # location_hash; location_labels хранит (зашифрованное) название для каждого хэша,
+    # чтобы показать его в статистике. Возвращает True, если хэши посчитаны впервые
+    # и счётчики статистики нужно пересобрать.
+    added = _add_columns(c, 'users', {'location_hash': 'TEXT'})
+    c.execute("DROP INDEX IF EXISTS idx_users_location")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_location_hash ON users (location_hash)")
+    c.execute('''CREATE TABLE IF NOT EXISTS location_labels
+                 (hash TEXT PRIMARY KEY, label TEXT) WITHOUT ROWID''')
+    c.execute("CREATE TABLE IF NOT EXISTS pii_state (name TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+    if 'location_hash' in added:
+        c.execute("UPDATE users SET location_hash = location_hash(location) WHERE location IS NOT NULL")
+        _save_location_key_id(c)
+        return True
+    c.execute("SELECT value FROM pii_state WHERE name = 'location_key'")
+    row = c.fetchone()
+    if row and row[0] != location_key_id():
+        # Хэши посчитаны другим ключом (или без ключа): новые записи с ними не совпадут
+        logging.error("Location hashes were built with a different ENCRYPTION_KEY: "
+                      "run `python security.py migrate` to rebuild them")
+    elif row is None:
+        _save_location_key_id(c)
+    return False
+
+def _save_location_key_id(c: sqlite3.Cursor):
+    c.execute("INSERT OR REPLACE INTO pii_state (name, value) VALUES ('location_key', ?)", (location_key_id(),))
+
+def encrypt_existing_users(chunk_size: int = PII_MIGRATION_CHUNK) -> int:
+    # Миграция при включении шифрования и смене ключа: пользователи читаются порциями по
+    # первичному ключу, значения шифруются текущим ключом (или перешифровываются из прежнего),
+    # location_hash пересчитывается из открытого города, и всё это пишется одной транзакцией
+    # на порцию — прерванный запуск можно повторить. Затем пересобираются счётчики по городам
+    # и подписи городов, которые были посчитаны по старым хэшам.
+    if not encryption_enabled():
+        raise RuntimeError("ENCRYPTION_KEY is not set")
+    last_id, total, failed = 0, 0, 0
+    while True:
+        with write_cursor() as c:
+            c.execute("SELECT id, first_name, last_name, location, location_hash FROM users WHERE id > ? ORDER BY id LIMIT ?",
+                      (last_id, chunk_size))
+            rows = c.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = []
+            for row in rows:
+                try:
+                    values = [reencrypt_value(value) for value in row[1:4]]
+                except ValueError:
+                    # Значение не расшифровывается ни одним ключом: строку не трогаем, чтобы не потерять данные
+                    failed += 1
+                    continue
+                location_hash = location_key(decrypt_value(values[2]))
+                if values != list(row[1:4]) or location_hash != row[4]:
+                    updates.append((*values, location_hash, row[0]))
+            c.executemany("UPDATE users SET first_name = ?, last_name = ?, location = ?, location_hash = ? WHERE id = ?",
+                          updates)
+        total += len(updates)
+        logging.info(f"PII migration: {total} users updated, last id {last_id}")
+    with write_cursor() as c:
+        _rebuild_location_stats(c)
+        if not failed:
+            _save_location_key_id(c)
+    if failed:
+        # Ключ в базе не обновляется: предупреждение при запуске останется до успешной миграции
+        logging.error(f"PII migration: {failed} users could not be decrypted with the configured keys")
+    return total
+
+def get_location_labels(hashes: List[str]) -> Dict[str, str]:
+    if not hashes:
+        return {}
+    with read_cursor() as c:
+        c.execute(f"SELECT hash, label FROM location_labels WHERE hash IN ({', '.join('?' * len(hashes))})", hashes)
+        rows = c.fetchall()
+    return dict(zip([row[0] for row in rows], decrypt_many(row[1] for row in rows)))
+
+def _init_products_fts(c: sqlite3.Cursor):
+    # Полнотекстовый индекс по товарам. Триграммный токенизатор находит подстроки
+    # без учёта регистра, поэтому "цветочн" совпадает и с "Цветочные", и с "цветочный".
+    # Индекс синхронизируется с таблицей products триггерами.
+    global _fts_enabled
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'")
+    exists = c.fetchone() is not None
+    try:
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5
+                     (name, category, description, content='products', content_rowid='rowid', tokenize='trigram')''')
+    except sqlite3.OperationalError as e:
+        logging.warning(f"FTS5 is not available, falling back to LIKE search: {e}")
+        _fts_enabled = False
+        return
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+                     INSERT INTO products_fts (rowid, name, category, description)
+                     VALUES (new.rowid, new.name, new.category, new.description);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+                     INSERT INTO products_fts (products_fts, rowid, name, category, description)
+                     VALUES ('delete', old.rowid, old.name, old.category, old.description);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE ON products BEGIN
+                     INSERT INTO products_fts (products_fts, rowid, name, category, description)
+                     VALUES ('delete', old.rowid, old.name, old.category, old.description);
+                     INSERT INTO products_fts (rowid, name, category, description)
+                     VALUES (new.rowid, new.name, new.category, new.description);
+                 END''')
+    if not exists:
+        c.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+    _fts_enabled = True
 
+# Агрегаты для статистики ведутся триггерами в той же транзакции, что и запись
+# данных, поэтому админ-панель читает готовые числа и не сканирует таблицы.
+# Счётчики: users, users_completed, recommendations, support_requests,
+# feedback_count, feedback_sum и разбивки gender:*, location:*, fragrance:*, rating:*.
+_COMPLETED = "({0}.gender IS NOT NULL AND {0}.location IS NOT NULL AND {0}.preferred_fragrances IS NOT NULL AND {0}.preferred_fragrances NOT IN ('', '[]'))"
+_FRAGRANCES = "json_each(CASE WHEN json_valid({0}.preferred_fragrances) THEN {0}.preferred_fragrances ELSE '[]' END)"
+
+def _bump(name: str, delta: str, source: str = "WHERE 1") -> str:
+    return f"""INSERT INTO stats_counters (name, value) SELECT {name}, {delta} {source}
+               ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;"""
+
+def _bump_daily(day: str, name: str, delta: str) -> str:
+    return f"""INSERT INTO stats_daily (day, name, value) VALUES ({day}, {name}, {delta})
+               ON CONFLICT(day, name) DO UPDATE SET value = value + excluded.value;"""
+
+def _user_stats(row: str, sign: str) -> str:
+    sql = "".join((
+        _bump("'users_completed'", f"{sign}1", f"WHERE {_COMPLETED.format(row)}"),
+        _bump(f"'gender:' || {row}.gender", f"{sign}1", f"WHERE {row}.gender IS NOT NULL"),
+        _bump(f"'location:' || {row}.location_hash", f"{sign}1", f"WHERE {row}.location_hash IS NOT NULL"),
+        _bump("'fragrance:' || value", f"{sign}1", f"FROM (SELECT DISTINCT value FROM {_FRAGRANCES.format(row)}) WHERE 1"),
+    ))
+    if sign == '+':
+        # Не INSERT OR IGNORE: внутри триггера его перекрывает политика конфликтов внешнего upsert
+        sql += f"""INSERT INTO location_labels (hash, label) SELECT {row}.location_hash, {row}.location
+                    WHERE {row}.location_hash IS NOT NULL AND NOT EXISTS (SELECT 1 FROM location_labels WHERE hash = {row}.location_hash);"""
+    return sql
+
+def _event_stats(table: str, row: str, sign: str) -> str:
+    day = f"COALESCE(date({row}.timestamp), date('now'))"
+    if table == 'feedback':
+        sql = (_bump("'feedback_count'", f"{sign}1") + _bump("'feedback_sum'", f"{sign}{row}.score") +
+               _bump(f"'rating:' || {row}.score", f"{sign}1"))
+        if sign == '+':
+            sql += _bump_daily(day, "'feedback_count'", "1") + _bump_daily(day, "'feedback_sum'", f"{row}.score")
+        return sql
+    sql = _bump(f"'{table}'", f"{sign}1")
+    if sign == '+':
+        sql += _bump_daily(day, f"'{table}'", "1")
+    return sql
+
+def _init_stats(c: sqlite3.Cursor, rebuild: bool = False):
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'stats_counters'")
+    exists = c.fetchone() is not None
+    c.execute("CREATE TABLE IF NOT EXISTS stats_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID")
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_daily
+                 (day TEXT, name TEXT, value INTEGER NOT NULL, PRIMARY KEY (day, name)) WITHOUT ROWID''')
+    # Триггеры пересоздаются при каждом запуске, чтобы изменения их определений доходили до существующих баз
+    for table in ('users', 'recommendations', 'support_requests', 'feedback'):
+        for suffix in ('ai', 'ad', 'au'):
+            c.execute(f"DROP TRIGGER IF EXISTS {table}_stats_{suffix}")
+    c.execute(f'''CREATE TRIGGER users_stats_ai AFTER INSERT ON users BEGIN
+                      {_bump("'users'", "1")}
+                      {_bump_daily("date('now')", "'users'", "1")}
+                      {_user_stats('new', '+')}
+                  END''')
+    c.execute(f'''CREATE TRIGGER users_stats_ad AFTER DELETE ON users BEGIN
+                      {_bump("'users'", "-1")}
+                      {_user_stats('old', '-')}
+                  END''')
+    # Шифротекст города меняется при каждой записи, поэтому смену города видно только по хэшу
+    c.execute(f'''CREATE TRIGGER users_stats_au AFTER UPDATE OF gender, preferred_fragrances, location_hash ON users
+                  WHEN old.gender IS NOT new.gender OR old.preferred_fragrances IS NOT new.preferred_fragrances
+                       OR old.location_hash IS NOT new.location_hash BEGIN
+                      {_user_stats('old', '-')}
+                      {_user_stats('new', '+')}
+                  END''')
+    for table in ('recommendations', 'support_requests', 'feedback'):
+        # Заранее подготовленные рекомендации не считаются выданными, пока их не отправили пользователю
+        new_filter, old_filter = ("WHEN new.precomputed = 0", "WHEN old.precomputed = 0") if table == 'recommendations' else ("", "")
+        c.execute(f'''CREATE TRIGGER {table}_stats_ai AFTER INSERT ON {table} {new_filter} BEGIN
+                          {_event_stats(table, 'new', '+')}
+                      END''')
+        c.execute(f'''CREATE TRIGGER {table}_stats_ad AFTER DELETE ON {table} {old_filter} BEGIN
+                          {_event_stats(table, 'old', '-')}
+                      END''')
+    if not exists or rebuild:
+        rebuild_stats(c)
+
+def rebuild_stats(c: sqlite3.Cursor):
+    # Полный пересчёт агрегатов; нужен один раз, когда таблицы статистики появляются в существующей базе
+    c.execute("DELETE FROM stats_counters")
+    c.execute("DELETE FROM stats_daily")
+    c.execute("INSERT INTO stats_counters SELECT 'users', COUNT(*) FROM users")
+    c.execute(f"INSERT INTO stats_counters SELECT 'users_completed', COUNT(*) FROM users WHERE {_COMPLETED.format('users')}")
+    c.execute("INSERT INTO stats_counters SELECT 'gender:' || gender, COUNT(*) FROM users WHERE gender IS NOT NULL GROUP BY gender")
+    _rebuild_location_stats(c)
+    c.execute(f'''INSERT INTO stats_counters SELECT 'fragrance:' || f.value, COUNT(DISTINCT users.id)
+                  FROM users, {_FRAGRANCES.format('users')} AS f GROUP BY f.value''')
+    for table, condition in (('recommendations', 'precomputed = 0'), ('support_requests', '1')):
+        c.execute(f"INSERT INTO stats_counters SELECT '{table}', COUNT(*) FROM {table} WHERE {condition}")
+        c.execute(f"INSERT INTO stats_daily SELECT date(timestamp), '{table}', COUNT(*) FROM {table} WHERE {condition} GROUP BY date(timestamp)")
+    c.execute("INSERT INTO stats_counters SELECT 'feedback_count', COUNT(*) FROM feedback")
+    c.execute("INSERT INTO stats_counters SELECT 'feedback_sum', COALESCE(SUM(score), 0) FROM feedback")
+    c.execute("INSERT INTO stats_counters SELECT 'rating:' || score, COUNT(*) FROM feedback GROUP BY score")
+    c.execute("INSERT INTO stats_daily SELECT date(timestamp), 'feedback_count', COUNT(*) FROM feedback GROUP BY date(timestamp)")
+    c.execute("INSERT INTO stats_daily SELECT date(timestamp), 'feedback_sum', SUM(score) FROM feedback GROUP BY date(timestamp)")
+    logging.info("Statistics counters rebuilt")
+
+def _rebuild_location_stats(c: sqlite3.Cursor):
+    # Разбивка по городам и подписи городов зависят от ключа слепого индекса
+    c.execute("DELETE FROM stats_counters WHERE name LIKE 'location:%'")
+    c.execute("INSERT INTO stats_counters SELECT 'location:' || location_hash, COUNT(*) FROM users WHERE location_hash IS NOT NULL GROUP BY location_hash")
+    c.execute("DELETE FROM location_labels")
+    c.execute("INSERT OR IGNORE INTO location_labels SELECT location_hash, location FROM users WHERE location_hash IS NOT NULL")
+
+def _has_fts() -> bool:
+    global _fts_enabled
+    if _fts_enabled is None:
+        with read_cursor() as c:
+            c.execute("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'")
+            _fts_enabled = c.fetchone() is not None
+    return _fts_enabled
+
+def add_user(user_id: int, first_name: str, last_name: str):
+    first_name, last_name = encrypt_many((first_name, last_name))
+    with write_cursor() as c:
+        c.execute('''INSERT INTO users (id, first_name, last_name) VALUES (?, ?, ?)
+                     ON CONFLICT(id) DO UPDATE SET first_name = excluded.first_name, last_name = excluded.last_name''',
+                  (user_id, first_name, last_name))
+    log_event('user_added', user_id=user_id)
 
 def get_user(user_id: int) -> Dict[str, Any]:
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    user = c.fetchone()
-    conn.close()
+    with read_cursor() as c:
+        c.execute(f"{_USER_SELECT} WHERE id = ?", (user_id,))
+        user = c.fetchone()
     if user:
-        user_dict = {
-            'id': user[0],
-            'first_name': user[1],
-            'last_name': user[2],
-            'age': user[3],
-            'gender': user[4],
-            'preferred_fragrances': json.loads(user[5]) if user[5] else [],
-            'location': user[6]
-        }
-        return user_dict
+        return _users_from_rows([user])[0]
     return None
 
 def update_user(user_id: int, field: str, value: Any):
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-    if not c.fetchone():
-        c.execute("INSERT INTO users (id) VALUES (?)", (user_id,))
-    if isinstance(value, list):
-        value = json.dumps(value)
-    c.execute(f"UPDATE users SET {field} = ? WHERE id = ?", (value, user_id))
-    conn.commit()
-
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-    if not c.fetchone():
-        c.execute("INSERT INTO users (id) VALUES (?)", (user_id,))
-        logging.info(f"New user created: {user_id}")
-    if isinstance(value, list):
-        value = json.dumps(value)
-    c.execute(f"UPDATE users SET {field} = ? WHERE id = ?", (value, user_id))
-    conn.commit()
-    conn.close()
-    logging.info(f"User {user_id} updated: {field} = {value}")
-
-from typing import Dict, Any
-
+    if field not in USER_FIELDS:
+        raise ValueError(f"Unknown user field: {field}")
+    # Шифрование — до захвата блокировки записи
+    location_hash = location_key(value) if field == 'location' else None
+    if field in PII_FIELDS:
+        value = encrypt_many([value])[0] if isinstance(value, str) else value
+    with write_cursor() as c:
+        c.execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (user_id,))
+        if c.rowcount:
+            logging.info(f"New user created: {user_id}")
+        if field == 'preferred_fragrances':
+            c.execute("UPDATE users SET preferred_fragrances = ?, fragrance_mask = ? WHERE id = ?",
+                      (json.dumps(value) if value else None, fragrance_mask(value), user_id))
+        elif field == 'location':
+            c.execute("UPDATE users SET location = ?, location_hash = ? WHERE id = ?", (value, location_hash, user_id))
+        else:
+            c.execute(f"UPDATE users SET {field} = ? WHERE id = ?", (value, user_id))
+    log_event('user_updated', user_id=user_id, field=field)
 
+def save_users(users: List[Dict[str, Any]]):
+    # Пакетная запись профилей целиком (используется кэшем профилей)
+    encrypted = encrypt_many([u.get(field) for u in users for field in PII_FIELDS])
+    rows = []
+    for n, u in enumerate(users):
+        first_name, last_name, location = encrypted[n * 3:n * 3 + 3]
+        rows.append((u['id'], first_name, last_name, u.get('age'), u.get('gender'),
+                     json.dumps(u['preferred_fragrances']) if u.get('preferred_fragrances') else None, location,
+                     fragrance_mask(u.get('preferred_fragrances')), location_key(u.get('location'))))
+    with write_cursor() as c:
+        c.executemany('''INSERT INTO users (id, first_name, last_name, age, gender, preferred_fragrances, location, fragrance_mask, location_hash)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                         ON CONFLICT(id) DO UPDATE SET first_name = excluded.first_name, last_name = excluded.last_name,
+                                                       age = excluded.age, gender = excluded.gender,
+                                                       preferred_fragrances = excluded.preferred_fragrances,
+                                                       location = excluded.location,
+                                                       fragrance_mask = excluded.fragrance_mask,
+                                                       location_hash = excluded.location_hash''', rows)
 
 def get_all_users() -> List[Dict[str, Any]]:
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("SELECT * FROM users")
-    users = c.fetchall()
-    conn.close()
-    return [{
-        'id': user[0],
-        'first_name': user[1],
-        'last_name': user[2],
-        'age': user[3],
-        'gender': user[4],
-        'preferred_fragrances': json.loads(user[5]) if user[5] else [],
-        'location': user[6]
-    } for user in users]
-
-def save_feedback(user_id: int, score: int):
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("INSERT INTO feedback (user_id, score) VALUES (?, ?)", (user_id, score))
-    conn.commit()
-    conn.close()
-
-def get_feedback_stats() -> Dict[str, Any]:
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("SELECT AVG(score) as avg_score, COUNT(*) as total_feedback FROM feedback")
-    result = c.fetchone()
-    conn.close()
-    return {
-        'average_score': result[0],
-        'total_feedback': result[1]
-    }
+    with read_cursor() as c:
+        c.execute(_USER_SELECT)
+        users = c.fetchall()
+    return _users_from_rows(users)
 
-def import_products_from_csv(csv_file_path):
-    if not os.path.exists(csv_file_path):
-        print(f"Error: CSV file not found at {csv_file_path}")
-        return
+def get_user_ids_by_fragrances(fragrances: List[str], match_all: bool = False, after_id: int = 0, limit: int = -1) -> List[int]:
+    # Выборка по индексу user_fragrances: любое из семейств или все сразу
+    ids = [FRAGRANCE_BITS[f] for f in dict.fromkeys(fragrances) if f in FRAGRANCE_BITS]
+    if not ids:
+        return []
+    placeholders = ', '.join('?' * len(ids))
+    with read_cursor() as c:
+        if match_all:
+            c.execute(f'''SELECT user_id FROM user_fragrances WHERE fragrance_id IN ({placeholders}) AND user_id > ?
+                          GROUP BY user_id HAVING COUNT(*) = ? ORDER BY user_id LIMIT ?''', ids + [after_id, len(ids), limit])
+        else:
+            c.execute(f'''SELECT DISTINCT user_id FROM user_fragrances WHERE fragrance_id IN ({placeholders}) AND user_id > ?
+                          ORDER BY user_id LIMIT ?''', ids + [after_id, limit])
+        return [row[0] for row in c.fetchall()]
+
+def count_users_by_fragrance_mask(mask: int, match_all: bool = False) -> int:
+    # Побитовая проверка по целочисленной колонке, без разбора JSON
+    with read_cursor() as c:
+        if match_all:
+            c.execute("SELECT COUNT(*) FROM users WHERE fragrance_mask & ? = ?", (mask, mask))
+        else:
+            c.execute("SELECT COUNT(*) FROM users WHERE fragrance_mask & ? != 0", (mask,))
+        return c.fetchone()[0]
+
+def get_fragrance_counts() -> Dict[str, int]:
+    with read_cursor() as c:
+        c.execute('''SELECT f.name, COUNT(*) FROM user_fragrances u JOIN fragrance_families f ON f.id = u.fragrance_id
+                     GROUP BY u.fragrance_id ORDER BY COUNT(*) DESC''')
+        return dict(c.fetchall())
+
+def on_products_imported(callback: Callable[[], None]):
+    # Подписка на обновление каталога (например, перезагрузка каталога в памяти)
+    _products_listeners.append(callback)
+
+def notify_products_imported():
+    for callback in _products_listeners:
+        try:
+            callback()
+        except Exception as e:
+            logging.error(f"Products import listener failed: {e}")
+
+def get_users_after(after_id: int, limit: int) -> List[Dict[str, Any]]:
+    # Постраничное чтение по первичному ключу: массовые задачи не держат всех пользователей в памяти
+    with read_cursor() as c:
+        c.execute(f"{_USER_SELECT} WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))
+        users = c.fetchall()
+    return _users_from_rows(users)
+
+def count_segment(segment: Optional[Dict[str, Any]]) -> int:
+    where, params = compile_spec(segment)
+    with read_cursor() as c:
+        c.execute(f"SELECT COUNT(*) FROM users WHERE {where}", params)
+        return c.fetchone()[0]
+
+def get_segment_users_after(segment: Optional[Dict[str, Any]], after_id: int, limit: int) -> List[Dict[str, Any]]:
+    # Как get_users_after, но только пользователи сегмента; условия проверяет SQLite по индексам
+    where, params = compile_spec(segment)
+    with read_cursor() as c:
+        c.execute(f"{_USER_SELECT} WHERE {where} AND users.id > ? ORDER BY users.id LIMIT ?", params + [after_id, limit])
+        users = c.fetchall()
+    return _users_from_rows(users)
+
+def get_job_checkpoint(job: str) -> int:
+    with read_cursor() as c:
+        c.execute("SELECT last_user_id FROM job_checkpoints WHERE job = ?", (job,))
+        row = c.fetchone()
+    return row[0] if row else None
+
+def save_job_checkpoint(job: str, last_user_id: int):
+    with write_cursor() as c:
+        c.execute('''INSERT INTO job_checkpoints (job, last_user_id) VALUES (?, ?)
+                     ON CONFLICT(job) DO UPDATE SET last_user_id = excluded.last_user_id,
+                                                    updated_at = CURRENT_TIMESTAMP''', (job, last_user_id))
+
+def clear_job_checkpoint(job: str):
+    with write_cursor() as c:
+        c.execute("DELETE FROM job_checkpoints WHERE job = ?", (job,))
+
+def create_broadcast(admin_chat_id: int, text: str, segment: Optional[Dict[str, Any]] = None) -> int:
+    # Получатели фиксируются одним INSERT ... SELECT, без загрузки списка пользователей в Python
+    where, params = compile_spec(segment)
+    with write_cursor() as c:
+        c.execute("INSERT INTO broadcasts (admin_chat_id, text, status, segment) VALUES (?, ?, 'running', ?)",
+                  (admin_chat_id, text, json.dumps(segment, ensure_ascii=False) if segment else None))
+        broadcast_id = c.lastrowid
+        c.execute(f'''INSERT INTO broadcast_deliveries (broadcast_id, user_id, status)
+                      SELECT ?, id, 'pending' FROM users WHERE {where}''', [broadcast_id] + params)
+    return broadcast_id
 
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    
-    with open(csv_file_path, 'r', encoding='utf-8') as csvfile:
-        csv_reader = csv.reader(csvfile)
-        for row in csv_reader:
-            if len(row) >= 4 and row[3].startswith('https://edp.by/shop/'):
-                c.execute("INSERT OR REPLACE INTO products (id, name, url, category) VALUES (?, ?, ?, ?)",
-                          (row[0], row[4] if len(row) > 4 else '', row[3], row[3].split('/')[4]))
-    
-    conn.commit()
-    conn.close()
-    print("Products imported successfully.")
+def get_broadcast(broadcast_id: int) -> Dict[str, Any]:
+    with read_cursor() as c:
+        c.execute("SELECT id, admin_chat_id, text, status, progress_message_id FROM broadcasts WHERE id = ?", (broadcast_id,))
+        row = c.fetchone()
+    if row:
+        return {'id': row[0], 'admin_chat_id': row[1], 'text': row[2], 'status': row[3], 'progress_message_id': row[4]}
+    return None
+
+def get_unfinished_broadcasts() -> List[int]:
+    with read_cursor() as c:
+        c.execute("SELECT id FROM broadcasts WHERE status = 'running'")
+        return [row[0] for row in c.fetchall()]
+
+def set_broadcast_status(broadcast_id: int, status: str):
+    with write_cursor() as c:
+        c.execute("UPDATE broadcasts SET status = ? WHERE id = ?", (status, broadcast_id))
+
+def pause_broadcast(broadcast_id: int):
+    # Только идущую: нажатие "Пауза", пришедшее после завершения, не должно возвращать рассылку в работу
+    with write_cursor() as c:
+        c.execute("UPDATE broadcasts SET status = 'paused' WHERE id = ? AND status = 'running'", (broadcast_id,))
+
+def set_broadcast_progress_message(broadcast_id: int, message_id: int):
+    with write_cursor() as c:
+        c.execute("UPDATE broadcasts SET progress_message_id = ? WHERE id = ?", (message_id, broadcast_id))
+
+def claim_recipients(broadcast_id: int, owner: str, limit: int, ttl: float) -> List[int]:
+    # Пачка получателей забирается одним UPDATE ... RETURNING: два процесса не получат одних
+    # и тех же, а захват умершего процесса (status = 'sending') истекает через ttl секунд
+    now = time.time()
+    with write_cursor() as c:
+        c.execute('''UPDATE broadcast_deliveries SET status = 'sending', owner = ?, claimed_until = ?
+                     WHERE broadcast_id = ? AND user_id IN (
+                         SELECT user_id FROM broadcast_deliveries
+                         WHERE broadcast_id = ? AND (status = 'pending' OR (status = 'sending' AND claimed_until < ?))
+                         ORDER BY user_id LIMIT ?)
+                     RETURNING user_id''', (owner, now + ttl, broadcast_id, broadcast_id, now, limit))
+        return sorted(row[0] for row in c.fetchall())
+
+def count_outstanding_recipients(broadcast_id: int, owner: str) -> int:
+    # Неотправленные, кроме своих захваченных. Свободные тоже считаются: другой процесс мог вернуть
+    # получателей (release_recipients) между пустым claim_recipients и этим запросом
+    with read_cursor() as c:
+        c.execute('''SELECT COUNT(*) FROM broadcast_deliveries
+                     WHERE broadcast_id = ? AND (status = 'pending' OR (status = 'sending' AND owner != ?))''',
+                  (broadcast_id, owner))
+        return c.fetchone()[0]
+
+def release_recipients(broadcast_id: int, owner: str) -> int:
+    # Захваченные, но не отправленные (пауза, потеря аренды) возвращаются в очередь сразу
+    with write_cursor() as c:
+        c.execute('''UPDATE broadcast_deliveries SET status = 'pending', owner = NULL, claimed_until = NULL
+                     WHERE broadcast_id = ? AND status = 'sending' AND owner = ?''', (broadcast_id, owner))
+        return c.rowcount
+
+def mark_deliveries(broadcast_id: int, results: List[tuple]):
+    # results: (user_id, status, error)
+    with write_cursor() as c:
+        c.executemany('''UPDATE broadcast_deliveries SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+                         WHERE broadcast_id = ? AND user_id = ?''',
+                      [(status, error, broadcast_id, user_id) for user_id, status, error in results])
+
+def get_broadcast_counts(broadcast_id: int) -> Dict[str, int]:
+    with read_cursor() as c:
+        c.execute("SELECT status, COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ? GROUP BY status", (broadcast_id,))
+        counts = dict(c.fetchall())
+    counts['pending'] = counts.get('pending', 0) + counts.pop('sending', 0)
+    return {status: counts.get(status, 0) for status in ('pending', 'sent', 'failed')}
+
+def reset_failed_deliveries(broadcast_id: int) -> int:
+    with write_cursor() as c:
+        c.execute("UPDATE broadcast_deliveries SET status = 'pending', error = NULL WHERE broadcast_id = ? AND status = 'failed'",
+                  (broadcast_id,))
+        return c.rowcount
 
 def get_products_by_category(category: str) -> List[Dict[str, Any]]:
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE category = ?", (category,))
-    products = c.fetchall()
-    conn.close()
+    with read_cursor() as c:
+        c.execute("SELECT * FROM products WHERE category = ?", (category,))
+        products = c.fetchall()
     return [{'id': p[0], 'name': p[1], 'url': p[2], 'category': p[3]} for p in products]
 
 def get_all_products() -> List[Dict[str, Any]]:
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("SELECT * FROM products")
-    products = c.fetchall()
-    conn.close()
+    with read_cursor() as c:
+        c.execute("SELECT * FROM products")
+        products = c.fetchall()
     return [{'id': p[0], 'name': p[1], 'url': p[2], 'category': p[3]} for p in products]
 
 def get_support_requests() -> List[Dict[str, Any]]:
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("SELECT * FROM support_requests ORDER BY timestamp DESC LIMIT 10")
-    requests = c.fetchall()
-    conn.close()
+    with read_cursor() as c:
+        c.execute("SELECT * FROM support_requests ORDER BY timestamp DESC LIMIT 10")
+        requests = c.fetchall()
     return [{'id': r[0], 'user_id': r[1], 'message': r[2], 'photo_id': r[3], 'timestamp': r[4]} for r in requests]
 
 def get_support_request_count() -> int:
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM support_requests")
-    count = c.fetchone()[0]
-    conn.close()
-    return count
+    with read_cursor() as c:
+        c.execute("SELECT COUNT(*) FROM support_requests")
+        return c.fetchone()[0]
 
 def get_recommendation_count() -> int:
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM recommendations")
-    count = c.fetchone()[0]
-    conn.close()
-    return count
+    with read_cursor() as c:
+        c.execute("SELECT COUNT(*) FROM recommendations WHERE precomputed = 0")
+        return c.fetchone()[0]
 
 def add_support_request(user_id: int, message: str, photo_id: str = None):
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("INSERT INTO support_requests (user_id, message, photo_id) VALUES (?, ?, ?)",
-              (user_id, message, photo_id))
-    conn.commit()
-    conn.close()
+    with write_cursor() as c:
+        c.execute("INSERT INTO support_requests (user_id, message, photo_id) VALUES (?, ?, ?)",
+                  (user_id, message, photo_id))
 
 def add_recommendation(user_id: int, recommendation: str):
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("INSERT INTO recommendations (user_id, recommendation) VALUES (?, ?)",
-              (user_id, recommendation))
-    conn.commit()
-    conn.close()
+    with write_cursor() as c:
+        c.execute("INSERT INTO recommendations (user_id, recommendation) VALUES (?, ?)",
+                  (user_id, recommendation))
+
+def save_precomputed_recommendations(rows: List[tuple]):
+    # rows: (user_id, recommendation, version, fingerprint, expires_at); предыдущая заготовка пользователя заменяется
+    with write_cursor() as c:
+        c.executemany("DELETE FROM recommendations WHERE user_id = ? AND precomputed = 1", ((row[0],) for row in rows))
+        c.executemany('''INSERT INTO recommendations (user_id, recommendation, precomputed, version, fingerprint, expires_at)
+                         VALUES (?, ?, 1, ?, ?, ?)''', rows)
+
+def get_precomputed_recommendation(user_id: int) -> Optional[Dict[str, Any]]:
+    with read_cursor() as c:
+        c.execute('''SELECT recommendation, version, fingerprint, expires_at FROM recommendations
+                     WHERE user_id = ? AND precomputed = 1''', (user_id,))
+        row = c.fetchone()
+    if row is None:
+        return None
+    return {'recommendation': row[0], 'version': row[1], 'fingerprint': row[2], 'expires_at': row[3]}
+
+def get_precomputed_states(user_ids: List[int]) -> Dict[int, tuple]:
+    # (version, fingerprint, expires_at) для пачки пользователей одним запросом
+    if not user_ids:
+        return {}
+    with read_cursor() as c:
+        c.execute(f'''SELECT user_id, version, fingerprint, expires_at FROM recommendations
+                      WHERE precomputed = 1 AND user_id IN ({', '.join('?' * len(user_ids))})''', user_ids)
+        return {row[0]: row[1:] for row in c.fetchall()}
+
+def _fts_phrase(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+def _search_products_fts(c: sqlite3.Cursor, gender: str, fragrances: List[str], limit: int) -> List[tuple]:
+    terms = []
+    for fragrance in fragrances:
+        terms.extend(search_terms(fragrance))
+    phrases = [_fts_phrase(t) for t in dict.fromkeys(terms) if len(t) >= 3]
+    category = GENDER_CATEGORIES.get((gender or '').lower())
+    if category:
+        # Пол учитывается в ранжировании, но не обязателен для совпадения
+        phrases.append(f"category : {_fts_phrase(category)}")
+    if not phrases:
+        return []
+    # Берём несколько лучших по bm25 кандидатов и перемешиваем их, чтобы
+    # рекомендации не повторялись слово в слово.
+    c.execute('''SELECT p.id, p.name, p.url, p.category, p.description FROM products_fts
+                 JOIN products p ON p.rowid = products_fts.rowid
+                 WHERE products_fts MATCH ?
+                 ORDER BY rank
+                 LIMIT ?''', (" OR ".join(phrases), limit * 4))
+    candidates = c.fetchall()
+    picked = sorted(random.sample(range(len(candidates)), min(limit, len(candidates))))
+    return [candidates[i] for i in picked]
 
 def get_products_by_preferences(gender: str, fragrances: List[str], limit: int = 5) -> List[Dict[str, Any]]:
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    
+    if _has_fts():
+        with read_cursor() as c:
+            products = _search_products_fts(c, gender, fragrances, limit)
+            if not products:
+                # Случайный срез каталога без сортировки всей таблицы
+                c.execute("SELECT * FROM products LIMIT ? OFFSET ABS(RANDOM()) % MAX((SELECT COUNT(*) FROM products) - ?, 1)",
+                          (limit, limit))
+                products = c.fetchall()
+        result = [_product_from_row(p) for p in products]
+        log_event('products_found', gender=gender, fragrances=len(fragrances), count=len(result))
+        return result
+    return _get_products_by_like(gender, fragrances, limit)
+
+def _get_products_by_like(gender: str, fragrances: List[str], limit: int = 5) -> List[Dict[str, Any]]:
     # Создаем более гибкое условие для поиска
     fragrance_condition = " OR ".join(["name LIKE ? OR category LIKE ? OR description LIKE ?"] * len(fragrances))
     params = []
     for fragrance in fragrances:
         params.extend([f"%{fragrance}%", f"%{fragrance}%", f"%{fragrance}%"])
-    
+
     # Добавляем поиск по полу, но делаем его необязательным
     gender_condition = "OR (name LIKE ? OR category LIKE ? OR description LIKE ?)"
     params.extend([f"%{gender}%", f"%{gender}%", f"%{gender}%"])
-    
+
     query = f"""
-        SELECT * FROM products 
+        SELECT * FROM products
         WHERE ({fragrance_condition}) {gender_condition}
         ORDER BY RANDOM()
         LIMIT ?
     """
-    c.execute(query, params + [limit])
-    
-    products = c.fetchall()
-    
-    # Если продукты не найдены, выбираем случайные продукты
-    if not products:
-        c.execute("SELECT * FROM products ORDER BY RANDOM() LIMIT ?", [limit])
+    with read_cursor() as c:
+        c.execute(query, params + [limit])
         products = c.fetchall()
-    
-    conn.close()
-    
-    result = [{'id': p[0], 'name': p[1], 'url': p[2], 'category': p[3], 'description': p[4] if len(p) > 4 else ''} for p in products]
-    logging.info(f"Products found: {result}")
+
+        # Если продукты не найдены, выбираем случайные продукты
+        if not products:
+            c.execute("SELECT * FROM products ORDER BY RANDOM() LIMIT ?", [limit])
+            products = c.fetchall()
+
+    result = [_product_from_row(p) for p in products]
+    log_event('products_found', gender=gender, fragrances=len(fragrances), count=len(result), search='like')
     return result
+
+
+# Неблокирующие версии для обработчиков aiogram: запросы выполняются в пуле потоков,
+# а не в цикле событий.
+
+async def aadd_user(user_id: int, first_name: str, last_name: str):
+    await run_db(add_user, user_id, first_name, last_name)
+
+async def aget_user(user_id: int) -> Dict[str, Any]:
+    return await run_db(get_user, user_id)
+
+async def aupdate_user(user_id: int, field: str, value: Any):
+    await run_db(update_user, user_id, field, value)
+
+async def asave_users(users: List[Dict[str, Any]]):
+    await run_db(save_users, users)
+
+async def aget_all_users() -> List[Dict[str, Any]]:
+    return await run_db(get_all_users)
+
+async def aget_user_ids_by_fragrances(fragrances: List[str], match_all: bool = False, after_id: int = 0, limit: int = -1) -> List[int]:
+    return await run_db(get_user_ids_by_fragrances, fragrances, match_all, after_id, limit)
+
+async def acount_segment(segment: Optional[Dict[str, Any]]) -> int:
+    return await run_db(count_segment, segment)
+
+async def aget_fragrance_counts() -> Dict[str, int]:
+    return await run_db(get_fragrance_counts)
+
+async def aget_products_by_preferences(gender: str, fragrances: List[str], limit: int = 5) -> List[Dict[str, Any]]:
+    return await run_db(get_products_by_preferences, gender, fragrances, limit)
+
+async def aget_support_requests() -> List[Dict[str, Any]]:
+    return await run_db(get_support_requests)
+
+async def aget_support_request_count() -> int:
+    return await run_db(get_support_request_count)
+
+async def aget_recommendation_count() -> int:
+    return await run_db(get_recommendation_count)
+
+async def aadd_support_request(user_id: int, message: str, photo_id: str = None):
+    await run_db(add_support_request, user_id, message, photo_id)
+
+async def aadd_recommendation(user_id: int, recommendation: str):
+    await run_db(add_recommendation, user_id, recommendation)
+
+async def aget_precomputed_recommendation(user_id: int) -> Optional[Dict[str, Any]]:
+    return await run_db(get_precomputed_recommendation, user_id)
+
+async def asave_precomputed_recommendations(rows: List[tuple]):
+    await run_db(save_precomputed_recommendations, rows)
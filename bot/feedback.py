@@ -1,22 +1,22 @@
-import sqlite3
 from typing import Dict, Any
-from config import DATABASE_URL
+from database import write_cursor, run_db
+from stats import get_counters
 
-def save_feedback(user_id: str, score: int):
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("INSERT INTO feedback (user_id, score) VALUES (?, ?)", (user_id, score))
-    conn.commit()
-    conn.close()
+def save_feedback(user_id: int, score: int):
+    with write_cursor() as c:
+        c.execute("INSERT INTO feedback (user_id, score) VALUES (?, ?)", (user_id, score))
 
 def get_feedback_stats() -> Dict[str, Any]:
-    conn = sqlite3.connect(DATABASE_URL)
-    c = conn.cursor()
-    c.execute("SELECT AVG(score) as avg_score, COUNT(*) as total_feedback FROM feedback")
-    result = c.fetchone()
-    conn.close()
+    # Сумма и количество оценок ведутся триггерами, среднее считается без прохода по таблице
+    counters = get_counters(('feedback_sum', 'feedback_count'))
+    total = counters['feedback_count']
     return {
-        'average_score': result[0],
-        'total_feedback': result[1]
+        'average_score': counters['feedback_sum'] / total if total else None,
+        'total_feedback': total
     }
 
+async def asave_feedback(user_id: int, score: int):
+    await run_db(save_feedback, user_id, score)
+
+async def aget_feedback_stats() -> Dict[str, Any]:
+    return await run_db(get_feedback_stats)
@@ -0,0 +1,81 @@
+import re
+from functools import lru_cache
+from typing import List, Iterable, Tuple
+
+# Семейства ароматов по страницам клавиатуры опроса
+FRAGRANCES = [
+    ["Цветочные", "Древесные", "Цитрусовые", "Восточные", "Фужерные"],
+    ["Шипровые", "Кожаные", "Гурманские", "Акватические", "Зеленые"],
+    ["Пряные", "Фруктовые", "Альдегидные", "Мускусные", "Табачные"]
+]
+FRAGRANCE_FAMILIES = [fragrance for page in FRAGRANCES for fragrance in page]
+# Номер семейства = номер бита в users.fragrance_mask и fragrance_id в user_fragrances;
+# новые семейства добавляются только в конец списка
+FRAGRANCE_BITS = {fragrance: bit for bit, fragrance in enumerate(FRAGRANCE_FAMILIES)}
+
+def fragrance_mask(fragrances: Iterable[str]) -> int:
+    mask = 0
+    for fragrance in fragrances or ():
+        bit = FRAGRANCE_BITS.get(fragrance)
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+
+@lru_cache(maxsize=None)
+def _families(mask: int) -> Tuple[str, ...]:
+    return tuple(fragrance for bit, fragrance in enumerate(FRAGRANCE_FAMILIES) if mask >> bit & 1)
+
+
+def fragrances_from_mask(mask: int) -> List[str]:
+    # Разных масок не больше 2^15, поэтому разбор кэшируется целиком
+    return list(_families(mask or 0))
+
+
+# Ключевые слова для семейств ароматов: названия товаров в каталоге edp.by
+# в основном латиницей, поэтому русское название семейства дополняется
+# типичными словами из названий парфюмов.
+FRAGRANCE_KEYWORDS = {
+    "Цветочные": ["цветочн", "flor", "fleur", "flower", "rose", "jasmin", "peony", "iris", "bloom"],
+    "Древесные": ["древесн", "wood", "bois", "cedar", "santal", "sandal", "vetiver", "oud"],
+    "Цитрусовые": ["цитрус", "citr", "agrum", "lemon", "limon", "orange", "bergamot", "neroli", "mandarin"],
+    "Восточные": ["восточн", "orient", "amber", "ambre", "incense", "encens", "myrrh", "opium"],
+    "Фужерные": ["фужерн", "fougere", "fern", "lavender", "lavande", "barbershop"],
+    "Шипровые": ["шипров", "chypre", "patchouli", "mousse", "moss"],
+    "Кожаные": ["кожан", "leather", "cuir", "suede", "daim"],
+    "Гурманские": ["гурман", "gourmand", "vanil", "caramel", "cacao", "chocolate", "coffee", "praline", "honey"],
+    "Акватические": ["акватическ", "aqua", "acqua", "marine", "ocean", "sea", "eau fraiche"],
+    "Зеленые": ["зелен", "green", "vert", "verde", "grass", "herb", "tea"],
+    "Пряные": ["прян", "spic", "epice", "pepper", "poivre", "cardamom", "cinnamon", "saffron", "ginger"],
+    "Фруктовые": ["фруктов", "fruit", "peach", "pear", "cherry", "berry", "apple", "mango", "fig"],
+    "Альдегидные": ["альдегидн", "aldehyde", "aldehyd", "no 5", "no.5", "white"],
+    "Мускусные": ["мускусн", "musk", "musc", "muschio", "skin"],
+    "Табачные": ["табачн", "tobacco", "tabac", "tabacco", "cigar", "smoke"],
+}
+
+# Пол пользователя -> раздел каталога edp.by
+GENDER_CATEGORIES = {
+    "мужской": "mens-perfumes",
+    "женский": "womens-fragrances",
+    "другой": "unisex-fragrances",
+}
+
+_RU_ENDINGS = sorted([
+    "ыми", "ими", "ого", "его", "ому", "ему",
+    "ые", "ие", "ый", "ий", "ой", "ая", "яя", "ое", "ее", "ую", "юю", "ых", "их", "ым", "им",
+    "ы", "и", "а", "я", "о", "е", "у", "ю",
+], key=len, reverse=True)
+
+
+def stem(word: str) -> str:
+    # Лёгкий стеммер для прилагательных: "Цветочные" и "цветочный" -> "цветочн".
+    word = word.lower().strip()
+    if re.fullmatch(r"[а-яё-]+", word):
+        for ending in _RU_ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 3:
+                return word[:-len(ending)]
+    return word
+
+
+def search_terms(fragrance: str) -> List[str]:
+    return [stem(fragrance)] + FRAGRANCE_KEYWORDS.get(fragrance, [])
@@ -1,17 +1,168 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Callable, Optional, Tuple
 import gspread
+from gspread.exceptions import APIError, WorksheetNotFound
 from oauth2client.service_account import ServiceAccountCredentials
-from typing import Dict, Any
+from requests.exceptions import RequestException
 from config import GOOGLE_SHEETS_CREDENTIALS, GOOGLE_SHEETS_ID
+from database import read_cursor, write_cursor
+from stats import get_counters, get_daily_between, get_breakdown, get_rating_histogram
 
-def update_google_sheets(data: Dict[str, Any]):
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_SHEETS_CREDENTIALS, scope)
-    client = gspread.authorize(creds)
+SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+DAILY_SHEET = "По дням"
+FRAGRANCES_SHEET = "Ароматы"
+DAILY_HEADER = ['Дата', 'Новые пользователи', 'Рекомендации', 'Обращения', 'Оценок', 'Средняя оценка']
+FRAGRANCES_HEADER = ['Дата', 'Аромат', 'Пользователей']
+TOP_FRAGRANCES = 10
+NEW_SHEET_ROWS = 1000
+MAX_ATTEMPTS = 5
+RETRY_STATUSES = {401, 429, 500, 502, 503, 504}
 
-    sheet = client.open_by_key(GOOGLE_SHEETS_ID).sheet1
-    
-    # Обновляем данные в Google Sheets
-    sheet.update('A1', [['Метрика', 'Значение']])
-    sheet.update('A2', [['Средняя оценка', data['average_score']]])
-    sheet.update('A3', [['Всего отзывов', data['total_feedback']]])
 
+def _default_client() -> gspread.Client:
+    creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_SHEETS_CREDENTIALS, SCOPE)
+    return gspread.authorize(creds)
+
+
+def _get_export_state(target: str) -> Tuple[Optional[str], int]:
+    with read_cursor() as c:
+        c.execute("SELECT last_day, next_row FROM export_state WHERE target = ?", (target,))
+        row = c.fetchone()
+    return row if row else (None, 1)
+
+
+def _save_export_state(c, target: str, last_day: str, next_row: int):
+    c.execute('''INSERT INTO export_state (target, last_day, next_row, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                 ON CONFLICT(target) DO UPDATE SET last_day = excluded.last_day, next_row = excluded.next_row,
+                                                   updated_at = excluded.updated_at''',
+              (target, last_day, next_row))
+
+
+def _a1(title: str, row: int) -> str:
+    return "'" + title.replace("'", "''") + f"'!A{row}"
+
+
+class SheetsExporter:
+    # Выгрузка аналитики одним запросом values:batchUpdate. Клиент авторизуется один раз
+    # и переиспользуется; строки по дням дописываются с позиции, сохранённой в export_state,
+    # поэтому повтор после сбоя перезаписывает те же ячейки, а не дублирует их.
+    def __init__(self, client_factory: Callable[[], Any] = _default_client, spreadsheet_id: str = GOOGLE_SHEETS_ID,
+                 max_attempts: int = MAX_ATTEMPTS, backoff: float = 1.0):
+        self.client_factory = client_factory
+        self.spreadsheet_id = spreadsheet_id
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._spreadsheet = None
+        self._worksheets: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _reset(self):
+        self._spreadsheet = None
+        self._worksheets.clear()
+
+    def _open(self):
+        if self._spreadsheet is None:
+            self._spreadsheet = self.client_factory().open_by_key(self.spreadsheet_id)
+        return self._spreadsheet
+
+    def _worksheet(self, title: Optional[str], cols: int = 2):
+        worksheet = self._worksheets.get(title)
+        if worksheet is None:
+            spreadsheet = self._open()
+            if title is None:
+                worksheet = spreadsheet.sheet1
+            else:
+                try:
+                    worksheet = spreadsheet.worksheet(title)
+                except WorksheetNotFound:
+                    worksheet = spreadsheet.add_worksheet(title, rows=NEW_SHEET_ROWS, cols=cols)
+            self._worksheets[title] = worksheet
+        return worksheet
+
+    def _append(self, data: List[Dict[str, Any]], title: str, header: List[str], start: int, rows: List[list]) -> int:
+        if start == 1:
+            rows = [header] + rows
+        if not rows:
+            return start
+        worksheet = self._worksheet(title, len(header))
+        end = start + len(rows) - 1
+        if worksheet.row_count < end:
+            worksheet.add_rows(end - worksheet.row_count + NEW_SHEET_ROWS)
+        data.append({'range': _a1(worksheet.title, start), 'values': rows})
+        return end + 1
+
+    def _summary(self) -> List[list]:
+        counters = get_counters()
+        feedback_count = counters['feedback_count']
+        rows = [['Метрика', 'Значение'],
+                ['Средняя оценка', round(counters['feedback_sum'] / feedback_count, 2) if feedback_count else ''],
+                ['Всего отзывов', feedback_count],
+                ['Всего пользователей', counters['users']],
+                ['Заполнили профиль', counters['users_completed']],
+                ['Всего рекомендаций', counters['recommendations']],
+                ['Обращений в поддержку', counters['support_requests']]]
+        rows += [[f"Оценка {score}", count] for score, count in get_rating_histogram().items()]
+        return rows
+
+    def _export(self) -> Dict[str, int]:
+        today = datetime.now(timezone.utc).date()
+        yesterday = (today - timedelta(days=1)).isoformat()
+        data = [{'range': _a1(self._worksheet(None).title, 1), 'values': self._summary()}]
+
+        # По дням выгружаются только завершённые сутки: такие строки больше не меняются
+        daily_day, daily_row = _get_export_state('daily')
+        first_day = (datetime.fromisoformat(daily_day).date() + timedelta(days=1)).isoformat() if daily_day else '0000-00-00'
+        daily = get_daily_between(first_day, yesterday)
+        daily_rows = [[d['day'], d.get('users', 0), d.get('recommendations', 0), d.get('support_requests', 0),
+                       d.get('feedback_count', 0),
+                       round(d['feedback_sum'] / d['feedback_count'], 2) if d.get('feedback_count') else '']
+                      for d in daily]
+        daily_next = self._append(data, DAILY_SHEET, DAILY_HEADER, daily_row, daily_rows)
+
+        # Снимок популярных ароматов — не чаще раза в сутки
+        fragrances_day, fragrances_row = _get_export_state('fragrances')
+        fragrance_rows = []
+        if fragrances_day != today.isoformat():
+            fragrance_rows = [[today.isoformat(), name, count]
+                              for name, count in get_breakdown('fragrance', limit=TOP_FRAGRANCES).items()]
+        fragrances_next = self._append(data, FRAGRANCES_SHEET, FRAGRANCES_HEADER, fragrances_row, fragrance_rows)
+
+        self._open().values_batch_update({'valueInputOption': 'USER_ENTERED', 'data': data})
+
+        # Запись в таблицу и сохранение состояния не атомарны: если процесс упадёт между ними,
+        # следующий запуск запишет те же строки ещё раз. Повтор безопасен только потому, что строки
+        # пишутся по номеру (next_row не изменился), а не добавляются в конец листа.
+        # last_day — последний выгруженный завершённый день; вчерашние сутки выгружены целиком,
+        # даже если за них не было строк, поэтому отметка всегда равна yesterday и не бывает NULL
+        with write_cursor() as c:
+            _save_export_state(c, 'daily', yesterday, daily_next)
+            _save_export_state(c, 'fragrances', today.isoformat(), fragrances_next)
+        return {'daily': len(daily_rows), 'fragrances': len(fragrance_rows)}
+
+    def export(self) -> Dict[str, int]:
+        with self._lock:
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    result = self._export()
+                    logging.info(f"Google Sheets export finished: {result}")
+                    return result
+                except (APIError, RequestException, ConnectionError, TimeoutError) as e:
+                    if isinstance(e, APIError) and e.code not in RETRY_STATUSES or attempt == self.max_attempts:
+                        raise
+                    if isinstance(e, APIError) and e.code == 401:
+                        self._reset()
+                    delay = self.backoff * 2 ** (attempt - 1) * (1 + random.random() / 2)
+                    logging.warning(f"Google Sheets export failed (attempt {attempt}), retrying in {delay:.1f}s: {e}")
+                    time.sleep(delay)
+
+    async def aexport(self) -> Dict[str, int]:
+        # gspread синхронный — выполняем в отдельном потоке, чтобы не блокировать бота
+        return await asyncio.to_thread(self.export)
+
+
+exporter = SheetsExporter()
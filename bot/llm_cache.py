@@ -0,0 +1,158 @@
+import time
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Callable, Awaitable, AsyncIterator, Tuple
+from config import LLM_CACHE_SIZE, LLM_CACHE_TTL, LLM_CACHE_PERSISTENT
+from database import read_cursor, write_cursor, run_db
+
+
+def make_key(kind: str, model: str, gender: str, fragrances: List[str],
+             product_ids: List[str] = (), user_message: str = "") -> str:
+    message = " ".join((user_message or "").lower().split())
+    payload = {
+        'kind': kind,
+        'model': model,
+        'gender': (gender or "").strip().lower(),
+        'fragrances': sorted(f.strip().lower() for f in fragrances),
+        'products': sorted(str(p) for p in product_ids),
+        'message': hashlib.sha256(message.encode()).hexdigest() if message else "",
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+
+def _load_persisted(key: str, ttl: float) -> Optional[Tuple[float, str]]:
+    with read_cursor() as c:
+        c.execute("SELECT created_at, response FROM llm_cache WHERE key = ? AND created_at > ?",
+                  (key, time.time() - ttl))
+        return c.fetchone()
+
+
+def _persist(key: str, created_at: float, response: str):
+    with write_cursor() as c:
+        c.execute("INSERT OR REPLACE INTO llm_cache (key, response, created_at) VALUES (?, ?, ?)",
+                  (key, response, created_at))
+        c.execute("DELETE FROM llm_cache WHERE created_at < ?", (created_at - LLM_CACHE_TTL,))
+
+
+class LeaderCancelled(Exception):
+    # Отдаётся ожидающим вместо CancelledError: отмена чужого обработчика не должна отменять их
+    pass
+
+
+class ResponseCache:
+    def __init__(self, max_size: int = LLM_CACHE_SIZE, ttl: float = LLM_CACHE_TTL, persistent: bool = LLM_CACHE_PERSISTENT):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persistent = persistent
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        created_at, value = entry
+        if time.time() - created_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str, created_at: float = None):
+        self._entries[key] = (created_at or time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_or_create(self, key: str, factory: Callable[[], Awaitable[str]]) -> str:
+        async def produce() -> AsyncIterator[str]:
+            yield await factory()
+        return "".join([chunk async for chunk in self.stream(key, produce)])
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        # Потоковый вариант: ответ из кэша отдаётся одним куском, новый — по мере генерации
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            yield value
+            return
+
+        # Одинаковые одновременные запросы ждут один вызов к API
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            try:
+                value = await asyncio.shield(inflight)
+            except LeaderCancelled:
+                # Запрос-лидер отменили (например, вместе с обработчиком его пользователя) — повторяем сами
+                async for chunk in self.stream(key, factory):
+                    yield chunk
+                return
+            yield value
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await self._load_persisted(key)
+            if value is None:
+                self.misses += 1
+                parts = []
+                async for chunk in factory():
+                    parts.append(chunk)
+                    yield chunk
+                value = "".join(parts)
+                await self._store(key, value)
+            else:
+                yield value
+            future.set_result(value)
+        except (asyncio.CancelledError, GeneratorExit):
+            future.set_exception(LeaderCancelled(key))
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Ошибка передаётся ожидающим; помечаем её прочитанной, если их нет
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _load_persisted(self, key: str) -> Optional[str]:
+        if not self.persistent:
+            return None
+        row = await run_db(_load_persisted, key, self.ttl)
+        if not row:
+            return None
+        self.hits += 1
+        self.set(key, row[1], row[0])
+        return row[1]
+
+    async def _store(self, key: str, value: str):
+        created_at = time.time()
+        self.set(key, value, created_at)
+        if self.persistent:
+            try:
+                await run_db(_persist, key, created_at, value)
+            except Exception as e:
+                logging.error(f"Failed to persist LLM cache entry: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'inflight': len(self._inflight),
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+response_cache = ResponseCache()
@@ -1,29 +1,55 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
+import gc
 import asyncio
+from datetime import datetime, timedelta
 import logging
-from aiogram import Bot, Dispatcher, types
+from typing import List
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.filters import StateFilter
 from aiogram.filters.command import Command
-from aiogram.types import InlineKeyboardButton, CallbackQuery
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.types import CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramBadRequest
-from config import TELEGRAM_TOKEN, ADMIN_USER_IDS
-from database import init_db, add_user, get_user, update_user, get_all_users, import_products_from_csv, get_feedback_stats, add_support_request, add_recommendation
-from ai_helper import generate_recommendation
-from feedback import save_feedback
-from google_sheets import update_google_sheets
-from admin import handle_admin_command, get_bot_statistics, get_support_requests_list
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from config import TELEGRAM_TOKEN, ADMIN_USER_IDS, STREAM_EDIT_INTERVAL, PRECOMPUTE_HOUR
+from database import init_db, aadd_recommendation, run_db, close_connections, db_queue_depth
+from profile_cache import profiles
+from ai_helper import stream_recommendation, is_recordable, get_client
+from fragrances import FRAGRANCES, FRAGRANCE_FAMILIES
+from catalog import catalog
+from product_import import import_products_from_csv
+from recommendation_job import run_recommendation_job, run_precompute_job, resume_pending_job
+import recommendation_store
+from feedback import asave_feedback
+from admin import handle_admin_command, get_bot_statistics, get_support_requests_list, ask_broadcast_text, ask_broadcast_segment, handle_broadcast_segment, handle_broadcast_control, BroadcastStates
+from broadcast import engine as broadcast_engine
+from shared_state import backend as state_backend, create_fsm_storage
+import metrics
+import security
+from llm_cache import response_cache
+from callbacks import MenuCallback, GenderCallback, FragranceCallback, LocationCallback, FeedbackCallback, AdminCallback, BroadcastCallback
 
 logging.basicConfig(level=logging.INFO)
 
+# Google Sheets (gspread, oauth2client) и аналитика заказов (pandas) нужны раз в сутки,
+# поэтому импортируются при первом вызове, а не при запуске
+startup = metrics.StartupTimer(_IMPORT_STARTED)
+startup.record('imports', time.perf_counter() - _IMPORT_STARTED)
+
 BOT_ID = None
 
 bot = Bot(token=TELEGRAM_TOKEN)
-dp = Dispatcher()
+dp = Dispatcher(storage=create_fsm_storage(state_backend))
+dp.message.middleware(metrics.HandlerMetricsMiddleware())
+dp.callback_query.middleware(metrics.HandlerMetricsMiddleware())
+
+metrics.registry.gauge('bot_db_queue_depth', "Запросы к БД в ожидании потока", func=db_queue_depth)
+metrics.registry.gauge('bot_profile_cache_dirty', "Несохранённые профили", func=lambda: profiles.dirty_count)
+metrics.registry.gauge('bot_llm_inflight', "Запросы к модели в работе", func=lambda: response_cache.stats()['inflight'])
+metrics.registry.gauge('bot_broadcasts_running', "Идущие рассылки", func=lambda: broadcast_engine.running_count)
 
-FRAGRANCES = [
-    ["Цветочные", "Древесные", "Цитрусовые", "Восточные", "Фужерные"],
-    ["Шипровые", "Кожаные", "Гурманские", "Акватические", "Зеленые"],
-    ["Пряные", "Фруктовые", "Альдегидные", "Мускусные", "Табачные"]
-]
 LOCATIONS = [
     ["Москва", "Санкт-Петербург", "Новосибирск", "Екатеринбург", "Казань"],
     ["Нижний Новгород", "Челябинск", "Самара", "Омск", "Ростов-на-Дону"],
@@ -31,22 +57,31 @@ LOCATIONS = [
 ]
 
 
+class SurveyStates(StatesGroup):
+    age = State()
+    gender = State()
+    fragrances = State()
+    location = State()
+    custom_location = State()
+
+
 @dp.message(Command("start"))
-async def start(message: types.Message):
+async def start(message: types.Message, state: FSMContext):
+    await state.clear()
     user = message.from_user
-    user_data = get_user(user.id)
+    user_data = await profiles.get(user.id)
     if not user_data:
-        add_user(user.id, user.first_name, user.last_name)
+        await profiles.add_user(user.id, user.first_name, user.last_name)
         logging.info(f"New user added: {user.id}")
     else:
-        logging.info(f"Existing user: {user.id}")
+        metrics.log_event('user_returned', user_id=user.id)
 
     keyboard = InlineKeyboardBuilder()
-    keyboard.add(InlineKeyboardButton(text="Получить рекомендацию", callback_data="get_recommendation"))
-    keyboard.add(InlineKeyboardButton(text="Обновить предпочтения", callback_data="update_preferences"))
+    keyboard.button(text="Получить рекомендацию", callback_data=MenuCallback(action="recommend"))
+    keyboard.button(text="Обновить предпочтения", callback_data=MenuCallback(action="survey"))
     
     if str(user.id) in ADMIN_USER_IDS:
-        keyboard.add(InlineKeyboardButton(text="Админ-панель", callback_data="admin_panel"))
+        keyboard.button(text="Админ-панель", callback_data=MenuCallback(action="admin"))
     
     keyboard.adjust(1)
 
@@ -55,35 +90,65 @@ async def start(message: types.Message):
         reply_markup=keyboard.as_markup()
     )
 
-@dp.callback_query(lambda c: c.data == "get_recommendation")
-async def get_recommendation_callback(callback_query: CallbackQuery):
-    user_data = get_user(callback_query.from_user.id)
+@dp.message(Command("admin"))
+async def admin_command(message: types.Message):
+    if str(message.from_user.id) in ADMIN_USER_IDS:
+        await handle_admin_command(message)
+    else:
+        await message.reply("У вас нет доступа к админ-панели.")
+
+@dp.message(BroadcastStates.waiting_text)
+async def broadcast_text(message: types.Message, state: FSMContext):
+    if str(message.from_user.id) not in ADMIN_USER_IDS or not message.text:
+        await state.clear()
+        return
+    await ask_broadcast_segment(message, state)
+
+@dp.message(BroadcastStates.waiting_segment)
+async def broadcast_segment(message: types.Message, state: FSMContext):
+    if str(message.from_user.id) not in ADMIN_USER_IDS or not message.text:
+        await state.clear()
+        return
+    await handle_broadcast_segment(bot, message, state)
+
+@dp.callback_query(MenuCallback.filter(F.action == "recommend"))
+async def get_recommendation_callback(callback_query: CallbackQuery, state: FSMContext):
+    user_data = await profiles.get(callback_query.from_user.id)
     if not user_data or not user_data.get('gender') or not user_data.get('preferred_fragrances'):
         await callback_query.message.answer("Для получения рекомендации нужно указать пол и предпочитаемые ароматы. Пожалуйста, обновите ваши предпочтения.")
-        await update_preferences_callback(callback_query)
+        await start_survey(callback_query.message, state)
     else:
-        await callback_query.message.answer("Генерирую рекомендацию, это может занять несколько секунд...")
-        recommendation = await generate_recommendation(user_data)
-        await callback_query.message.answer(recommendation)
+        # Сначала — рекомендация, подготовленная ночью; модель вызывается только при промахе
+        stored = await recommendation_store.get_fresh(user_data)
+        if stored:
+            await callback_query.message.answer(stored)
+            await aadd_recommendation(callback_query.from_user.id, stored)
+        else:
+            placeholder = await callback_query.message.answer("Генерирую рекомендацию, это может занять несколько секунд...")
+            await stream_recommendation_to(placeholder, callback_query.from_user.id, user_data)
         await ask_feedback(callback_query.message)
     await callback_query.answer()
 
-@dp.callback_query(lambda c: c.data == "update_preferences")
-async def update_preferences_callback(callback_query: CallbackQuery):
-    await ask_age(callback_query.message)
+@dp.callback_query(MenuCallback.filter(F.action == "survey"))
+async def update_preferences_callback(callback_query: CallbackQuery, state: FSMContext):
+    await start_survey(callback_query.message, state)
     await callback_query.answer()
 
-async def ask_age(message: types.Message):
+async def start_survey(message: types.Message, state: FSMContext):
+    await state.set_state(SurveyStates.age)
     await message.answer("Пожалуйста, введите ваш возраст:")
 
-@dp.message(lambda message: message.text and message.text.isdigit())
-async def process_age_input(message: types.Message):
+# Шаги опроса различаются состоянием FSM: ответ попадает только в обработчик текущего шага,
+# а текст вне опроса — в свободный запрос к модели (handle_message)
+@dp.message(SurveyStates.age, F.text.isdigit())
+async def process_age_input(message: types.Message, state: FSMContext):
     user_age = message.text
-    update_user(message.from_user.id, 'age', user_age)
+    await profiles.update(message.from_user.id, 'age', user_age)
     await message.answer(f"Ваш возраст ({user_age}) сохранен. Пожалуйста, продолжите выбор предпочтений.")
+    await state.set_state(SurveyStates.gender)
     await ask_gender(message)
 
-@dp.message(lambda message: message.text and not message.text.isdigit())
+@dp.message(SurveyStates.age)
 async def handle_non_digit_input(message: types.Message):
     await message.answer("Пожалуйста, введите числовое значение для возраста.")
 
@@ -91,14 +156,15 @@ async def ask_gender(message: types.Message):
     keyboard = InlineKeyboardBuilder()
     genders = ["Мужской", "Женский", "Другой"]
     for gender in genders:
-        keyboard.add(InlineKeyboardButton(text=gender, callback_data=f"gender_{gender.lower()}"))
+        keyboard.button(text=gender, callback_data=GenderCallback(gender=gender.lower()))
     keyboard.adjust(1)
     await message.answer("Выберите ваш пол:", reply_markup=keyboard.as_markup())
 
-@dp.callback_query(lambda c: c.data.startswith("gender_"))
-async def process_gender(callback_query: CallbackQuery):
-    gender = callback_query.data.split("_")[1]
-    update_user(callback_query.from_user.id, "gender", gender)
+@dp.callback_query(SurveyStates.gender, GenderCallback.filter())
+async def process_gender(callback_query: CallbackQuery, callback_data: GenderCallback, state: FSMContext):
+    gender = callback_data.gender
+    await profiles.update(callback_query.from_user.id, "gender", gender)
+    await state.set_state(SurveyStates.fragrances)
 
     try:
         await callback_query.message.edit_reply_markup(reply_markup=None)
@@ -114,30 +180,27 @@ async def process_gender(callback_query: CallbackQuery):
 async def ask_fragrances(message: types.Message, page=0):
     keyboard = InlineKeyboardBuilder()
     for fragrance in FRAGRANCES[page]:
-        keyboard.add(InlineKeyboardButton(text=fragrance, callback_data=f"fragrance_{fragrance}"))
+        keyboard.button(text=fragrance, callback_data=FragranceCallback(action="pick", value=FRAGRANCE_FAMILIES.index(fragrance)))
     if page < len(FRAGRANCES) - 1:
-        keyboard.add(InlineKeyboardButton(text="Следующая страница", callback_data=f"fragrance_next_{page+1}"))
-    keyboard.add(InlineKeyboardButton(text="Завершить выбор", callback_data="finish_fragrances"))
+        keyboard.button(text="Следующая страница", callback_data=FragranceCallback(action="page", value=page + 1))
+    keyboard.button(text="Завершить выбор", callback_data=FragranceCallback(action="done"))
     keyboard.adjust(1)
     await message.answer('Выберите предпочитаемые ароматы (можно выбрать несколько):', reply_markup=keyboard.as_markup())
 
-@dp.callback_query(lambda c: c.data.startswith('fragrance_'))
-async def process_fragrance(callback_query: CallbackQuery):
-    data = callback_query.data.split('_')
-    if data[1] == 'next':
-        page = int(data[2])
-        await ask_fragrances(callback_query.message, page)
-    else:
-        fragrance = '_'.join(data[1:])
-        user_data = get_user(callback_query.from_user.id)
-        fragrances = user_data.get('preferred_fragrances', []) if user_data else []
-        if fragrance not in fragrances:
-            fragrances.append(fragrance)
-        update_user(callback_query.from_user.id, 'preferred_fragrances', fragrances)
-        await callback_query.answer(text=f"Вы выбрали: {fragrance}. Можете выбрать ещё или завершить выбор.")
-
-@dp.callback_query(lambda c: c.data == "finish_fragrances")
-async def finish_fragrances(callback_query: CallbackQuery):
+@dp.callback_query(SurveyStates.fragrances, FragranceCallback.filter(F.action == "pick"))
+async def process_fragrance(callback_query: CallbackQuery, callback_data: FragranceCallback):
+    fragrance = FRAGRANCE_FAMILIES[callback_data.value]
+    await profiles.add_fragrance(callback_query.from_user.id, fragrance)
+    await callback_query.answer(text=f"Вы выбрали: {fragrance}. Можете выбрать ещё или завершить выбор.")
+
+@dp.callback_query(SurveyStates.fragrances, FragranceCallback.filter(F.action == "page"))
+async def process_fragrance_page(callback_query: CallbackQuery, callback_data: FragranceCallback):
+    await ask_fragrances(callback_query.message, callback_data.value)
+    await callback_query.answer()
+
+@dp.callback_query(SurveyStates.fragrances, FragranceCallback.filter(F.action == "done"))
+async def finish_fragrances(callback_query: CallbackQuery, state: FSMContext):
+    await state.set_state(SurveyStates.location)
     await callback_query.message.edit_reply_markup(reply_markup=None)
     await callback_query.message.answer("Спасибо за ваши предпочтения!")
     await ask_location(callback_query.message)
@@ -146,136 +209,260 @@ async def finish_fragrances(callback_query: CallbackQuery):
 async def ask_location(message: types.Message):
     keyboard = InlineKeyboardBuilder()
     for location in LOCATIONS[0]:
-        keyboard.add(InlineKeyboardButton(text=location, callback_data=f"location_{location}"))
-    keyboard.add(InlineKeyboardButton(text="Другой город", callback_data="location_other"))
+        keyboard.button(text=location, callback_data=LocationCallback(city=location))
+    keyboard.button(text="Другой город", callback_data=LocationCallback())
     keyboard.adjust(1)
     await message.answer('Выберите ваше местоположение:', reply_markup=keyboard.as_markup())
 
-@dp.callback_query(lambda c: c.data.startswith('location_'))
-async def process_location(callback_query: CallbackQuery):
+@dp.callback_query(SurveyStates.location, LocationCallback.filter())
+async def process_location(callback_query: CallbackQuery, callback_data: LocationCallback, state: FSMContext):
     user_id = callback_query.from_user.id
-    logging.info(f"Processing location for user_id={user_id}")
+    metrics.log_event('location_selected', user_id=user_id, custom=callback_data.city is None)
 
-    data = callback_query.data.split('_')
-    if data[1] == 'other':
+    if callback_data.city is None:
+        await state.set_state(SurveyStates.custom_location)
         await callback_query.message.answer("Пожалуйста, введите название вашего города:")
     else:
-        location = '_'.join(data[1:])
-        update_user(user_id, 'location', location)
+        await profiles.update(user_id, 'location', callback_data.city)
         await callback_query.message.edit_reply_markup(reply_markup=None)
-        await finish_survey(callback_query)
+        await finish_survey(callback_query.message, user_id, state)
     await callback_query.answer()
 
+@dp.message(SurveyStates.custom_location, F.text)
+async def process_custom_location(message: types.Message, state: FSMContext):
+    await profiles.update(message.from_user.id, 'location', message.text)
+    await finish_survey(message, message.from_user.id, state)
 
-@dp.message(lambda message: message.text and not message.text.startswith('/'))
-async def process_custom_location(message: types.Message):
-    user_id = message.from_user.id
-    update_user(user_id, 'location', message.text)
-    user_data = get_user(user_id)
+async def finish_survey(message: types.Message, user_id: int, state: FSMContext):
+    await state.clear()
+    await profiles.flush([user_id])
+    user_data = await profiles.get(user_id)
     if not user_data:
         await message.answer("Произошла ошибка при получении данных пользователя. Пожалуйста, попробуйте обновить предпочтения.")
         return
-    await message.answer("Генерирую рекомендацию, это может занять несколько секунд...")
-    recommendation = await generate_recommendation(user_data)
-    await message.answer(f'Спасибо за ответы! Вот моя рекомендация для вас:\n\n{recommendation}')
+    placeholder = await message.answer("Генерирую рекомендацию, это может занять несколько секунд...")
+    await stream_recommendation_to(placeholder, user_id, user_data, prefix='Спасибо за ответы! Вот моя рекомендация для вас:\n\n')
     await ask_feedback(message)
 
-async def finish_survey(callback_query: CallbackQuery):
-    user_id = callback_query.from_user.id
-    user_data = get_user(user_id)
-    if not user_data:
-        await callback_query.message.answer("Произошла ошибка при получении данных пользователя. Пожалуйста, попробуйте обновить предпочтения.")
-        return
-    await callback_query.message.answer("Генерирую рекомендацию, это может занять несколько секунд...")
-    recommendation = await generate_recommendation(user_data)
-    await callback_query.message.answer(f'Спасибо за ответы! Вот моя рекомендация для вас:\n\n{recommendation}')
-    await ask_feedback(callback_query.message)
+async def _edit_text(message: types.Message, text: str) -> float:
+    # Возвращает паузу, которую нужно выдержать перед следующим редактированием
+    try:
+        await message.edit_text(text)
+    except TelegramRetryAfter as e:
+        return e.retry_after
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            logging.warning(f"Failed to edit streamed message: {e}")
+    return 0.0
+
+async def stream_recommendation_to(placeholder: types.Message, user_id: int, user_data: dict,
+                                   user_message: str = "", prefix: str = ""):
+    # Текст модели выводится по мере генерации в одно сообщение; правки не чаще
+    # STREAM_EDIT_INTERVAL, чтобы не упираться в лимиты Telegram на редактирование.
+    text = ""
+    next_edit = 0.0
+    async for chunk in stream_recommendation(user_data, user_message):
+        text += chunk
+        now = time.monotonic()
+        if now >= next_edit and text.strip():
+            next_edit = now + STREAM_EDIT_INTERVAL + await _edit_text(placeholder, prefix + text + " ▌")
+    text = text.strip()
+    await _edit_text(placeholder, prefix + text)
+    if is_recordable(text):
+        await aadd_recommendation(user_id, text)
+        if not user_message:
+            # Ответ без вопроса пользователя годится и для следующего нажатия "Получить рекомендацию"
+            await recommendation_store.save(user_data, text)
 
 async def ask_feedback(message: types.Message):
     keyboard = InlineKeyboardBuilder()
     for i in range(1, 6):
-        keyboard.add(InlineKeyboardButton(text=f"{i} звезд", callback_data=f"feedback_{i}"))
+        keyboard.button(text=f"{i} звезд", callback_data=FeedbackCallback(rating=i))
     keyboard.adjust(1)
     await message.answer("Оцените мои рекомендации (от 1 до 5):", reply_markup=keyboard.as_markup())
 
-@dp.callback_query(lambda c: c.data.startswith('feedback_'))
-async def process_feedback(callback_query: CallbackQuery):
-    feedback = int(callback_query.data.split('_')[1])
-    save_feedback(callback_query.from_user.id, feedback)
+@dp.callback_query(FeedbackCallback.filter())
+async def process_feedback(callback_query: CallbackQuery, callback_data: FeedbackCallback):
+    await asave_feedback(callback_query.from_user.id, callback_data.rating)
     await callback_query.answer(text="Спасибо за ваш отзыв!")
     await callback_query.message.answer("Мы продолжим работу над улучшением рекомендаций для вас!")
 
-@dp.message()
-async def handle_message(message: types.Message):
+@dp.message(StateFilter(None), F.text, ~F.text.startswith('/'))
+async def handle_message(message: types.Message, state: FSMContext):
     if message.from_user.id == bot.id:
         return  # Игнорируем сообщения от самого бота
 
-    user_data = get_user(message.from_user.id)
+    user_data = await profiles.get(message.from_user.id)
     if not user_data or not user_data.get('gender') or not user_data.get('preferred_fragrances'):
         await message.reply("Для получения рекомендации нужно указать пол и предпочитаемые ароматы. Пожалуйста, обновите ваши предпочтения.")
-        await update_preferences_callback(types.CallbackQuery(message=message, from_user=message.from_user, chat_instance="", data="update_preferences"))
+        await start_survey(message, state)
     else:
-        await message.reply("Генерирую рекомендацию, это может занять несколько секунд...")
-        response = await generate_recommendation(user_data, message.text)
-        await message.reply(response)
-        add_recommendation(message.from_user.id, response)
+        placeholder = await message.reply("Генерирую рекомендацию, это может занять несколько секунд...")
+        await stream_recommendation_to(placeholder, message.from_user.id, user_data, message.text)
         await ask_feedback(message)
 
-@dp.message(Command("admin"))
-async def admin_command(message: types.Message):
+@dp.message(StateFilter(None), F.text.startswith('/'))
+async def unknown_command(message: types.Message):
+    # Опечатка в команде (/strat) — не вопрос к модели: отвечаем подсказкой без запроса к OpenAI
+    text = "Неизвестная команда. Доступные команды:\n/start — главное меню: рекомендация и обновление предпочтений"
     if str(message.from_user.id) in ADMIN_USER_IDS:
-        await handle_admin_command(message)
-    else:
-        await message.reply("У вас нет доступа к админ-панели.")
+        text += "\n/admin — админ-панель"
+    await message.reply(text)
 
-@dp.callback_query(lambda c: c.data == "admin_stats")
+@dp.callback_query(AdminCallback.filter(F.action == "stats"))
 async def admin_stats(callback_query: CallbackQuery):
     if str(callback_query.from_user.id) in ADMIN_USER_IDS:
         stats = await get_bot_statistics()
         await callback_query.message.answer(stats)
     await callback_query.answer()
 
-@dp.callback_query(lambda c: c.data == "admin_support")
+@dp.callback_query(AdminCallback.filter(F.action == "support"))
 async def admin_support(callback_query: CallbackQuery):
     if str(callback_query.from_user.id) in ADMIN_USER_IDS:
         support_requests = await get_support_requests_list()
         await callback_query.message.answer(support_requests)
     await callback_query.answer()
 
+@dp.callback_query(AdminCallback.filter(F.action == "metrics"))
+async def admin_metrics(callback_query: CallbackQuery):
+    if str(callback_query.from_user.id) in ADMIN_USER_IDS:
+        await callback_query.message.answer(metrics.summary())
+    await callback_query.answer()
+
+@dp.callback_query(MenuCallback.filter(F.action == "admin"))
+async def admin_panel(callback_query: CallbackQuery):
+    if str(callback_query.from_user.id) in ADMIN_USER_IDS:
+        await handle_admin_command(callback_query.message)
+    await callback_query.answer()
+
+@dp.callback_query(AdminCallback.filter(F.action == "broadcast"))
+async def admin_broadcast(callback_query: CallbackQuery, state: FSMContext):
+    if str(callback_query.from_user.id) in ADMIN_USER_IDS:
+        await ask_broadcast_text(callback_query.message, state)
+    await callback_query.answer()
+
+@dp.callback_query(BroadcastCallback.filter())
+async def broadcast_control(callback_query: CallbackQuery, callback_data: BroadcastCallback):
+    if str(callback_query.from_user.id) not in ADMIN_USER_IDS:
+        await callback_query.answer()
+        return
+    result = await handle_broadcast_control(bot, callback_data.action, callback_data.broadcast_id)
+    await callback_query.answer(text=result)
+
+@dp.callback_query()
+async def stale_callback(callback_query: CallbackQuery):
+    # Кнопки из завершённого или прерванного опроса и старого формата
+    await callback_query.answer(text="Эта кнопка больше не активна. Нажмите /start, чтобы начать заново.")
+
 async def send_recommendations():
-    users = get_all_users()
-    for user in users:
-        recommendation = await generate_recommendation(user)
-        try:
-            await bot.send_message(chat_id=user['id'], text=f"Новая рекомендация для вас:\n\n{recommendation}")
-        except Exception as e:
-            logging.error(f"Failed to send recommendation to user {user['id']}: {str(e)}")
+    await profiles.flush()
+    await run_recommendation_job(bot)
 
 async def update_analytics():
-    feedback_stats = get_feedback_stats()
-    update_google_sheets(feedback_stats)
+    try:
+        from google_sheets import exporter as sheets_exporter
+        await sheets_exporter.aexport()
+    except Exception as e:
+        logging.error(f"Failed to export analytics to Google Sheets: {e}")
 
-async def scheduler():
+async def update_order_analytics():
+    try:
+        from data_analysis import aupdate_order_aggregates
+        await aupdate_order_aggregates()
+    except Exception as e:
+        logging.error(f"Failed to update order analytics: {e}")
+
+async def precompute_recommendations():
+    await profiles.flush()
+    await run_precompute_job()
+
+def _seconds_until(hour: int) -> float:
+    now = datetime.now()
+    target = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if target <= now:
+        target += timedelta(days=1)
+    return (target - now).total_seconds()
+
+async def precompute_scheduler():
+    # Пересчёт в часы минимальной нагрузки, чтобы днём отвечать из хранилища
+    while True:
+        await asyncio.sleep(_seconds_until(PRECOMPUTE_HOUR))
+        try:
+            await precompute_recommendations()
+        except Exception as e:
+            logging.error(f"Recommendation precompute failed: {e}")
+
+async def daily_scheduler():
     while True:
         await asyncio.sleep(86400)  # 24 hours
         await send_recommendations()
         await update_analytics()
+        await update_order_analytics()
+
+async def scheduler():
+    await asyncio.gather(precompute_scheduler(), daily_scheduler())
+
+def load_vector_index():
+    # vectors импортирует numpy — заметную часть времени запуска, поэтому модуль загружается
+    # только при прогреве и в рабочем потоке, не останавливая цикл событий
+    from vectors import vector_index
+    vector_index.load()
+
+async def load_catalogs():
+    await run_db(catalog.load)
+    await run_db(load_vector_index)
+
+def freeze_startup_objects():
+    # Модули, каталоги и клиенты живут до конца процесса: после gc.freeze() полная сборка мусора
+    # их не обходит и не останавливает цикл событий на первых обновлениях
+    gc.freeze()
+
+async def warm_up(import_csv: bool = True):
+    # Выполняется уже после начала приёма обновлений: пока каталог не загружен, товары
+    # подбираются запросом к SQLite (catalog.pick_products), клиент OpenAI создаётся здесь же заранее
+    timer = metrics.StartupTimer()
+    try:
+        if import_csv:
+            await timer.timed('import_products', run_db(import_products_from_csv, 'edpby.csv'))
+        await timer.timed('pii_cipher', asyncio.to_thread(security.warm_up))
+        await timer.timed('load_catalogs', load_catalogs())
+        await timer.timed('openai_client', asyncio.to_thread(get_client))
+    except Exception as e:
+        logging.error(f"Warm-up failed: {e}")
+    freeze_startup_objects()
+    timer.report("Warm-up finished", 'warm_up_total')
+
+async def start_leader_tasks() -> List[asyncio.Task]:
+    # Задачи, которые должны выполняться ровно в одном процессе
+    return [asyncio.create_task(scheduler()),
+            asyncio.create_task(resume_pending_job(bot)),
+            asyncio.create_task(broadcast_engine.resume_unfinished(bot))]
 
 async def main():
     try:
         global BOT_ID
-        # Инициализация ID бота
-        bot_info = await bot.get_me()
+        # Схема БД и запрос к Telegram независимы и идут параллельно; bot.me() кэширует
+        # ответ, поэтому start_polling не запрашивает его повторно
+        _, bot_info = await asyncio.gather(startup.timed('init_db', run_db(init_db)),
+                                           startup.timed('get_me', bot.me()))
         BOT_ID = bot_info.id
         logging.info(f"Bot initialized with username: {bot_info.username}, id: {BOT_ID}")
-        
-        init_db()
-        import_products_from_csv('edpby.csv')
-        asyncio.create_task(scheduler())
+
+        # Импорт каталога и прогрев — в фоне, обновления принимаются сразу
+        asyncio.create_task(warm_up())
+        await start_leader_tasks()
+        asyncio.create_task(profiles.run_flusher())
+        asyncio.create_task(metrics.monitor_loop_lag())
+        await startup.timed('metrics_server', metrics.start_server())
+        freeze_startup_objects()
+        startup.report("Startup finished, polling", 'ready_total')
         await dp.start_polling(bot)
     except Exception as e:
         logging.error(f"Error in main function: {e}")
         raise
+    finally:
+        await profiles.close()
+        close_connections()
 
 
 if __name__ == '__main__':
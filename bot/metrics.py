@@ -0,0 +1,342 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Tuple, List, Callable, Iterator, Awaitable, TypeVar
+from aiogram import BaseMiddleware
+from config import METRICS_HOST, METRICS_PORT, LOG_SAMPLE_RATE
+
+# Метрики процесса в текстовом формате Prometheus: счётчики, значения и гистограммы
+# с метками. Обновляются из цикла событий и из потоков пула БД, поэтому под блокировкой.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LOOP_LAG_INTERVAL = 1.0
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+T = TypeVar("T")
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: str = '') -> str:
+        parts = [f'{name}="{_escape(value)}"' for name, value in zip(self.labels, key)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> List[str]:
+        return super().render() + [f"{self.name}{self._format_labels(key)} {value}" for key, value in self.values().items()]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (), func: Callable[[], float] = None):
+        # func — значение вычисляется при каждом чтении (глубина очереди, размер кэша)
+        super().__init__(name, description, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self.func = func
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def get(self, **labels) -> float:
+        if self.func is not None:
+            return self.func()
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> List[str]:
+        if self.func is not None:
+            try:
+                return super().render() + [f"{self.name} {self.func()}"]
+            except Exception as e:
+                logging.error(f"Failed to read gauge {self.name}: {e}")
+                return []
+        with self._lock:
+            values = dict(self._values)
+        return super().render() + [f"{self.name}{self._format_labels(key)} {value}" for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        # метки -> [счётчики по корзинам (последняя — +Inf), сумма, количество]
+        self._values: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            else:
+                state[0][-1] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self) -> Dict[Tuple[str, ...], Tuple[List[int], float, int]]:
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+
+    def quantile(self, q: float, counts: List[int]) -> float:
+        # Оценка по верхней границе корзины, как histogram_quantile без интерполяции
+        total = sum(counts)
+        if not total:
+            return 0.0
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float('inf')
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, (counts, total, count) in self.snapshot().items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name: str, description: str, labels: Tuple[str, ...] = (), func: Callable[[], float] = None) -> Gauge:
+        return self.register(Gauge(name, description, labels, func))
+
+    def histogram(self, name: str, description: str, labels: Tuple[str, ...] = ()) -> Histogram:
+        return self.register(Histogram(name, description, labels))
+
+    def metrics(self) -> List[_Metric]:
+        return list(self._metrics.values())
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram('bot_handler_seconds', "Время обработки апдейта", ('event', 'handler'))
+handler_errors = registry.counter('bot_handler_errors_total', "Исключения в обработчиках", ('event', 'handler'))
+db_seconds = registry.histogram('bot_db_seconds', "Время вызова функции database.py через пул", ('function',))
+db_errors = registry.counter('bot_db_errors_total', "Ошибки функций database.py", ('function',))
+openai_seconds = registry.histogram('bot_openai_seconds', "Время запроса к OpenAI", ('kind',))
+openai_tokens = registry.counter('bot_openai_tokens_total', "Токены OpenAI", ('kind',))
+openai_errors = registry.counter('bot_openai_errors_total', "Ошибки запросов к OpenAI", ('kind',))
+openai_hedges = registry.counter('bot_openai_hedged_total', "Дублирующие запросы к OpenAI")
+template_renders = registry.counter('bot_template_renders_total', "Рекомендации по шаблону", ('lane',))
+llm_fallbacks = registry.counter('bot_llm_fallbacks_total', "Ответы без модели", ('source',))
+loop_lag = registry.gauge('bot_event_loop_lag_seconds', "Запаздывание цикла событий")
+queue_depth = registry.gauge('bot_queue_depth', "Глубина очередей фоновых задач", ('queue',))
+startup_seconds = registry.gauge('bot_startup_seconds', "Длительность фаз запуска", ('phase',))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware: вызывается уже после выбора обработчика, имя берётся из него
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        event_type = type(event).__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(event=event_type, handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, event=event_type, handler=name)
+
+
+def record_db_call(function: str, seconds: float, failed: bool):
+    db_seconds.observe(seconds, function=function)
+    if failed:
+        db_errors.inc(function=function)
+
+
+def record_openai_usage(usage):
+    if usage is not None:
+        openai_tokens.inc(usage.prompt_tokens or 0, kind='prompt')
+        openai_tokens.inc(usage.completion_tokens or 0, kind='completion')
+
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    # Сон длится дольше заказанного, когда цикл занят синхронной работой
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag.set(max(time.perf_counter() - started - interval, 0.0))
+
+
+class StartupTimer:
+    # Фазы запуска в порядке завершения; параллельные фазы считаются каждая от своего начала
+    def __init__(self, started: float = None):
+        self.started = time.perf_counter() if started is None else started
+        self.phases: Dict[str, float] = {}
+
+    def record(self, phase: str, seconds: float):
+        self.phases[phase] = seconds
+        startup_seconds.set(seconds, phase=phase)
+
+    async def timed(self, phase: str, awaitable: Awaitable[T]) -> T:
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.record(phase, time.perf_counter() - started)
+
+    def report(self, title: str, total_phase: str):
+        self.record(total_phase, time.perf_counter() - self.started)
+        logging.info(f"{title}: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items()))
+
+
+class _Fields:
+    # Строка "ключ=значение" собирается, только если запись действительно выводится
+    def __init__(self, fields: Dict[str, Any]):
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return " ".join(f"{key}={value}" for key, value in self.fields.items())
+
+
+def log_event(event: str, rate: float = None, level: int = logging.INFO, **fields):
+    # Частые события пишутся в лог выборочно: доля rate (по умолчанию LOG_SAMPLE_RATE)
+    if random.random() >= (LOG_SAMPLE_RATE if rate is None else rate):
+        return
+    if logging.getLogger().isEnabledFor(level):
+        logging.log(level, "%s %s", event, _Fields(fields))
+
+
+def _summarize(histogram: Histogram, limit: int) -> List[Tuple[str, int, float, float]]:
+    # (метки, количество, p50, p95) по убыванию суммарного времени
+    rows = sorted(histogram.snapshot().items(), key=lambda item: item[1][1], reverse=True)[:limit]
+    return [("/".join(key), count, histogram.quantile(0.5, counts), histogram.quantile(0.95, counts))
+            for key, (counts, total, count) in rows]
+
+
+def summary() -> str:
+    text = "Производительность (с запуска процесса):\n\n"
+    text += f"Запаздывание цикла событий: {loop_lag.get() * 1000:.0f} мс\n"
+    phases = {key[0]: value for key, value in startup_seconds.values().items()}
+    if phases:
+        text += "Запуск: " + ", ".join(f"{phase} {seconds:.2f} с" for phase, seconds in phases.items()) + "\n"
+
+    text += "\nОбработчики (p50 / p95 по корзинам):\n"
+    for name, count, p50, p95 in _summarize(handler_seconds, 5):
+        text += f"{name}: {count} шт., ≤{p50 * 1000:.0f} / ≤{p95 * 1000:.0f} мс\n"
+
+    text += "\nБаза данных:\n"
+    for name, count, p50, p95 in _summarize(db_seconds, 5):
+        text += f"{name}: {count} шт., ≤{p50 * 1000:.0f} / ≤{p95 * 1000:.0f} мс\n"
+    db_failed = sum(db_errors.values().values())
+    if db_failed:
+        text += f"Ошибок БД: {db_failed:.0f}\n"
+
+    text += "\nOpenAI:\n"
+    for name, count, p50, p95 in _summarize(openai_seconds, 2):
+        text += f"{name}: {count} запросов, ≤{p50:.1f} / ≤{p95:.1f} с\n"
+    tokens = {key[0]: value for key, value in openai_tokens.values().items()}
+    text += f"Токены: {tokens.get('prompt', 0):.0f} на входе, {tokens.get('completion', 0):.0f} на выходе\n"
+    text += f"Ошибок: {sum(openai_errors.values().values()):.0f}\n"
+
+    gauges = [metric for metric in registry.metrics() if isinstance(metric, Gauge) and metric.func is not None]
+    if gauges:
+        text += "\nОчереди:\n" + "\n".join(f"{metric.description}: {metric.get():.0f}" for metric in gauges)
+    return text.rstrip()
+
+
+async def handle_metrics(request):
+    from aiohttp import web
+    return web.Response(body=registry.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    # Отдельный локальный HTTP-сервер для /metrics; порт 0 — выключено
+    if not port:
+        return None
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logging.error(f"Metrics server not started on {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logging.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,190 @@
+import re
+import math
+import csv
+import sys
+import logging
+import argparse
+from datetime import datetime
+from typing import Dict, Any, List, Callable, Tuple
+from config import POPULARITY_HALF_LIFE_DAYS
+from database import init_db, read_cursor, write_cursor, logaddexp2
+
+# Популярность товаров по событиям из выгрузки edp.by (8 колонок):
+# id события, id открытого товара (0 — не открывали), ..., текст запроса, IP, время, ...
+#
+# Каждое событие весит 2 ** ((t - EPOCH) / период полураспада). Пересчитывать накопленные
+# суммы со временем не нужно: затухание к текущему моменту — общий множитель для всех
+# товаров, он не меняет порядок и сокращается при нормировке на максимум.
+# Веса и суммы хранятся как log2: при малом периоде полураспада или далёкой дате
+# сам вес не помещается во float.
+EPOCH = datetime(2024, 1, 1)
+EVENT_ROW_LENGTH = 8
+BATCH_SIZE = 1000
+_WORD_RE = re.compile(r"[^\w]+")
+_VOLUME_RE = re.compile(r"\s\d+(?:[.,]\d+)?\s*(?:ml|мл)\b.*$")
+
+_listeners: List[Callable[[], None]] = []
+
+
+def normalize_name(text: str) -> str:
+    return " ".join(_WORD_RE.sub(" ", text.lower()).split())
+
+
+def base_name(text: str) -> str:
+    # "PACO RABANNE - 1 Million 50 ml туалетная вода" -> "paco rabanne 1 million"
+    return normalize_name(_VOLUME_RE.sub("", " " + text.lower()))
+
+
+def event_log_weight(timestamp: str) -> float:
+    days = (datetime.fromisoformat(timestamp) - EPOCH).total_seconds() / 86400
+    return days / POPULARITY_HALF_LIFE_DAYS
+
+
+def on_popularity_updated(callback: Callable[[], None]):
+    _listeners.append(callback)
+
+
+def _notify():
+    for callback in _listeners:
+        try:
+            callback()
+        except Exception as e:
+            logging.error(f"Popularity listener failed: {e}")
+
+
+def get_watermark() -> int:
+    with read_cursor() as c:
+        c.execute("SELECT last_event_id FROM popularity_state WHERE source = 'events'")
+        row = c.fetchone()
+    return row[0] if row else 0
+
+
+class EventAggregator:
+    # Потоковая свёртка событий: в памяти только сумма весов по каждому
+    # уникальному (товар, текст запроса), а не сами события
+    def __init__(self, after_event_id: int = 0):
+        self.after_event_id = after_event_id
+        self.last_event_id = after_event_id
+        self.totals: Dict[Tuple[str, str], List[float]] = {}
+        self.events = 0
+        self.invalid = 0
+
+    def add(self, row: List[str]):
+        try:
+            event_id = int(row[0])
+            weight = event_log_weight(row[5])
+        except (ValueError, OverflowError):
+            self.invalid += 1
+            return
+        if event_id <= self.after_event_id:
+            return
+        self.events += 1
+        self.last_event_id = max(self.last_event_id, event_id)
+        key = (row[1], normalize_name(row[3]))
+        total = self.totals.get(key)
+        if total is None:
+            self.totals[key] = [weight, 1]
+        else:
+            total[0] = logaddexp2(total[0], weight)
+            total[1] += 1
+
+
+def apply_events(aggregator: EventAggregator) -> Dict[str, Any]:
+    stats = {'events': aggregator.events, 'matched': 0, 'unmatched': 0, 'invalid': aggregator.invalid}
+    if not aggregator.events:
+        return stats
+    with read_cursor() as c:
+        c.execute("SELECT id, name, category FROM products")
+        products = c.fetchall()
+    categories = {product_id: category for product_id, _, category in products}
+    exact: Dict[str, List[str]] = {}
+    by_base: Dict[str, List[str]] = {}
+    for product_id, name, _ in products:
+        exact.setdefault(normalize_name(name or ''), []).append(product_id)
+        by_base.setdefault(base_name(name or ''), []).append(product_id)
+
+    # Открытый товар > точное совпадение названия > то же название без объёма (вес делится между объёмами)
+    scores: Dict[str, List[float]] = {}
+    for (clicked, text), (weight, count) in aggregator.totals.items():
+        if clicked in categories:
+            ids = [clicked]
+        else:
+            ids = (exact.get(text) or by_base.get(base_name(text))) if text else None
+        if not ids:
+            stats['unmatched'] += int(count)
+            continue
+        stats['matched'] += int(count)
+        share = weight - math.log2(len(ids))
+        for product_id in ids:
+            score = scores.setdefault(product_id, [None, 0])
+            score[0] = logaddexp2(score[0], share)
+            score[1] += count / len(ids)
+
+    by_category: Dict[str, List[float]] = {}
+    for product_id, (weight, count) in scores.items():
+        score = by_category.setdefault(categories[product_id], [None, 0])
+        score[0] = logaddexp2(score[0], weight)
+        score[1] += count
+
+    with write_cursor() as c:
+        rows = [(product_id, weight, count) for product_id, (weight, count) in scores.items()]
+        for start in range(0, len(rows), BATCH_SIZE):
+            c.executemany('''INSERT INTO product_popularity (product_id, score, log_score, events) VALUES (?, 0, ?, ?)
+                             ON CONFLICT(product_id) DO UPDATE SET log_score = logaddexp2(log_score, excluded.log_score),
+                                                                   events = events + excluded.events''',
+                          rows[start:start + BATCH_SIZE])
+        c.executemany('''INSERT INTO category_popularity (category, score, log_score, events) VALUES (?, 0, ?, ?)
+                         ON CONFLICT(category) DO UPDATE SET log_score = logaddexp2(log_score, excluded.log_score),
+                                                             events = events + excluded.events''',
+                      [(category, weight, count) for category, (weight, count) in by_category.items()])
+        c.execute('''INSERT INTO popularity_state (source, last_event_id, updated_at) VALUES ('events', ?, CURRENT_TIMESTAMP)
+                     ON CONFLICT(source) DO UPDATE SET last_event_id = excluded.last_event_id, updated_at = excluded.updated_at''',
+                  (aggregator.last_event_id,))
+    logging.info(f"Popularity updated: {stats}")
+    if scores:
+        _notify()
+    return stats
+
+
+def ingest_events_file(path: str) -> Dict[str, Any]:
+    # Отдельный лог событий: новые файлы дочитываются с последнего обработанного id события
+    aggregator = EventAggregator(get_watermark())
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) == EVENT_ROW_LENGTH:
+                aggregator.add(row)
+    return apply_events(aggregator)
+
+
+def load_product_scores() -> Dict[str, float]:
+    # Доля от самого популярного товара, 0..1
+    with read_cursor() as c:
+        c.execute("SELECT product_id, log_score FROM product_popularity WHERE log_score IS NOT NULL")
+        rows = c.fetchall()
+    if not rows:
+        return {}
+    top = max(score for _, score in rows)
+    return {product_id: 2.0 ** (score - top) for product_id, score in rows}
+
+
+def get_category_popularity() -> Dict[str, float]:
+    with read_cursor() as c:
+        c.execute("SELECT category, log_score FROM category_popularity WHERE log_score IS NOT NULL ORDER BY log_score DESC")
+        rows = c.fetchall()
+    top = rows[0][1] if rows else 0.0
+    return {category: 2.0 ** (score - top) for category, score in rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Учёт популярности товаров по логу событий edp.by")
+    parser.add_argument('csv_files', nargs='+')
+    args = parser.parse_args(argv)
+    init_db()
+    for path in args.csv_files:
+        stats = ingest_events_file(path)
+        print(f"{path}: {stats}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
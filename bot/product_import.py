@@ -0,0 +1,148 @@
+import os
+import csv
+import sys
+import hashlib
+import logging
+import argparse
+from typing import Dict, Any, Iterator, Optional, Tuple
+from database import init_db, read_cursor, write_cursor, notify_products_imported
+from popularity import EventAggregator, apply_events, get_watermark, EVENT_ROW_LENGTH
+
+BATCH_SIZE = 1000
+SHOP_PREFIX = 'https://edp.by/shop/'
+
+# Файл выгрузки содержит строки разной формы:
+# - 10 колонок: страницы сайта (id, url, название, дата, ...); товары и разделы edp.by/shop;
+# - 8 колонок: события посетителей (id, открытый товар, ..., текст запроса, IP, дата, ...),
+#   они идут в учёт популярности (popularity.py).
+CATALOG_ROW_LENGTH = 10
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _get_import_state(source: str) -> Optional[Tuple[int, float, str]]:
+    with read_cursor() as c:
+        c.execute("SELECT size, mtime, sha256 FROM import_state WHERE source = ?", (source,))
+        return c.fetchone()
+
+
+def _save_import_state(c, source: str, size: int, mtime: float, sha256: str):
+    c.execute('''INSERT INTO import_state (source, size, mtime, sha256, imported_at) VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                 ON CONFLICT(source) DO UPDATE SET size = excluded.size, mtime = excluded.mtime,
+                                                   sha256 = excluded.sha256, imported_at = excluded.imported_at''',
+              (source, size, mtime, sha256))
+
+
+def iter_catalog_rows(csv_file_path: str, stats: Dict[str, int],
+                      events: Optional[EventAggregator] = None) -> Iterator[Tuple[str, str, str, str]]:
+    with open(csv_file_path, 'r', encoding='utf-8', newline='') as csvfile:
+        for row in csv.reader(csvfile):
+            if len(row) == EVENT_ROW_LENGTH:
+                stats['events'] += 1
+                if events is not None:
+                    events.add(row)
+                continue
+            if len(row) != CATALOG_ROW_LENGTH:
+                stats['malformed'] += 1
+                continue
+            url = row[1]
+            if not url.startswith(SHOP_PREFIX):
+                continue
+            path = [part for part in url[len(SHOP_PREFIX):].split('/') if part]
+            if len(path) < 2:
+                # Страница раздела (/shop/mens-perfumes/), а не товар
+                stats['categories'] += 1
+                continue
+            yield row[0], row[2].strip(), url, path[0]
+
+
+def import_products_from_csv(csv_file_path: str, force: bool = False) -> Dict[str, Any]:
+    stats = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0,
+             'categories': 0, 'events': 0, 'duplicates': 0, 'malformed': 0, 'skipped': False}
+    if not os.path.exists(csv_file_path):
+        logging.error(f"CSV file not found at {csv_file_path}")
+        return stats
+
+    source = os.path.abspath(csv_file_path)
+    st = os.stat(csv_file_path)
+    state = _get_import_state(source)
+    if not force and state and state[0] == st.st_size and state[1] == st.st_mtime:
+        stats['skipped'] = True
+        logging.info(f"Products import skipped: {csv_file_path} is unchanged")
+        return stats
+    sha256 = _file_sha256(csv_file_path)
+    if not force and state and state[2] == sha256:
+        with write_cursor() as c:
+            _save_import_state(c, source, st.st_size, st.st_mtime, sha256)
+        stats['skipped'] = True
+        logging.info(f"Products import skipped: {csv_file_path} content is unchanged")
+        return stats
+
+    with read_cursor() as c:
+        c.execute("SELECT id, name, url, category FROM products")
+        existing = {row[0]: row[1:] for row in c.fetchall()}
+
+    events = EventAggregator(get_watermark())
+    with write_cursor() as c:
+        inserts, updates = [], []
+
+        def flush():
+            if inserts:
+                c.executemany("INSERT INTO products (id, name, url, category) VALUES (?, ?, ?, ?)", inserts)
+                inserts.clear()
+            if updates:
+                c.executemany("UPDATE products SET name = ?, url = ?, category = ? WHERE id = ?", updates)
+                updates.clear()
+
+        seen = set()
+        for product_id, name, url, category in iter_catalog_rows(csv_file_path, stats, events):
+            if product_id in seen:
+                stats['duplicates'] += 1
+                continue
+            seen.add(product_id)
+            current = existing.pop(product_id, None)
+            if current is None:
+                inserts.append((product_id, name, url, category))
+                stats['inserted'] += 1
+            elif current != (name, url, category):
+                updates.append((name, url, category, product_id))
+                stats['updated'] += 1
+            else:
+                stats['unchanged'] += 1
+            if len(inserts) + len(updates) >= BATCH_SIZE:
+                flush()
+        flush()
+
+        # Всё, что осталось в existing, исчезло из выгрузки
+        stats['deleted'] = len(existing)
+        c.executemany("DELETE FROM products WHERE id = ?", ((product_id,) for product_id in existing))
+        _save_import_state(c, source, st.st_size, st.st_mtime, sha256)
+
+    if stats['inserted'] or stats['updated'] or stats['deleted']:
+        notify_products_imported()
+    logging.info(f"Products imported: {stats}")
+    # События сопоставляются с уже обновлённым каталогом; учитываются только новые (по id события)
+    stats['popularity'] = apply_events(events)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Импорт каталога edp.by из CSV-выгрузки")
+    parser.add_argument('csv_file', nargs='?', default='edpby.csv')
+    parser.add_argument('--force', action='store_true', help="импортировать, даже если файл не изменился")
+    args = parser.parse_args(argv)
+    init_db()
+    stats = import_products_from_csv(args.csv_file, force=args.force)
+    for key, value in stats.items():
+        print(f"{key}: {value}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+import sys
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional, Iterable
+from config import PROFILE_CACHE_MAX_BYTES, PROFILE_FLUSH_INTERVAL, STATE_BACKEND
+from database import aget_user, asave_users, USER_FIELDS
+
+
+def _profile_size(profile: Dict[str, Any]) -> int:
+    size = sys.getsizeof(profile)
+    for value in profile.values():
+        size += sys.getsizeof(value)
+        if isinstance(value, list):
+            size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+def _copy(profile: Dict[str, Any]) -> Dict[str, Any]:
+    return dict(profile, preferred_fragrances=list(profile['preferred_fragrances']))
+
+
+class ProfileCache:
+    # Изменения профиля сразу видны обработчикам, а в SQLite попадают пачками:
+    # по таймеру, по завершении опроса и при остановке бота.
+    # В режиме write_through (несколько процессов с общей базой) кэш не используется:
+    # соседний воркер мог изменить профиль, поэтому чтение и запись идут сразу в SQLite.
+    def __init__(self, max_bytes: int = PROFILE_CACHE_MAX_BYTES, flush_interval: float = PROFILE_FLUSH_INTERVAL,
+                 write_through: bool = False):
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.write_through = write_through
+        self._profiles: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._bytes = 0
+        self._dirty: set = set()
+        self._flush_lock = asyncio.Lock()
+        # user_id -> [блокировка, число ожидающих]; запись удаляется, когда профиль никто не правит
+        self._edit_locks: Dict[int, list] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def dirty_count(self) -> int:
+        return len(self._dirty)
+
+    async def _save(self, profile: Dict[str, Any]):
+        if self.write_through:
+            try:
+                await asave_users([profile])
+            finally:
+                self._dirty.discard(profile['id'])
+        else:
+            self._store(profile)
+
+    def _store(self, profile: Dict[str, Any]):
+        user_id = profile['id']
+        self._bytes -= self._sizes.get(user_id, 0)
+        self._profiles[user_id] = profile
+        self._profiles.move_to_end(user_id)
+        self._sizes[user_id] = _profile_size(profile)
+        self._bytes += self._sizes[user_id]
+        self._evict()
+
+    def _evict(self):
+        # Несохранённые профили не вытесняются: они уйдут при ближайшем сбросе
+        for user_id in list(self._profiles):
+            if self._bytes <= self.max_bytes:
+                break
+            if user_id in self._dirty:
+                continue
+            del self._profiles[user_id]
+            self._bytes -= self._sizes.pop(user_id)
+
+    async def _load(self, user_id: int) -> Optional[Dict[str, Any]]:
+        if self.write_through:
+            self.misses += 1
+            return await aget_user(user_id)
+        profile = self._profiles.get(user_id)
+        if profile is not None:
+            self.hits += 1
+            self._profiles.move_to_end(user_id)
+            return profile
+        self.misses += 1
+        profile = await aget_user(user_id)
+        # Пока шёл запрос, профиль мог появиться в кэше — его версия свежее
+        if user_id in self._profiles:
+            return self._profiles[user_id]
+        if profile is not None:
+            self._store(profile)
+        return profile
+
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        profile = await self._load(user_id)
+        return _copy(profile) if profile else None
+
+    @asynccontextmanager
+    async def _edit(self, user_id: int):
+        # Чтение, изменение и сохранение профиля одного пользователя идут по очереди: иначе
+        # /start и ответ опроса, пришедшие одновременно, создали бы по своему профилю
+        # (или прочитали бы одну версию из базы) и последний сохранённый затёр бы поля другого
+        entry = self._edit_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                profile = await self._load(user_id)
+                if profile is None:
+                    profile = {'id': user_id, **{field: None for field in USER_FIELDS}, 'preferred_fragrances': []}
+                    logging.info(f"New user created: {user_id}")
+                self._dirty.add(user_id)
+                yield profile
+                await self._save(profile)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._edit_locks[user_id]
+
+    async def add_user(self, user_id: int, first_name: str, last_name: str):
+        async with self._edit(user_id) as profile:
+            profile['first_name'] = first_name
+            profile['last_name'] = last_name
+
+    async def update(self, user_id: int, field: str, value: Any):
+        if field not in USER_FIELDS:
+            raise ValueError(f"Unknown user field: {field}")
+        async with self._edit(user_id) as profile:
+            profile[field] = list(value) if field == 'preferred_fragrances' else value
+
+    async def add_fragrance(self, user_id: int, fragrance: str) -> List[str]:
+        async with self._edit(user_id) as profile:
+            if fragrance not in profile['preferred_fragrances']:
+                profile['preferred_fragrances'].append(fragrance)
+            return list(profile['preferred_fragrances'])
+
+    async def flush(self, user_ids: Iterable[int] = None):
+        async with self._flush_lock:
+            ids = self._dirty if user_ids is None else self._dirty.intersection(user_ids)
+            if not ids:
+                return
+            ids = list(ids)
+            batch = [_copy(self._profiles[user_id]) for user_id in ids]
+            self._dirty.difference_update(ids)
+            try:
+                await asave_users(batch)
+            except Exception:
+                self._dirty.update(ids)
+                raise
+            logging.info(f"Flushed {len(batch)} user profiles")
+            self._evict()
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Failed to flush user profiles: {e}")
+
+    async def close(self):
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {'size': len(self._profiles), 'bytes': self._bytes, 'dirty': len(self._dirty),
+                'hits': self.hits, 'misses': self.misses}
+
+
+profiles = ProfileCache(write_through=STATE_BACKEND != 'memory')
@@ -0,0 +1,99 @@
+import time
+import asyncio
+import logging
+from typing import Dict
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, TelegramNetworkError, TelegramServerError
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_INTERVAL
+
+SEND_ATTEMPTS = 5
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        # Flood wait от Telegram относится ко всему боту, а не к одному чату
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def try_acquire(self, tokens: float = 1, reserve: float = 0.0) -> float:
+        # Без ожидания: 0 — токены списаны, иначе через сколько секунд их станет достаточно.
+        # reserve — запас, который этот вызов не может израсходовать (для более важных запросов)
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens - reserve >= tokens:
+            self._tokens -= tokens
+            return 0.0
+        return (tokens + reserve - self._tokens) / self.rate
+
+    def refund(self, tokens: float):
+        # Возврат неизрасходованного (или доплата перерасхода при отрицательном значении)
+        self._tokens = min(self.capacity, self._tokens + tokens)
+
+    async def acquire(self, tokens: float = 1):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class SendError(Exception):
+    def __init__(self, message: str, permanent: bool):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+class TelegramSender:
+    def __init__(self, bot: Bot, rate: float = TELEGRAM_GLOBAL_RATE,
+                 per_chat_interval: float = TELEGRAM_PER_CHAT_INTERVAL):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self._next_chat_slot: Dict[int, float] = {}
+        self.retries = 0
+
+    async def _wait_chat_slot(self, chat_id: int):
+        now = time.monotonic()
+        slot = max(now, self._next_chat_slot.get(chat_id, 0.0))
+        self._next_chat_slot[chat_id] = slot + self.per_chat_interval
+        if len(self._next_chat_slot) > 10000:
+            self._next_chat_slot = {k: v for k, v in self._next_chat_slot.items() if v > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        for attempt in range(1, SEND_ATTEMPTS + 1):
+            await self._wait_chat_slot(chat_id)
+            await self.bucket.acquire()
+            try:
+                return await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            except TelegramRetryAfter as e:
+                self.retries += 1
+                logging.warning(f"Flood control, retry after {e.retry_after}s (chat {chat_id})")
+                self.bucket.pause(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Пользователь заблокировал бота или чат не существует: повтор не поможет
+                raise SendError(str(e), permanent=True)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                self.retries += 1
+                if attempt == SEND_ATTEMPTS:
+                    raise SendError(str(e), permanent=False)
+                await asyncio.sleep(min(2 ** attempt, 30))
+        raise SendError("Too many flood control retries", permanent=False)
@@ -0,0 +1,259 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, Any, Callable, Optional
+from aiogram import Bot
+from config import RECOMMENDATION_CONCURRENCY, PRECOMPUTE_CONCURRENCY, RECOMMENDATION_INACTIVE_DAYS
+from database import (run_db, get_segment_users_after, get_job_checkpoint, save_job_checkpoint, clear_job_checkpoint,
+                      aadd_recommendation, get_precomputed_states, asave_precomputed_recommendations)
+from ai_helper import generate_recommendation, is_recordable, BATCH
+import recommendation_store
+from templates import is_templated
+from ratelimit import TelegramSender, SendError
+from metrics import queue_depth
+
+JOB_NAME = "daily_recommendations"
+PRECOMPUTE_JOB_NAME = "precompute_recommendations"
+STORE_BATCH_SIZE = 50
+USERS_CHUNK_SIZE = 500
+CHECKPOINT_EVERY = 50
+PROGRESS_INTERVAL = 10.0
+
+# Пользователи без пола или ароматов отсеиваются ещё в SQL (segments.py)
+DAILY_SEGMENT = {'recommendable': True, 'inactive_days': RECOMMENDATION_INACTIVE_DAYS}
+PRECOMPUTE_SEGMENT = {'recommendable': True}
+
+_running = asyncio.Lock()
+_precomputing = asyncio.Lock()
+
+
+class _Watermark:
+    # Пользователи завершаются не по порядку; контрольная точка — наибольший id,
+    # до которого включительно обработаны все выданные пользователи.
+    def __init__(self, start: int):
+        self.value = start
+        self._issued = deque()
+        self._done = set()
+
+    def issue(self, user_id: int):
+        self._issued.append(user_id)
+
+    def complete(self, user_id: int):
+        self._done.add(user_id)
+        while self._issued and self._issued[0] in self._done:
+            self.value = self._issued.popleft()
+            self._done.discard(self.value)
+
+
+def _log_progress(stats: Dict[str, Any]):
+    logging.info(f"Recommendation job: processed {stats['processed']}, sent {stats['sent']}, "
+                 f"skipped {stats['skipped']}, failed {stats['failed']}, {stats['rate']:.1f} users/s")
+
+
+def _log_precompute_progress(stats: Dict[str, Any]):
+    logging.info(f"Precompute job: processed {stats['processed']}, generated {stats['generated']}, "
+                 f"fresh {stats['fresh']}, skipped {stats['skipped']}, templated {stats['templated']}, "
+                 f"failed {stats['failed']}, {stats['rate']:.1f} users/s")
+
+
+async def run_recommendation_job(bot: Bot, concurrency: int = RECOMMENDATION_CONCURRENCY, job: str = JOB_NAME,
+                                 progress: Optional[Callable[[Dict[str, Any]], None]] = _log_progress,
+                                 segment: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    if _running.locked():
+        logging.warning(f"Job {job} is already running, skipping this run")
+        return {}
+    async with _running:
+        return await _run(bot, concurrency, job, progress, DAILY_SEGMENT if segment is None else segment)
+
+
+async def _run(bot: Bot, concurrency: int, job: str, progress, segment: Dict[str, Any]) -> Dict[str, Any]:
+    start_after = await run_db(get_job_checkpoint, job)
+    if start_after is not None:
+        logging.info(f"Resuming job {job} after user {start_after}")
+    watermark = _Watermark(start_after or 0)
+    sender = TelegramSender(bot)
+    users_queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    send_queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    started = time.monotonic()
+    stats = {'processed': 0, 'sent': 0, 'skipped': 0, 'failed': 0, 'rate': 0.0}
+
+    async def finish(user_id: int, outcome: str):
+        stats[outcome] += 1
+        stats['processed'] += 1
+        watermark.complete(user_id)
+        queue_depth.set(users_queue.qsize(), queue=f"{job}:users")
+        queue_depth.set(send_queue.qsize(), queue=f"{job}:send")
+        if stats['processed'] % CHECKPOINT_EVERY == 0:
+            await run_db(save_job_checkpoint, job, watermark.value)
+
+    async def produce():
+        last_id = watermark.value
+        while True:
+            users = await run_db(get_segment_users_after, segment, last_id, USERS_CHUNK_SIZE)
+            if not users:
+                break
+            for user in users:
+                watermark.issue(user['id'])
+                await users_queue.put(user)
+            last_id = users[-1]['id']
+        for _ in range(concurrency):
+            await users_queue.put(None)
+
+    async def generate():
+        while (user := await users_queue.get()) is not None:
+            if not user.get('gender') or not user.get('preferred_fragrances'):
+                await finish(user['id'], 'skipped')
+                continue
+            # После ночного пересчёта у большинства пользователей уже есть готовая рекомендация
+            recommendation = await recommendation_store.get_fresh(user) or await generate_recommendation(user, lane=BATCH)
+            if not is_recordable(recommendation):
+                await finish(user['id'], 'failed')
+                continue
+            await send_queue.put((user['id'], recommendation))
+
+    async def send():
+        while (item := await send_queue.get()) is not None:
+            user_id, recommendation = item
+            try:
+                await sender.send_message(user_id, f"Новая рекомендация для вас:\n\n{recommendation}")
+                await aadd_recommendation(user_id, recommendation)
+                await finish(user_id, 'sent')
+            except SendError as e:
+                logging.error(f"Failed to send recommendation to user {user_id}: {e}")
+                await finish(user_id, 'failed')
+            except Exception as e:
+                logging.error(f"Failed to send recommendation to user {user_id}: {str(e)}")
+                await finish(user_id, 'failed')
+
+    async def report():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            stats['rate'] = stats['processed'] / (time.monotonic() - started)
+            progress(stats)
+
+    reporter = asyncio.create_task(report()) if progress else None
+    senders = [asyncio.create_task(send()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(produce(), *(generate() for _ in range(concurrency)))
+        for _ in senders:
+            await send_queue.put(None)
+        await asyncio.gather(*senders)
+    except BaseException:
+        for task in senders:
+            task.cancel()
+        await run_db(save_job_checkpoint, job, watermark.value)
+        raise
+    finally:
+        if reporter:
+            reporter.cancel()
+
+    await run_db(clear_job_checkpoint, job)
+    stats['rate'] = stats['processed'] / max(time.monotonic() - started, 1e-9)
+    stats['retries'] = sender.retries
+    if progress:
+        progress(stats)
+    return stats
+
+
+async def run_precompute_job(concurrency: int = PRECOMPUTE_CONCURRENCY, job: str = PRECOMPUTE_JOB_NAME,
+                             progress: Optional[Callable[[Dict[str, Any]], None]] = _log_precompute_progress,
+                             segment: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # Ночной пересчёт: рекомендации генерируются только для тех, у кого профиль
+    # изменился, сменилась версия генерации или истёк срок годности заготовки
+    if _precomputing.locked():
+        logging.warning(f"Job {job} is already running, skipping this run")
+        return {}
+    async with _precomputing:
+        return await _precompute(concurrency, job, progress, PRECOMPUTE_SEGMENT if segment is None else segment)
+
+
+async def _precompute(concurrency: int, job: str, progress, segment: Dict[str, Any]) -> Dict[str, Any]:
+    start_after = await run_db(get_job_checkpoint, job)
+    if start_after is not None:
+        logging.info(f"Resuming job {job} after user {start_after}")
+    watermark = _Watermark(start_after or 0)
+    users_queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    results = []
+    started = time.monotonic()
+    stats = {'processed': 0, 'generated': 0, 'fresh': 0, 'skipped': 0, 'templated': 0, 'failed': 0, 'rate': 0.0}
+
+    async def flush():
+        nonlocal results
+        if results:
+            batch, results = results, []
+            await asave_precomputed_recommendations(batch)
+
+    async def finish(user_id: int, outcome: str):
+        stats[outcome] += 1
+        stats['processed'] += 1
+        watermark.complete(user_id)
+        if stats['processed'] % CHECKPOINT_EVERY == 0:
+            # Контрольная точка не должна обгонять сохранённые результаты
+            await flush()
+            await run_db(save_job_checkpoint, job, watermark.value)
+
+    async def produce():
+        last_id = watermark.value
+        while True:
+            users = await run_db(get_segment_users_after, segment, last_id, USERS_CHUNK_SIZE)
+            if not users:
+                break
+            states = await run_db(get_precomputed_states, [user['id'] for user in users])
+            for user in users:
+                watermark.issue(user['id'])
+                if not user.get('gender') or not user.get('preferred_fragrances'):
+                    await finish(user['id'], 'skipped')
+                elif user['id'] in states and recommendation_store.is_fresh(*states[user['id']], user):
+                    await finish(user['id'], 'fresh')
+                else:
+                    await users_queue.put(user)
+            last_id = users[-1]['id']
+        for _ in range(concurrency):
+            await users_queue.put(None)
+
+    async def generate():
+        while (user := await users_queue.get()) is not None:
+            recommendation = await generate_recommendation(user, lane=BATCH)
+            if not is_recordable(recommendation):
+                await finish(user['id'], 'failed')
+                continue
+            if is_templated(recommendation):
+                # Шаблон собирается за миллисекунды, хранить его заранее незачем
+                await finish(user['id'], 'templated')
+                continue
+            results.append(recommendation_store.stored_row(user, recommendation))
+            if len(results) >= STORE_BATCH_SIZE:
+                await flush()
+            await finish(user['id'], 'generated')
+
+    async def report():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            stats['rate'] = stats['processed'] / (time.monotonic() - started)
+            progress(stats)
+
+    reporter = asyncio.create_task(report()) if progress else None
+    try:
+        await asyncio.gather(produce(), *(generate() for _ in range(concurrency)))
+        await flush()
+    except BaseException:
+        await flush()
+        await run_db(save_job_checkpoint, job, watermark.value)
+        raise
+    finally:
+        if reporter:
+            reporter.cancel()
+
+    await run_db(clear_job_checkpoint, job)
+    stats['rate'] = stats['processed'] / max(time.monotonic() - started, 1e-9)
+    if progress:
+        progress(stats)
+    return stats
+
+
+async def resume_pending_job(bot: Bot):
+    if await run_db(get_job_checkpoint, PRECOMPUTE_JOB_NAME) is not None:
+        await run_precompute_job()
+    if await run_db(get_job_checkpoint, JOB_NAME) is not None:
+        await run_recommendation_job(bot)
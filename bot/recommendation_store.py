@@ -0,0 +1,41 @@
+import time
+import json
+import hashlib
+from typing import Dict, Any, Optional
+from config import RECOMMENDATION_TTL
+from database import aget_precomputed_recommendation, asave_precomputed_recommendations
+from ai_helper import RECOMMENDATION_VERSION, is_recordable
+from templates import is_templated
+
+# Готовые рекомендации хранятся в таблице recommendations (precomputed = 1) вместе с версией
+# генерации и отпечатком профиля: заготовка выдаётся, только пока профиль не изменился,
+# версия совпадает и не истёк срок годности.
+
+
+def profile_fingerprint(user: Dict[str, Any]) -> str:
+    # В промпт попадают только пол и ароматы; порядок выбора ароматов значения не имеет
+    payload = json.dumps([(user.get('gender') or '').lower(), sorted(user.get('preferred_fragrances') or [])],
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def is_fresh(version: Optional[int], fingerprint: Optional[str], expires_at: Optional[float], user: Dict[str, Any]) -> bool:
+    return (version == RECOMMENDATION_VERSION and fingerprint == profile_fingerprint(user)
+            and expires_at is not None and expires_at > time.time())
+
+
+def stored_row(user: Dict[str, Any], recommendation: str) -> tuple:
+    return (user['id'], recommendation, RECOMMENDATION_VERSION, profile_fingerprint(user), time.time() + RECOMMENDATION_TTL)
+
+
+async def get_fresh(user: Dict[str, Any]) -> Optional[str]:
+    stored = await aget_precomputed_recommendation(user['id'])
+    if stored and is_fresh(stored['version'], stored['fingerprint'], stored['expires_at'], user):
+        return stored['recommendation']
+    return None
+
+
+async def save(user: Dict[str, Any], recommendation: str):
+    complete = user.get('gender') and user.get('preferred_fragrances')
+    if complete and is_recordable(recommendation) and not is_templated(recommendation):
+        await asave_precomputed_recommendations([stored_row(user, recommendation)])
@@ -1,10 +1,225 @@
-from cryptography.fernet import Fernet
-from config import ENCRYPTION_KEY
+import sys
+import hmac
+import hashlib
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Iterable
+from config import ENCRYPTION_KEY, PII_CACHE_MAX_BYTES, PII_CRYPTO_WORKERS, PII_PARALLEL_MIN, PII_MIGRATION_CHUNK
+
+# Шифрование персональных данных (имена и город пользователя) на уровне полей.
+# Зашифрованное значение хранится с префиксом ENC_PREFIX, поэтому до и во время миграции
+# в базе могут одновременно лежать открытые и зашифрованные значения.
+# Fernet создаётся при первом обращении; без ENCRYPTION_KEY значения пишутся как есть.
+# ENCRYPTION_KEY может содержать несколько ключей через запятую: первым шифруется,
+# остальные (прежние) только расшифровывают до перешифрования миграцией.
+ENC_PREFIX = "enc1:"
+
+_keys = [key.strip() for key in (ENCRYPTION_KEY or "").split(",") if key.strip()]
+_fernet = None
+_primary = None
+_fernet_lock = threading.Lock()
+_pool: Optional[ThreadPoolExecutor] = None
+# Слепой индекс: одинаковые города дают одинаковый HMAC, по нему ищут и считают статистику,
+# не расшифровывая колонку location. Ключ HMAC выводится из текущего ключа шифрования
+_blind_key = hashlib.sha256(b"blind-index:" + _keys[0].encode()).digest() if _keys else None
+
+
+def encryption_enabled() -> bool:
+    return bool(_keys)
+
+
+def _get_ciphers():
+    # (текущий ключ, все ключи)
+    global _fernet, _primary
+    if _fernet is None:
+        if not _keys:
+            raise RuntimeError("ENCRYPTION_KEY is not set")
+        with _fernet_lock:
+            if _fernet is None:
+                from cryptography.fernet import Fernet, MultiFernet
+                _primary = Fernet(_keys[0])
+                _fernet = MultiFernet([_primary] + [Fernet(key) for key in _keys[1:]])
+    return _primary, _fernet
+
+
+def _get_fernet():
+    return _get_ciphers()[1]
+
+
+def warm_up():
+    # Импорт cryptography занимает сотни миллисекунд: при запуске он идёт в фоне,
+    # а не в первом обработчике, который держит поток записи БД
+    if encryption_enabled():
+        _get_fernet()
 
-fernet = Fernet(ENCRYPTION_KEY)
 
 def encrypt_data(data: str) -> str:
-    return fernet.encrypt(data.encode()).decode()
+    return _get_fernet().encrypt(data.encode()).decode()
+
 
 def decrypt_data(encrypted_data: str) -> str:
-    return fernet.decrypt(encrypted_data.encode()).decode()
\ No newline at end of file
+    return _get_fernet().decrypt(encrypted_data.encode()).decode()
+
+
+class _DecryptedCache:
+    # LRU «шифротекст -> открытый текст» с лимитом по памяти: профили читаются
+    # намного чаще, чем меняются, и повторная расшифровка не нужна
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, str]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[str]:
+        with self._lock:
+            value = self._items.get(token)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(token)
+            self.hits += 1
+            return value
+
+    def put(self, token: str, value: str):
+        size = sys.getsizeof(token) + sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if token in self._items:
+                return
+            self._items[token] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                old_token, old_value = self._items.popitem(last=False)
+                self._bytes -= sys.getsizeof(old_token) + sys.getsizeof(old_value)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+
+cache = _DecryptedCache(PII_CACHE_MAX_BYTES)
+
+
+def is_encrypted(value: Optional[str]) -> bool:
+    return isinstance(value, str) and value.startswith(ENC_PREFIX)
+
+
+def encrypt_value(value: Optional[str]) -> Optional[str]:
+    if value is None or not encryption_enabled() or is_encrypted(value):
+        return value
+    token = ENC_PREFIX + encrypt_data(value)
+    cache.put(token, value)
+    return token
+
+
+def decrypt_value(value: Optional[str]) -> Optional[str]:
+    if not is_encrypted(value):
+        return value
+    plain = cache.get(value)
+    if plain is None:
+        try:
+            plain = decrypt_data(value[len(ENC_PREFIX):])
+        except Exception as e:
+            # Ключ сменился или значение повреждено: один профиль не должен ронять массовое чтение
+            logging.error(f"Failed to decrypt a stored value: {type(e).__name__}")
+            return None
+        cache.put(value, plain)
+    return plain
+
+
+def _map(func, values: Iterable[Optional[str]]) -> List[Optional[str]]:
+    # Большие пачки (get_all_users, миграция) делятся между потоками PII_CRYPTO_WORKERS
+    global _pool
+    values = list(values)
+    if PII_CRYPTO_WORKERS <= 0 or len(values) < PII_PARALLEL_MIN:
+        return [func(value) for value in values]
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=PII_CRYPTO_WORKERS, thread_name_prefix="crypto")
+    size = -(-len(values) // PII_CRYPTO_WORKERS)
+    parts = _pool.map(lambda part: [func(value) for value in part],
+                      [values[start:start + size] for start in range(0, len(values), size)])
+    return [value for part in parts for value in part]
+
+
+def encrypt_many(values: Iterable[Optional[str]]) -> List[Optional[str]]:
+    return _map(encrypt_value, values)
+
+
+def decrypt_many(values: Iterable[Optional[str]]) -> List[Optional[str]]:
+    return _map(decrypt_value, values)
+
+
+def reencrypt_value(value: Optional[str]) -> Optional[str]:
+    # Значение, зашифрованное текущим ключом: открытое шифруется, зашифрованное прежним
+    # ключом перешифровывается, остальное возвращается как есть.
+    # ValueError — значение не расшифровывается ни одним из ключей
+    if value is None or not is_encrypted(value):
+        return encrypt_value(value)
+    from cryptography.fernet import InvalidToken
+    primary, fernet = _get_ciphers()
+    token = value[len(ENC_PREFIX):].encode()
+    try:
+        primary.decrypt(token)
+        return value
+    except InvalidToken:
+        pass
+    try:
+        return ENC_PREFIX + fernet.rotate(token).decode()
+    except InvalidToken:
+        raise ValueError("Value cannot be decrypted with any configured key")
+
+
+def blind_index(value: Optional[str]) -> Optional[str]:
+    # Без ключа хэш считался бы на общеизвестном ключе и легко обращался бы перебором городов
+    if _blind_key is None:
+        raise RuntimeError("ENCRYPTION_KEY is not set")
+    if value is None:
+        return None
+    return hmac.new(_blind_key, value.strip().casefold().encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def location_key(value: Optional[str]) -> Optional[str]:
+    # Значение users.location_hash: слепой индекс, а без шифрования — сам нормализованный город
+    # (он и так хранится открыто). После включения шифрования migrate пересчитывает все значения
+    if value is None:
+        return None
+    if encryption_enabled():
+        return blind_index(value)
+    return value.strip().casefold()
+
+
+def location_key_id() -> str:
+    # Чем посчитаны location_hash в базе; сравнивается при запуске с тем, что записано в базе
+    return hashlib.sha256(_blind_key).hexdigest()[:16] if _blind_key else "plain"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Шифрование персональных данных пользователей")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('genkey', help="сгенерировать ключ для ENCRYPTION_KEY")
+    migrate = subparsers.add_parser('migrate', help="зашифровать открытые значения текущим ключом, перешифровать "
+                                                    "значения прежних ключей и пересчитать хэши городов")
+    migrate.add_argument('--chunk-size', type=int, default=PII_MIGRATION_CHUNK)
+    args = parser.parse_args(argv)
+    if args.command == 'genkey':
+        from cryptography.fernet import Fernet
+        print(Fernet.generate_key().decode())
+        return 0
+    if not encryption_enabled():
+        print("ENCRYPTION_KEY не задан", file=sys.stderr)
+        return 1
+    from database import init_db, encrypt_existing_users
+    init_db()
+    print(f"Обновлено пользователей: {encrypt_existing_users(args.chunk_size)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+from typing import Dict, Any, List, Tuple
+from fragrances import FRAGRANCE_BITS
+from security import location_key
+
+# Сегмент пользователей для рассылок и фоновых задач — словарь условий, которые
+# объединяются через AND и превращаются в WHERE по таблице users:
+#   locations       — список городов                   (слепой индекс idx_users_location_hash)
+#   genders         — список значений пола              (idx_users_gender)
+#   age_min/age_max — возрастной диапазон              (idx_users_age по CAST(age AS INTEGER))
+#   fragrances      — любимые семейства, любое из них или все при fragrances_all (user_fragrances)
+#   inactive_days   — не получали рекомендаций столько дней (idx_users_last_recommendation)
+#   recommendable   — заполнены пол и ароматы, т.е. рекомендацию можно сгенерировать
+# Пустой словарь — все пользователи. Сегмент хранится в broadcasts.segment как JSON.
+SPEC_KEYS = ('locations', 'genders', 'age_min', 'age_max', 'fragrances', 'fragrances_all', 'inactive_days', 'recommendable')
+
+# Названия условий в тексте, который присылает администратор
+_TEXT_KEYS = {
+    'город': 'locations', 'города': 'locations',
+    'пол': 'genders',
+    'возраст': 'age',
+    'ароматы': 'fragrances', 'аромат': 'fragrances',
+    'все ароматы': 'fragrances_all',
+    'неактивны': 'inactive_days', 'без рекомендаций': 'inactive_days',
+}
+EVERYONE = ('всем', 'все')
+
+
+def _placeholders(values: List[Any]) -> str:
+    return ', '.join('?' * len(values))
+
+
+def compile_spec(spec: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    unknown = set(spec or {}) - set(SPEC_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown segment keys: {', '.join(sorted(unknown))}")
+    spec = spec or {}
+    conditions, params = [], []
+    if spec.get('locations'):
+        # Город хранится зашифрованным, сравнивается его слепой индекс (без учёта регистра)
+        conditions.append(f"users.location_hash IN ({_placeholders(spec['locations'])})")
+        params += [location_key(location) for location in spec['locations']]
+    if spec.get('genders'):
+        conditions.append(f"users.gender IN ({_placeholders(spec['genders'])})")
+        params += [gender.lower() for gender in spec['genders']]
+    # Выражение совпадает с выражением индекса idx_users_age, иначе SQLite его не использует
+    if spec.get('age_min') is not None:
+        conditions.append("CAST(users.age AS INTEGER) >= ?")
+        params.append(int(spec['age_min']))
+    if spec.get('age_max') is not None:
+        conditions.append("CAST(users.age AS INTEGER) <= ?")
+        params.append(int(spec['age_max']))
+    if spec.get('fragrances'):
+        ids = [FRAGRANCE_BITS[f] for f in dict.fromkeys(spec['fragrances']) if f in FRAGRANCE_BITS]
+        if not ids:
+            raise ValueError(f"Unknown fragrances: {', '.join(spec['fragrances'])}")
+        subquery = f"SELECT user_id FROM user_fragrances WHERE fragrance_id IN ({_placeholders(ids)})"
+        params += ids
+        if spec.get('fragrances_all') and len(ids) > 1:
+            subquery += " GROUP BY user_id HAVING COUNT(*) = ?"
+            params.append(len(ids))
+        conditions.append(f"users.id IN ({subquery})")
+    if spec.get('inactive_days'):
+        conditions.append("(users.last_recommendation_at IS NULL OR users.last_recommendation_at < datetime('now', ?))")
+        params.append(f"-{int(spec['inactive_days'])} days")
+    if spec.get('recommendable'):
+        conditions.append("users.gender IS NOT NULL AND users.gender != '' AND users.fragrance_mask != 0")
+    return " AND ".join(conditions) or "1", params
+
+
+def _split(value: str) -> List[str]:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def parse_spec(text: str) -> Dict[str, Any]:
+    # Условия по одному в строке: "город: Москва, Минск", "пол: женский", "возраст: 18-30",
+    # "ароматы: Цитрусовые" (или "все ароматы: ..."), "неактивны: 7"; "всем" — без условий
+    text = (text or '').strip()
+    if text.lower() in EVERYONE:
+        return {}
+    spec: Dict[str, Any] = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        name, sep, value = line.partition(':')
+        key = _TEXT_KEYS.get(name.strip().lower())
+        if not sep or key is None or not value.strip():
+            raise ValueError(f"Не понимаю условие «{line.strip()}»")
+        value = value.strip()
+        if key in ('locations', 'genders'):
+            spec[key] = _split(value)
+        elif key == 'age':
+            low, dash, high = value.partition('-')
+            try:
+                spec['age_min'] = int(low) if low.strip() else None
+                spec['age_max'] = int(high) if high.strip() else (None if dash else spec['age_min'])
+            except ValueError:
+                raise ValueError(f"Возраст указывается как 18-30, 18- или -30, а не «{value}»")
+        elif key in ('fragrances', 'fragrances_all'):
+            fragrances = [f.capitalize() for f in _split(value)]
+            unknown = [f for f in fragrances if f not in FRAGRANCE_BITS]
+            if unknown:
+                raise ValueError(f"Неизвестные ароматы: {', '.join(unknown)}")
+            spec['fragrances'] = fragrances
+            spec['fragrances_all'] = key == 'fragrances_all'
+        elif key == 'inactive_days':
+            if not value.isdigit():
+                raise ValueError(f"Число дней должно быть целым, а не «{value}»")
+            spec['inactive_days'] = int(value)
+    return spec
+
+
+def describe(spec: Dict[str, Any]) -> str:
+    if not spec:
+        return "все пользователи"
+    parts = []
+    if spec.get('locations'):
+        parts.append("город: " + ", ".join(spec['locations']))
+    if spec.get('genders'):
+        parts.append("пол: " + ", ".join(spec['genders']))
+    if spec.get('age_min') is not None or spec.get('age_max') is not None:
+        parts.append(f"возраст: {spec.get('age_min') if spec.get('age_min') is not None else ''}-"
+                     f"{spec.get('age_max') if spec.get('age_max') is not None else ''}")
+    if spec.get('fragrances'):
+        parts.append(("все ароматы: " if spec.get('fragrances_all') else "ароматы: ") + ", ".join(spec['fragrances']))
+    if spec.get('inactive_days'):
+        parts.append(f"без рекомендаций {spec['inactive_days']} дн.")
+    if spec.get('recommendable'):
+        parts.append("профиль заполнен")
+    return "; ".join(parts)
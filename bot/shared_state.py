@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple, List, Callable, Awaitable
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, DefaultKeyBuilder, KeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+from config import STATE_BACKEND, LEADER_LEASE_TTL
+from database import read_cursor, write_cursor, run_db
+
+# Состояние, которое должно быть общим для всех процессов бота (шаги FSM, аренда лидера).
+# memory — словари в памяти, годится для одного процесса (polling или один webhook-воркер);
+# sqlite — таблицы shared_state/leases в общей базе, для нескольких воркеров на одной машине.
+
+
+class MemoryBackend:
+    def __init__(self):
+        self._values: Dict[str, Tuple[Any, Optional[float]]] = {}
+        self._leases: Dict[str, Tuple[str, float]] = {}
+
+    async def get(self, key: str) -> Any:
+        value, expires_at = self._values.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            del self._values[key]
+            return None
+        return value
+
+    async def set(self, key: str, value: Any, ttl: float = None):
+        self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    async def delete(self, key: str):
+        self._values.pop(key, None)
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        current = self._leases.get(name)
+        if current and current[0] != owner and current[1] > now:
+            return False
+        self._leases[name] = (owner, now + ttl)
+        return True
+
+    async def release_lease(self, name: str, owner: str):
+        if self._leases.get(name, (None,))[0] == owner:
+            del self._leases[name]
+
+
+def _get_value(key: str) -> Any:
+    with read_cursor() as c:
+        c.execute("SELECT value, expires_at FROM shared_state WHERE key = ?", (key,))
+        row = c.fetchone()
+    if row is None or (row[1] is not None and row[1] <= time.time()):
+        return None
+    return json.loads(row[0])
+
+
+def _set_value(key: str, value: Any, ttl: float = None):
+    with write_cursor() as c:
+        c.execute('''INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)
+                     ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at''',
+                  (key, json.dumps(value, ensure_ascii=False), time.time() + ttl if ttl else None))
+
+
+def _delete_value(key: str):
+    with write_cursor() as c:
+        c.execute("DELETE FROM shared_state WHERE key = ?", (key,))
+
+
+def _acquire_lease(name: str, owner: str, ttl: float) -> bool:
+    # Аренду получает владелец текущей аренды (продление) или кто угодно, если она истекла;
+    # условный UPSERT выполняется атомарно под блокировкой записи SQLite
+    now = time.time()
+    with write_cursor() as c:
+        c.execute('''INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                     ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                     WHERE leases.owner = excluded.owner OR leases.expires_at <= ?''',
+                  (name, owner, now + ttl, now))
+        return c.rowcount > 0
+
+
+def _release_lease(name: str, owner: str):
+    with write_cursor() as c:
+        c.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+
+class SQLiteBackend:
+    async def get(self, key: str) -> Any:
+        return await run_db(_get_value, key)
+
+    async def set(self, key: str, value: Any, ttl: float = None):
+        await run_db(_set_value, key, value, ttl)
+
+    async def delete(self, key: str):
+        await run_db(_delete_value, key)
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        return await run_db(_acquire_lease, name, owner, ttl)
+
+    async def release_lease(self, name: str, owner: str):
+        await run_db(_release_lease, name, owner)
+
+
+class BackendStorage(BaseStorage):
+    # Хранилище FSM aiogram поверх общего бэкенда
+    def __init__(self, backend, key_builder: KeyBuilder = None):
+        self.backend = backend
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state=None):
+        state = state.state if isinstance(state, State) else state
+        if state is None:
+            await self.backend.delete(self.key_builder.build(key, 'state'))
+        else:
+            await self.backend.set(self.key_builder.build(key, 'state'), state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self.backend.get(self.key_builder.build(key, 'state'))
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]):
+        if data:
+            await self.backend.set(self.key_builder.build(key, 'data'), data)
+        else:
+            await self.backend.delete(self.key_builder.build(key, 'data'))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict(await self.backend.get(self.key_builder.build(key, 'data')) or {})
+
+    async def close(self):
+        pass
+
+
+def create_backend(kind: str = STATE_BACKEND):
+    if kind == 'sqlite':
+        return SQLiteBackend()
+    if kind != 'memory':
+        raise ValueError(f"Unknown state backend: {kind}")
+    return MemoryBackend()
+
+
+def create_fsm_storage(state_backend) -> BaseStorage:
+    if isinstance(state_backend, MemoryBackend):
+        return MemoryStorage()
+    return BackendStorage(state_backend)
+
+
+class LeaderElection:
+    # Фоновые задачи (планировщик, возобновление рассылок) работают только в одном процессе —
+    # у владельца аренды. Аренда продлевается каждые ttl/3 секунд; если процесс упал,
+    # через ttl её забирает другой воркер.
+    def __init__(self, state_backend, name: str, ttl: float = LEADER_LEASE_TTL):
+        self.backend = state_backend
+        self.name = name
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+
+    async def run(self, on_elected: Callable[[], Awaitable[List[asyncio.Task]]]):
+        tasks: List[asyncio.Task] = []
+        try:
+            while True:
+                try:
+                    acquired = await self.backend.acquire_lease(self.name, self.owner, self.ttl)
+                except Exception as e:
+                    logging.error(f"Failed to renew lease {self.name}: {e}")
+                    acquired = False
+                if acquired and not self.is_leader:
+                    logging.info(f"{self.owner} became leader for {self.name}")
+                    tasks = await on_elected()
+                elif not acquired and self.is_leader:
+                    logging.warning(f"{self.owner} lost leadership for {self.name}")
+                    for task in tasks:
+                        task.cancel()
+                    tasks = []
+                self.is_leader = acquired
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self.is_leader:
+                self.is_leader = False
+                await self.backend.release_lease(self.name, self.owner)
+
+
+backend = create_backend()
@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Iterable
+from database import read_cursor, run_db, get_location_labels
+
+# Агрегаты поддерживаются триггерами (database._init_stats), здесь только чтение:
+# каждое обращение — поиск по первичному ключу, без сканирования таблиц данных.
+SUMMARY_COUNTERS = ('users', 'users_completed', 'recommendations', 'support_requests', 'feedback_count', 'feedback_sum')
+
+def get_counters(names: Iterable[str] = SUMMARY_COUNTERS) -> Dict[str, int]:
+    names = list(names)
+    with read_cursor() as c:
+        c.execute(f"SELECT name, value FROM stats_counters WHERE name IN ({', '.join('?' * len(names))})", names)
+        values = dict(c.fetchall())
+    return {name: values.get(name, 0) for name in names}
+
+def get_breakdown(kind: str, limit: int = None) -> Dict[str, int]:
+    # kind: gender, location, fragrance или rating; диапазон по ключу "kind:" ... "kind;"
+    with read_cursor() as c:
+        c.execute("SELECT name, value FROM stats_counters WHERE name > ? AND name < ? AND value > 0 ORDER BY value DESC",
+                  (f"{kind}:", f"{kind};"))
+        rows = c.fetchall()
+    if limit:
+        rows = rows[:limit]
+    breakdown = {name[len(kind) + 1:]: value for name, value in rows}
+    if kind == 'location':
+        # Города в счётчиках — слепые хэши, названия берутся из location_labels
+        labels = get_location_labels(list(breakdown))
+        breakdown = {labels.get(key) or key: value for key, value in breakdown.items()}
+    return breakdown
+
+def get_daily_between(first_day: str, last_day: str) -> List[Dict[str, Any]]:
+    # Границы включительно, даты в формате YYYY-MM-DD (UTC, как date('now') в SQLite)
+    with read_cursor() as c:
+        c.execute("SELECT day, name, value FROM stats_daily WHERE day BETWEEN ? AND ? ORDER BY day", (first_day, last_day))
+        rows = c.fetchall()
+    buckets: Dict[str, Dict[str, Any]] = {}
+    for day, name, value in rows:
+        buckets.setdefault(day, {'day': day})[name] = value
+    return list(buckets.values())
+
+def get_daily(days: int = 7) -> List[Dict[str, Any]]:
+    today = datetime.now(timezone.utc).date()
+    return get_daily_between((today - timedelta(days=days - 1)).isoformat(), today.isoformat())
+
+def get_rating_histogram() -> Dict[int, int]:
+    ratings = get_breakdown('rating')
+    return {score: ratings.get(str(score), 0) for score in range(1, 6)}
+
+async def aget_counters(names: Iterable[str] = SUMMARY_COUNTERS) -> Dict[str, int]:
+    return await run_db(get_counters, tuple(names))
+
+async def aget_breakdown(kind: str, limit: int = None) -> Dict[str, int]:
+    return await run_db(get_breakdown, kind, limit)
+
+async def aget_daily(days: int = 7) -> List[Dict[str, Any]]:
+    return await run_db(get_daily, days)
+
+async def aget_rating_histogram() -> Dict[int, int]:
+    return await run_db(get_rating_histogram)
@@ -0,0 +1,72 @@
+import re
+from typing import Dict, Any, List
+
+# Рекомендация без обращения к модели: заранее написанные описания семейств ароматов
+# плюс товары, подобранные для профиля. Используется как быстрый путь (TEMPLATE_MODE в config.py);
+# вопросы пользователя свободным текстом всегда уходят в модель.
+TEMPLATE_HEADER = "Подборка по вашим предпочтениям"
+DESCRIPTION_LENGTH = 160
+
+FAMILY_NOTES = {
+    "Цветочные": "роза, жасмин, пион и ирис — нежные и романтичные композиции, которые легко носить каждый день.",
+    "Древесные": "кедр, сандал, ветивер и уд — тёплая, спокойная база, которая долго держится на коже.",
+    "Цитрусовые": "бергамот, лимон, мандарин и нероли — свежесть и энергия, особенно хороши летом и утром.",
+    "Восточные": "амбра, ладан, смолы и специи — плотные, обволакивающие ароматы для вечера и холодного сезона.",
+    "Фужерные": "лаванда, дубовый мох и кумарин — классика барбершопа, чистая и собранная.",
+    "Шипровые": "бергамот, пачули и мох — элегантный контраст свежего начала и глубокой базы.",
+    "Кожаные": "замша и выделанная кожа — благородные, немного дерзкие ароматы с характером.",
+    "Гурманские": "ваниль, карамель, кофе и какао — сладкие «съедобные» ноты, уютные и запоминающиеся.",
+    "Акватические": "морской бриз и озон — прохладные прозрачные ароматы для жары и активного дня.",
+    "Зеленые": "срезанная трава, листья и чай — естественная свежесть, лёгкая и ненавязчивая.",
+    "Пряные": "перец, кардамон, корица и шафран — согревающие акценты, добавляющие аромату глубины.",
+    "Фруктовые": "персик, груша, ягоды и инжир — сочные, яркие и жизнерадостные композиции.",
+    "Альдегидные": "искристые альдегиды — сияющая «мыльная» чистота, как у знаменитой классики.",
+    "Мускусные": "мягкий мускус — аромат «второй кожи», интимный и очень стойкий.",
+    "Табачные": "табачный лист, мёд и сухофрукты — тёплые, бархатные и немного винтажные.",
+}
+
+GENDER_NOTES = {
+    "мужской": "Для мужского гардероба мы выбрали ароматы с выразительным шлейфом и хорошей стойкостью.",
+    "женский": "Для женского гардероба мы выбрали ароматы, которые раскрываются на коже и хорошо звучат весь день.",
+    "другой": "Мы выбрали универсальные ароматы, которые одинаково хорошо звучат на любой коже.",
+}
+
+CATEGORY_TITLES = {
+    "mens-perfumes": "мужской аромат",
+    "womens-fragrances": "женский аромат",
+    "unisex-fragrances": "унисекс",
+    "probes": "пробник",
+}
+
+_TAG_RE = re.compile(r"<[^>]+>")
+
+
+def _description(product: Dict[str, Any]) -> str:
+    text = " ".join(_TAG_RE.sub(" ", product.get('description') or "").split())
+    if len(text) <= DESCRIPTION_LENGTH:
+        return text
+    return text[:DESCRIPTION_LENGTH].rsplit(" ", 1)[0] + "…"
+
+
+def render(gender: str, fragrances: List[str], products: List[Dict[str, Any]]) -> str:
+    lines = [f"{TEMPLATE_HEADER} ({', '.join(fragrances)}):", ""]
+    lines += [f"{family}: {FAMILY_NOTES[family]}" for family in fragrances if family in FAMILY_NOTES]
+    gender_note = GENDER_NOTES.get((gender or "").lower())
+    if gender_note:
+        lines += ["", gender_note]
+    if products:
+        lines += ["", "Обратите внимание на:"]
+        for product in products:
+            line = f"• {product['name']}"
+            category = CATEGORY_TITLES.get(product.get('category'))
+            if category:
+                line += f" ({category})"
+            description = _description(product)
+            if description:
+                line += f" — {description}"
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def is_templated(text: str) -> bool:
+    return text.startswith(TEMPLATE_HEADER)
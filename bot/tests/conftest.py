@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+import pytest
+
+# Модули бота импортируются по плоским именам (from config import ...), а config читает
+# окружение при импорте, поэтому временная база и настройки задаются до первого импорта
+_tmp = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ["DATABASE_URL"] = os.path.join(_tmp, "test.db")
+os.environ["VECTOR_INDEX_DIR"] = os.path.join(_tmp, "vector_index")
+os.environ["ENCRYPTION_KEY"] = ""
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:test-token")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def database():
+    import database
+    database.init_db()
+    return database
+
+
+@pytest.fixture
+def clean_users(database):
+    with database.write_cursor() as c:
+        c.execute("DELETE FROM users")
+        c.execute("DELETE FROM location_labels")
+    return database
+
+
+@pytest.fixture
+def bot_app(database):
+    # Обработчики main.py с заглушкой Bot API из нагрузочного стенда; вызванные методы — в bot_app.sent
+    import main
+    from benchmark import make_fake_telegram_session, UpdateFactory
+    session = make_fake_telegram_session(0, 0)
+    sent = []
+    make_request = session.make_request
+
+    async def record(bot, method, timeout=None):
+        sent.append(method)
+        return await make_request(bot, method, timeout)
+    session.make_request = record
+    main.bot.session = session
+    return SimpleNamespace(main=main, sent=sent, updates=UpdateFactory(main.bot.id))
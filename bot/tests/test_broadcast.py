@@ -0,0 +1,137 @@
+import asyncio
+import collections
+from types import SimpleNamespace
+import pytest
+import broadcast
+
+USERS = range(1, 301)
+
+
+class FakeBot:
+    def __init__(self, delay: float = 0.001):
+        self.delay = delay
+        self.sent = collections.Counter()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.delay)
+        if chat_id in USERS:
+            self.sent[chat_id] += 1
+        return SimpleNamespace(message_id=1)
+
+    async def edit_message_text(self, *args, **kwargs):
+        pass
+
+
+class DirectSender:
+    def __init__(self, bot, **kwargs):
+        self.bot = bot
+
+    async def send_message(self, chat_id, text):
+        await self.bot.send_message(chat_id, text)
+
+
+@pytest.fixture
+def recipients(clean_users, monkeypatch):
+    database = clean_users
+    with database.write_cursor() as c:
+        c.execute("DELETE FROM broadcast_deliveries")
+        c.executemany("INSERT INTO users (id) VALUES (?)", [(user_id,) for user_id in USERS])
+    monkeypatch.setattr(broadcast, 'TelegramSender', DirectSender)
+    monkeypatch.setattr(broadcast, 'PROGRESS_INTERVAL', 0.02)
+    monkeypatch.setattr(broadcast, 'RECIPIENTS_CHUNK_SIZE', 50)
+    return database
+
+
+def _engine(owner: str) -> broadcast.BroadcastEngine:
+    engine = broadcast.BroadcastEngine()
+    engine.owner = owner
+    return engine
+
+
+async def _finish(*engines):
+    await asyncio.gather(*(task for engine in engines for task in list(engine._tasks.values())))
+
+
+def test_pause_and_resume_send_each_recipient_once(recipients):
+    database = recipients
+
+    async def run():
+        bot, engine = FakeBot(delay=0.02), _engine('a')
+        broadcast_id = await engine.start(bot, 5000, "Новинки недели")
+        await asyncio.sleep(0.05)
+        await engine.pause(broadcast_id)
+        await _finish(engine)
+        paused = database.get_broadcast_counts(broadcast_id), database.get_broadcast(broadcast_id)['status']
+        await engine.resume(bot, broadcast_id)
+        await _finish(engine)
+        return bot, broadcast_id, paused
+    bot, broadcast_id, (paused_counts, paused_status) = asyncio.run(run())
+
+    assert paused_status == 'paused'
+    assert 0 < paused_counts['pending'] < len(USERS)
+    assert sorted(bot.sent) == list(USERS)
+    assert max(bot.sent.values()) == 1
+    assert database.get_broadcast(broadcast_id)['status'] == 'done'
+    assert database.get_broadcast_counts(broadcast_id) == {'sent': len(USERS), 'failed': 0, 'pending': 0}
+
+
+def test_pause_after_finish_keeps_broadcast_done(recipients):
+    database = recipients
+
+    async def run():
+        engine = _engine('a')
+        broadcast_id = await engine.start(FakeBot(), 5000, "Новинки недели")
+        await _finish(engine)
+        await engine.pause(broadcast_id)
+        return broadcast_id
+    broadcast_id = asyncio.run(run())
+    assert database.get_broadcast(broadcast_id)['status'] == 'done'
+
+
+@pytest.mark.parametrize("lease_ttl", [30, 0.01])
+def test_concurrent_engines_send_each_recipient_once(recipients, monkeypatch, lease_ttl):
+    # Два процесса (лидер и webhook-воркер) подхватили одну рассылку; при ttl 0.01 аренда
+    # истекает посреди отправки и переходит от одного к другому
+    database = recipients
+    monkeypatch.setattr(broadcast, 'BROADCAST_LEASE_TTL', lease_ttl)
+
+    async def run():
+        bot = FakeBot()
+        broadcast_id = await database.run_db(database.create_broadcast, 5000, "Новинки недели", None)
+        engines = [_engine('a'), _engine('b')]
+        for engine in engines:
+            engine._launch(bot, broadcast_id)
+        await _finish(*engines)
+        # Проигравший аренду процесс останавливается, не завершая рассылку: её доводит следующий запуск
+        while database.get_broadcast(broadcast_id)['status'] == 'running':
+            engine = _engine('c')
+            engine._launch(bot, broadcast_id)
+            await _finish(engine)
+        return bot, broadcast_id
+    bot, broadcast_id = asyncio.run(run())
+
+    assert sorted(bot.sent) == list(USERS)
+    assert max(bot.sent.values()) == 1
+    assert database.get_broadcast_counts(broadcast_id) == {'sent': len(USERS), 'failed': 0, 'pending': 0}
+
+
+def test_claims_are_disjoint_and_expire(recipients):
+    database = recipients
+    broadcast_id = database.create_broadcast(5000, "Новинки недели")
+    first = database.claim_recipients(broadcast_id, 'a', 100, 60)
+    second = database.claim_recipients(broadcast_id, 'b', 100, 60)
+    assert len(first) == len(second) == 100
+    assert not set(first) & set(second)
+    # Для b не отправлены свободные 100 и 100, захваченные a
+    assert database.count_outstanding_recipients(broadcast_id, 'b') == 200
+
+    # Захват упавшего процесса истекает, и получатели достаются следующему
+    dead = database.claim_recipients(broadcast_id, 'dead', 100, -1)
+    assert sorted(database.claim_recipients(broadcast_id, 'c', 1000, 60)) == dead
+
+    # Возвращённые получатели снова видны как неотправленные и снова захватываются
+    assert database.count_outstanding_recipients(broadcast_id, 'c') == 200
+    assert database.release_recipients(broadcast_id, 'a') == 100
+    assert database.count_outstanding_recipients(broadcast_id, 'b') == 200
+    assert sorted(database.claim_recipients(broadcast_id, 'c', 1000, 60)) == first
+    assert database.count_outstanding_recipients(broadcast_id, 'c') == 100
@@ -0,0 +1,48 @@
+import time
+import asyncio
+import ai_helper
+
+
+def _texts(bot_app):
+    return [method.text for method in bot_app.sent if getattr(method, 'text', None)]
+
+
+def test_fallback_reply_is_not_recorded(bot_app, clean_users, monkeypatch):
+    database = clean_users
+    with database.write_cursor() as c:
+        c.execute("DELETE FROM recommendations")
+    database.save_precomputed_recommendations([(601, "Подготовленная рекомендация", 1, "", time.time() + 3600)])
+    monkeypatch.setattr(ai_helper.dispatcher.breaker, 'opened_at', time.monotonic())
+
+    async def run():
+        profiles = bot_app.main.profiles
+        await profiles.add_user(601, "Иван", None)
+        await profiles.update(601, 'gender', "женский")
+        await profiles.add_fragrance(601, "Цветочные")
+        await bot_app.main.dp.feed_update(bot_app.main.bot, bot_app.updates.message(601, "Что подарить на весну?"))
+    asyncio.run(run())
+
+    assert any(text.startswith(ai_helper.FALLBACK_NOTICE) for text in _texts(bot_app))
+    with database.read_cursor() as c:
+        c.execute("SELECT precomputed, COUNT(*) FROM recommendations WHERE user_id = 601 GROUP BY precomputed")
+        assert dict(c.fetchall()) == {1: 1}
+
+
+def test_unknown_command_gets_help_without_llm_request(bot_app, clean_users, monkeypatch):
+    requests = []
+
+    async def no_stream(*args, **kwargs):
+        requests.append(args)
+        yield "ответ модели"
+    monkeypatch.setattr(bot_app.main, 'stream_recommendation', no_stream)
+
+    async def run():
+        profiles = bot_app.main.profiles
+        await profiles.add_user(602, "Анна", None)
+        await profiles.update(602, 'gender', "женский")
+        await profiles.add_fragrance(602, "Древесные")
+        await bot_app.main.dp.feed_update(bot_app.main.bot, bot_app.updates.message(602, "/strat"))
+    asyncio.run(run())
+
+    assert requests == []
+    assert any(text.startswith("Неизвестная команда") and "/start" in text for text in _texts(bot_app))
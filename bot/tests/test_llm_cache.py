@@ -0,0 +1,74 @@
+import asyncio
+import pytest
+from llm_cache import ResponseCache
+
+
+def _factory(calls, parts=("a", "b"), delay=0.02, error=None):
+    async def produce():
+        calls.append(1)
+        for part in parts:
+            await asyncio.sleep(delay)
+            if error:
+                raise error
+            yield part
+    return produce
+
+
+async def _consume(cache, key, factory):
+    return "".join([chunk async for chunk in cache.stream(key, factory)])
+
+
+def test_concurrent_requests_share_one_call():
+    async def run():
+        cache, calls = ResponseCache(persistent=False), []
+        results = await asyncio.gather(*(_consume(cache, 'k', _factory(calls)) for _ in range(5)))
+        return cache, calls, results
+    cache, calls, results = asyncio.run(run())
+    assert results == ["ab"] * 5
+    assert len(calls) == 1
+    assert cache.stats()['coalesced'] == 4
+    assert cache.stats()['inflight'] == 0
+
+
+def test_cached_value_is_served_without_call():
+    async def run():
+        cache, calls = ResponseCache(persistent=False), []
+        await cache.get_or_create('k', lambda: asyncio.sleep(0, "answer"))
+        result = await _consume(cache, 'k', _factory(calls))
+        return cache, calls, result
+    cache, calls, result = asyncio.run(run())
+    assert result == "answer"
+    assert calls == []
+    assert cache.hits == 1
+
+
+def test_leader_cancellation_does_not_cancel_waiters():
+    async def run():
+        cache, calls = ResponseCache(persistent=False), []
+        leader = asyncio.create_task(_consume(cache, 'k', _factory(calls)))
+        await asyncio.sleep(0.005)
+        waiters = [asyncio.create_task(_consume(cache, 'k', _factory(calls))) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*waiters)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return cache, calls, results
+    cache, calls, results = asyncio.run(run())
+    assert results == ["ab"] * 3
+    # Один повторный вызов на всех ожидающих, а не по одному на каждого
+    assert len(calls) == 2
+    assert cache.get('k') == "ab"
+
+
+def test_leader_error_reaches_waiters_and_is_not_cached():
+    async def run():
+        cache, calls = ResponseCache(persistent=False), []
+        failing = _factory(calls, error=RuntimeError("api down"))
+        results = await asyncio.gather(*(_consume(cache, 'k', failing) for _ in range(3)), return_exceptions=True)
+        retry = await _consume(cache, 'k', _factory(calls))
+        return calls, results, retry
+    calls, results, retry = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retry == "ab"
+    assert len(calls) == 2
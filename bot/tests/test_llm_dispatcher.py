@@ -0,0 +1,126 @@
+import time
+import asyncio
+import pytest
+import ai_helper
+from ai_helper import CircuitBreaker, CircuitOpenError, LLMDispatcher, INTERACTIVE, BATCH, _Lanes
+from shared_state import MemoryBackend
+
+
+def _dispatcher(**kwargs) -> LLMDispatcher:
+    kwargs.setdefault('hedge_delay', 0)
+    kwargs.setdefault('shared', None)
+    return LLMDispatcher(**kwargs)
+
+
+def _fake_complete(calls, delays=(), error=None):
+    # delays[i] — задержка i-го вызова; ответ содержит номер вызова
+    async def complete(prompt, usage):
+        number = len(calls)
+        calls.append(prompt)
+        await asyncio.sleep(delays[number] if number < len(delays) else 0)
+        if error:
+            raise error
+        usage['total'] = 10
+        return f"ответ {number}"
+    return complete
+
+
+def test_breaker_opens_and_lets_one_probe_through():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+    assert breaker.failure() is False
+    assert breaker.state == 'closed'
+    assert breaker.failure() is True
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+    assert not breaker.allow()  # пока идёт проба, остальные запросы не пропускаются
+    breaker.failure()
+    assert breaker.state == 'open'
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == 'closed'
+
+
+def test_open_circuit_refuses_without_calling_openai(monkeypatch):
+    calls = []
+    monkeypatch.setattr(ai_helper, '_complete', _fake_complete(calls, error=RuntimeError("502")))
+    dispatcher = _dispatcher()
+    dispatcher.breaker = CircuitBreaker(threshold=2, cooldown=60)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await dispatcher.complete("запрос")
+        with pytest.raises(CircuitOpenError):
+            await dispatcher.complete("запрос")
+    asyncio.run(run())
+    assert len(calls) == 2
+    assert dispatcher.lanes.active == {INTERACTIVE: 0, BATCH: 0}
+
+
+def test_interactive_waiters_get_freed_slots_first():
+    async def run():
+        lanes = _Lanes(concurrency=2, batch_concurrency=1)
+        await lanes.acquire(BATCH)
+        await lanes.acquire(INTERACTIVE)
+        assert not lanes.try_acquire(BATCH)
+        order = []
+
+        async def wait(lane):
+            await lanes.acquire(lane)
+            order.append(lane)
+        waiters = [asyncio.create_task(wait(BATCH)), asyncio.create_task(wait(INTERACTIVE))]
+        await asyncio.sleep(0)
+        lanes.release(INTERACTIVE)
+        await asyncio.sleep(0)
+        assert order == [INTERACTIVE]
+        lanes.release(BATCH)
+        await asyncio.gather(*waiters)
+        return order, lanes
+    order, lanes = asyncio.run(run())
+    assert order == [INTERACTIVE, BATCH]
+    assert lanes.active == {INTERACTIVE: 1, BATCH: 1}
+
+
+def test_slow_interactive_request_is_hedged(monkeypatch):
+    calls = []
+    monkeypatch.setattr(ai_helper, '_complete', _fake_complete(calls, delays=(1.0, 0.01)))
+    dispatcher = _dispatcher(hedge_delay=0.02)
+
+    async def run():
+        result = await dispatcher.complete("запрос")
+        await asyncio.sleep(0)
+        return result
+    assert asyncio.run(run()) == "ответ 1"
+    assert len(calls) == 2
+    # Отменённый первый запрос вернул слот и не считается ошибкой сервиса
+    assert dispatcher.lanes.active == {INTERACTIVE: 0, BATCH: 0}
+    assert dispatcher.breaker.state == 'closed'
+
+
+def test_limits_are_split_between_workers():
+    dispatcher = _dispatcher(workers=2, tokens_per_minute=1000, concurrency=8, batch_concurrency=3,
+                             shared=MemoryBackend())
+    assert dispatcher.budget.capacity == 500
+    assert dispatcher.lanes.limits == {INTERACTIVE: 4, BATCH: 2}
+
+
+def test_circuit_opened_by_one_worker_applies_to_another(monkeypatch):
+    calls = []
+    monkeypatch.setattr(ai_helper, '_complete', _fake_complete(calls, error=RuntimeError("502")))
+    shared = MemoryBackend()
+    first, second = (_dispatcher(workers=2, shared=shared) for _ in range(2))
+    first.breaker = CircuitBreaker(threshold=2, cooldown=60)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await first.complete("запрос")
+        await asyncio.sleep(0)  # публикация в общем хранилище идёт отдельной задачей
+        with pytest.raises(CircuitOpenError):
+            await second.complete("запрос")
+    asyncio.run(run())
+    assert len(calls) == 2
+    assert second.breaker.state == 'open'
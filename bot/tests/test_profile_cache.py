@@ -0,0 +1,33 @@
+import asyncio
+import pytest
+from profile_cache import ProfileCache
+
+
+@pytest.mark.parametrize("write_through", [False, True])
+def test_concurrent_edits_of_new_user_keep_all_fields(clean_users, write_through):
+    async def run():
+        cache = ProfileCache(write_through=write_through)
+        # /start и ответы опроса для ещё не сохранённого пользователя приходят одновременно
+        await asyncio.gather(cache.add_user(501, "Иван", "Петров"),
+                             cache.update(501, 'age', '30'),
+                             cache.add_fragrance(501, "Цветочные"))
+        await cache.flush()
+        return cache
+    cache = asyncio.run(run())
+    user = clean_users.get_user(501)
+    assert user['first_name'] == "Иван"
+    assert user['last_name'] == "Петров"
+    assert user['age'] == '30'
+    assert user['preferred_fragrances'] == ["Цветочные"]
+    assert cache._edit_locks == {}
+
+
+def test_concurrent_edits_of_cached_user_are_not_lost(clean_users):
+    async def run():
+        cache = ProfileCache(write_through=True)
+        await cache.add_user(502, "Анна", None)
+        await asyncio.gather(*(cache.add_fragrance(502, name) for name in ("Цветочные", "Древесные", "Цитрусовые")))
+        return await cache.get(502)
+    profile = asyncio.run(run())
+    assert sorted(profile['preferred_fragrances']) == ["Древесные", "Цветочные", "Цитрусовые"]
+    assert profile['first_name'] == "Анна"
@@ -0,0 +1,84 @@
+import random
+import asyncio
+import pytest
+import recommendation_job
+from recommendation_job import _Watermark, run_precompute_job, PRECOMPUTE_JOB_NAME
+from fragrances import FRAGRANCE_FAMILIES
+
+USERS = range(1, 121)
+FAILING_USER = 77
+
+
+def test_watermark_advances_only_over_completed_prefix():
+    watermark = _Watermark(10)
+    for user_id in (11, 12, 13, 14):
+        watermark.issue(user_id)
+    watermark.complete(13)
+    watermark.complete(12)
+    assert watermark.value == 10
+    watermark.complete(11)
+    assert watermark.value == 13
+    watermark.complete(14)
+    assert watermark.value == 14
+
+
+@pytest.fixture
+def profiles(clean_users, monkeypatch):
+    database = clean_users
+    with database.write_cursor() as c:
+        c.execute("DELETE FROM recommendations")
+        c.execute("DELETE FROM job_checkpoints")
+    # У каждого пятого профиль не заполнен — такие не попадают в сегмент
+    database.save_users([{'id': user_id, 'first_name': None, 'last_name': None, 'age': '30',
+                          'gender': None if user_id % 5 == 0 else 'женский',
+                          'preferred_fragrances': [FRAGRANCE_FAMILIES[user_id % 3]], 'location': None}
+                         for user_id in USERS])
+    monkeypatch.setattr(recommendation_job, 'CHECKPOINT_EVERY', 7)
+    monkeypatch.setattr(recommendation_job, 'STORE_BATCH_SIZE', 5)
+    monkeypatch.setattr(recommendation_job, 'USERS_CHUNK_SIZE', 20)
+    return database
+
+
+def _fake_generate(calls, fail_on=None):
+    async def generate(user, lane):
+        calls.append(user['id'])
+        # Пользователи завершаются не по порядку выдачи
+        await asyncio.sleep(random.random() * 0.005)
+        if user['id'] == fail_on:
+            raise RuntimeError("OpenAI недоступен")
+        return f"Рекомендация для {user['id']}"
+    return generate
+
+
+def _stored(database):
+    with database.read_cursor() as c:
+        c.execute("SELECT user_id, recommendation FROM recommendations WHERE precomputed = 1")
+        return dict(c.fetchall())
+
+
+def test_interrupted_precompute_resumes_without_gaps_or_repeats(profiles, monkeypatch):
+    database = profiles
+    eligible = [user_id for user_id in USERS if user_id % 5]
+    first_calls, second_calls = [], []
+
+    monkeypatch.setattr(recommendation_job, 'generate_recommendation', _fake_generate(first_calls, FAILING_USER))
+    with pytest.raises(RuntimeError):
+        asyncio.run(run_precompute_job(concurrency=4, progress=None))
+    checkpoint = database.get_job_checkpoint(PRECOMPUTE_JOB_NAME)
+    stored = _stored(database)
+    # Контрольная точка не обгоняет сохранённые результаты и не проходит мимо упавшего пользователя
+    assert 0 < checkpoint < FAILING_USER
+    assert all(user_id in stored for user_id in eligible if user_id <= checkpoint)
+
+    monkeypatch.setattr(recommendation_job, 'generate_recommendation', _fake_generate(second_calls))
+    stats = asyncio.run(run_precompute_job(concurrency=4, progress=None))
+
+    assert database.get_job_checkpoint(PRECOMPUTE_JOB_NAME) is None
+    assert all(user_id > checkpoint for user_id in second_calls)
+    # Сохранённые до сбоя заготовки свежие и не генерируются заново
+    assert not set(second_calls) & set(stored)
+    assert stats['fresh'] == len([user_id for user_id in stored if user_id > checkpoint])
+    assert sorted(_stored(database)) == eligible
+    with database.read_cursor() as c:
+        c.execute("SELECT COUNT(*) FROM recommendations WHERE precomputed = 1 GROUP BY user_id HAVING COUNT(*) > 1")
+        assert c.fetchall() == []
@@ -0,0 +1,96 @@
+import importlib
+import pytest
+from cryptography.fernet import Fernet
+import config
+import security
+import stats
+
+K1, K2, K3 = (Fernet.generate_key().decode() for _ in range(3))
+CITIES = {1: 'Минск', 2: 'минск ', 3: 'Москва'}
+
+
+@pytest.fixture
+def use_keys(monkeypatch):
+    # security читает ключи при импорте; функции, импортированные из него другими модулями,
+    # после reload видят новые значения, потому что модуль перезагружается на месте
+    def use(*keys):
+        monkeypatch.setattr(config, 'ENCRYPTION_KEY', ",".join(keys))
+        importlib.reload(security)
+    yield use
+    monkeypatch.setattr(config, 'ENCRYPTION_KEY', "")
+    importlib.reload(security)
+
+
+def _save(database, cities):
+    database.save_users([{'id': user_id, 'first_name': f"U{user_id}", 'last_name': "L", 'age': '30', 'gender': 'женский',
+                          'preferred_fragrances': [], 'location': city} for user_id, city in cities.items()])
+
+
+def _raw(database):
+    with database.read_cursor() as c:
+        c.execute("SELECT id, first_name, last_name, location, location_hash FROM users ORDER BY id")
+        return c.fetchall()
+
+
+def _location_breakdown():
+    return sorted((label.strip().lower(), count) for label, count in stats.get_breakdown('location').items())
+
+
+def test_blind_index_requires_key(use_keys):
+    use_keys()
+    with pytest.raises(RuntimeError):
+        security.blind_index('Минск')
+    assert security.location_key(' Минск ') == 'минск'
+    use_keys(K1)
+    assert security.location_key('минск') == security.location_key(' МИНСК') == security.blind_index('Минск')
+
+
+def test_enabling_encryption_rehashes_locations(clean_users, use_keys):
+    database = clean_users
+    use_keys()
+    _save(database, CITIES)
+    assert database.count_segment({'locations': ['Минск']}) == 2
+
+    use_keys(K1)
+    assert database.encrypt_existing_users(chunk_size=2) == 3
+    rows = _raw(database)
+    assert all(security.is_encrypted(value) for row in rows for value in row[1:4])
+    assert {row[4] for row in rows} == {security.blind_index('Минск'), security.blind_index('Москва')}
+    assert database.count_segment({'locations': ['минск']}) == 2
+    assert _location_breakdown() == [('минск', 2), ('москва', 1)]
+
+    # Новые записи получают тот же хэш, что и перехэшированные старые
+    database.update_user(4, 'location', 'МИНСК')
+    assert database.count_segment({'locations': ['Минск']}) == 3
+    assert _location_breakdown() == [('минск', 3), ('москва', 1)]
+    assert database.encrypt_existing_users() == 0
+
+
+def test_key_rotation_reencrypts_and_rehashes(clean_users, use_keys):
+    database = clean_users
+    use_keys(K1)
+    _save(database, CITIES)
+    before = _raw(database)
+
+    use_keys(K2, K1)
+    assert database.encrypt_existing_users(chunk_size=2) == 3
+    after = _raw(database)
+    assert all(old[1:] != new[1:] for old, new in zip(before, after))
+
+    # Прежний ключ больше не нужен
+    use_keys(K2)
+    assert {user['id']: user['location'] for user in database.get_all_users()} == CITIES
+    assert database.count_segment({'locations': ['Минск']}) == 2
+    assert _location_breakdown() == [('минск', 2), ('москва', 1)]
+    assert database.encrypt_existing_users() == 0
+
+
+def test_undecryptable_rows_are_left_untouched(clean_users, use_keys):
+    database = clean_users
+    use_keys(K1)
+    _save(database, CITIES)
+    before = _raw(database)
+
+    use_keys(K3)
+    assert database.encrypt_existing_users() == 0
+    assert _raw(database) == before
@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta
+import pytest
+from fragrances import FRAGRANCE_FAMILIES
+from segments import compile_spec, parse_spec, describe
+
+CITRUS, FLORAL, WOODY = FRAGRANCE_FAMILIES[:3]
+NOW = datetime.utcnow()
+USERS = [
+    # id, возраст, пол, ароматы, город, дней с последней рекомендации
+    (1, '25', 'женский', [CITRUS, FLORAL], 'Минск', None),
+    (2, '31', 'мужской', [WOODY], 'минск ', 1),
+    (3, '18', 'женский', [FLORAL], 'Москва', 10),
+    (4, '45', None, [CITRUS], 'Гомель', 30),
+    (5, 'неизвестно', 'мужской', [], None, None),
+    (6, '31', 'женский', [CITRUS, FLORAL, WOODY], 'МИНСК', 3),
+]
+
+
+@pytest.fixture
+def users(clean_users):
+    database = clean_users
+    database.save_users([{'id': user_id, 'first_name': f"U{user_id}", 'last_name': None, 'age': age, 'gender': gender,
+                          'preferred_fragrances': fragrances, 'location': location}
+                         for user_id, age, gender, fragrances, location, _ in USERS])
+    with database.write_cursor() as c:
+        c.executemany("UPDATE users SET last_recommendation_at = ? WHERE id = ?",
+                      [((NOW - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S') if days is not None else None, user_id)
+                       for user_id, *_, days in USERS])
+    return database
+
+
+def _expected(spec):
+    # Тот же отбор на Python по исходным данным
+    result = set()
+    for user_id, age, gender, fragrances, location, days in USERS:
+        if spec.get('locations') and (location or '').strip().lower() not in [l.lower() for l in spec['locations']]:
+            continue
+        if spec.get('genders') and gender not in spec['genders']:
+            continue
+        age_value = int(age) if age.isdigit() else 0
+        if spec.get('age_min') is not None and age_value < spec['age_min']:
+            continue
+        if spec.get('age_max') is not None and age_value > spec['age_max']:
+            continue
+        if spec.get('fragrances'):
+            check = all if spec.get('fragrances_all') else any
+            if not check(f in fragrances for f in spec['fragrances']):
+                continue
+        if spec.get('inactive_days') and days is not None and days < spec['inactive_days']:
+            continue
+        if spec.get('recommendable') and not (gender and fragrances):
+            continue
+        result.add(user_id)
+    return result
+
+
+@pytest.mark.parametrize('spec', [
+    {},
+    {'locations': ['Минск']},
+    {'locations': ['москва', 'Гомель']},
+    {'genders': ['женский']},
+    {'age_min': 20, 'age_max': 31},
+    {'age_max': 18},
+    {'fragrances': [CITRUS, WOODY]},
+    {'fragrances': [CITRUS, FLORAL], 'fragrances_all': True},
+    {'inactive_days': 7},
+    {'recommendable': True},
+    {'genders': ['женский'], 'locations': ['минск'], 'fragrances': [FLORAL], 'age_min': 30},
+])
+def test_segment_matches_python_filter(users, spec):
+    where, params = compile_spec(spec)
+    with users.read_cursor() as c:
+        c.execute(f"SELECT id FROM users WHERE {where}", params)
+        found = {row[0] for row in c.fetchall()}
+    assert found == _expected(spec)
+    assert users.count_segment(spec) == len(found)
+
+
+def test_empty_spec_selects_everyone():
+    assert compile_spec({}) == ("1", [])
+    assert compile_spec(None) == ("1", [])
+
+
+def test_unknown_key_and_fragrance_are_rejected():
+    with pytest.raises(ValueError):
+        compile_spec({'city': ['Минск']})
+    with pytest.raises(ValueError):
+        compile_spec({'fragrances': ['Несуществующий']})
+
+
+def test_age_condition_uses_expression_index(users):
+    where, params = compile_spec({'age_min': 20})
+    with users.read_cursor() as c:
+        c.execute(f"EXPLAIN QUERY PLAN SELECT id FROM users WHERE {where}", params)
+        plan = " ".join(row[-1] for row in c.fetchall())
+    assert 'idx_users_age' in plan
+
+
+def test_parse_spec_round_trip():
+    spec = parse_spec(f"город: Минск, Гомель\nпол: женский\nвозраст: 18-30\nвсе ароматы: {CITRUS.lower()}, {FLORAL}\nнеактивны: 7")
+    assert spec == {'locations': ['Минск', 'Гомель'], 'genders': ['женский'], 'age_min': 18, 'age_max': 30,
+                    'fragrances': [CITRUS, FLORAL], 'fragrances_all': True, 'inactive_days': 7}
+    assert parse_spec("всем") == {}
+    assert "город: Минск, Гомель" in describe(spec)
+
+
+@pytest.mark.parametrize('text', ["город Минск", "рост: 180", "возраст: много", "ароматы: Несуществующий", "неактивны: неделю"])
+def test_parse_spec_errors(text):
+    with pytest.raises(ValueError):
+        parse_spec(text)
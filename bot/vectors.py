@@ -0,0 +1,295 @@
+import os
+import re
+import json
+import time
+import zlib
+import logging
+import threading
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+from config import VECTOR_INDEX_DIR, VECTOR_DIMENSIONS
+from database import read_cursor, on_products_imported
+from fragrances import GENDER_CATEGORIES, search_terms
+from popularity import load_product_scores, on_popularity_updated
+
+# Векторный поиск товаров: TF-IDF по хэшированным признакам (слова и символьные
+# триграммы названия, адреса и раздела), сжатый усечённым SVD до VECTOR_DIMENSIONS.
+# Векторы товаров лежат в файле float32 и открываются через memmap; запрос
+# пользователя проецируется в то же пространство, оценка — одно умножение матрицы на вектор.
+HASH_BUCKETS = 1 << 15
+SVD_OVERSAMPLING = 10
+SVD_POWER_ITERATIONS = 2
+SPMM_CHUNK = 1 << 17
+# Если изменилась большая доля каталога, модель переобучается, иначе пересчитываются только изменённые строки
+REFIT_RATIO = 0.2
+CATEGORY_BOOST = 0.15
+# Прибавка за популярность (доля от самого популярного товара, 0..1)
+POPULARITY_BOOST = 0.1
+# Кандидатов берётся с запасом, чтобы отбросить почти одинаковые товары (разные объёмы одного аромата)
+CANDIDATES_PER_RESULT = 10
+DUPLICATE_SIMILARITY = 0.9
+INDEX_VERSION = 1
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def _hash(feature: str) -> int:
+    return zlib.crc32(feature.encode('utf-8')) & (HASH_BUCKETS - 1)
+
+
+def _features(text: str) -> Dict[int, float]:
+    counts: Dict[int, float] = {}
+    for word in _WORD_RE.findall(text.lower()):
+        keys = [f"w:{word}"]
+        padded = f" {word} "
+        keys += [padded[i:i + 3] for i in range(len(padded) - 2)]
+        for key in keys:
+            bucket = _hash(key)
+            counts[bucket] = counts.get(bucket, 0.0) + 1.0
+    return counts
+
+
+def _product_text(name: str, url: str, category: str, description: str) -> str:
+    slug = url.rstrip('/').rsplit('/', 1)[-1].replace('-', ' ')
+    return f"{name} {slug} {category} {description}"
+
+
+def _signature(row: Tuple[str, str, str, str, str]) -> int:
+    return zlib.crc32("\x1f".join(row).encode('utf-8'))
+
+
+def _coo(docs: List[Dict[int, float]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    lengths = np.fromiter((len(d) for d in docs), dtype=np.int64, count=len(docs))
+    rows = np.repeat(np.arange(len(docs), dtype=np.int64), lengths)
+    cols = np.fromiter((k for d in docs for k in d), dtype=np.int64, count=int(lengths.sum()))
+    vals = np.fromiter((v for d in docs for v in d.values()), dtype=np.float32, count=int(lengths.sum()))
+    return rows, cols, vals
+
+
+def _spmm(out_index: np.ndarray, in_index: np.ndarray, vals: np.ndarray, matrix: np.ndarray, size: int) -> np.ndarray:
+    # Разреженная матрица (в координатном виде, out_index отсортирован) на плотную, по кускам
+    result = np.zeros((size, matrix.shape[1]), dtype=np.float32)
+    for start in range(0, len(vals), SPMM_CHUNK):
+        out = out_index[start:start + SPMM_CHUNK]
+        if not len(out):
+            continue
+        contrib = vals[start:start + SPMM_CHUNK, None] * matrix[in_index[start:start + SPMM_CHUNK]]
+        boundaries = np.flatnonzero(np.diff(out)) + 1
+        starts = np.concatenate(([0], boundaries))
+        result[out[starts]] += np.add.reduceat(contrib, starts, axis=0)
+    return result
+
+
+class _Model:
+    def __init__(self, idf: np.ndarray, components: np.ndarray):
+        self.idf = idf
+        self.components = components
+
+    def _weights(self, docs: List[Dict[int, float]]):
+        rows, cols, vals = _coo(docs)
+        vals = (1.0 + np.log(vals)) * self.idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights=vals * vals, minlength=len(docs)))
+        vals = (vals / np.maximum(norms[rows], 1e-12)).astype(np.float32)
+        return rows, cols, vals
+
+    def embed(self, docs: List[Dict[int, float]]) -> np.ndarray:
+        if not docs:
+            return np.zeros((0, self.components.shape[1]), dtype=np.float32)
+        rows, cols, vals = self._weights(docs)
+        vectors = _spmm(rows, cols, vals, self.components, len(docs))
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+    @classmethod
+    def fit(cls, docs: List[Dict[int, float]], dimensions: int) -> "_Model":
+        # Рандомизированный усечённый SVD (Halko et al.) без построения плотной матрицы признаков
+        n = len(docs)
+        df = np.zeros(HASH_BUCKETS, dtype=np.float64)
+        for doc in docs:
+            df[list(doc)] += 1
+        idf = (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)
+        model = cls(idf, np.zeros((HASH_BUCKETS, 0), dtype=np.float32))
+        rows, cols, vals = model._weights(docs)
+        by_col = np.argsort(cols, kind='stable')
+        rows_t, cols_t, vals_t = cols[by_col], rows[by_col], vals[by_col]
+
+        rank = min(dimensions + SVD_OVERSAMPLING, n, HASH_BUCKETS)
+        rng = np.random.default_rng(0)
+        omega = rng.standard_normal((HASH_BUCKETS, rank)).astype(np.float32)
+        y = _spmm(rows, cols, vals, omega, n)
+        for _ in range(SVD_POWER_ITERATIONS):
+            q, _ = np.linalg.qr(y)
+            z = _spmm(rows_t, cols_t, vals_t, q, HASH_BUCKETS)
+            q, _ = np.linalg.qr(z)
+            y = _spmm(rows, cols, vals, q, n)
+        q, _ = np.linalg.qr(y)
+        b_t = _spmm(rows_t, cols_t, vals_t, q, HASH_BUCKETS)
+        _, _, vt = np.linalg.svd(b_t.T, full_matrices=False)
+        # В маленьком каталоге компонент может быть меньше, чем dimensions: недостающие остаются нулевыми
+        model.components = np.zeros((HASH_BUCKETS, dimensions), dtype=np.float32)
+        model.components[:, :min(dimensions, len(vt))] = vt[:dimensions].T
+        return model
+
+
+class _Snapshot:
+    __slots__ = ('model', 'vectors', 'ids', 'category_names', 'categories', 'category_codes', 'popularity')
+
+    def __init__(self, model: _Model, vectors: np.ndarray, ids: List[str], categories: List[str],
+                 popularity: Dict[str, float]):
+        self.model = model
+        self.vectors = vectors
+        self.ids = ids
+        self.category_names = categories
+        self.category_codes: Dict[str, int] = {}
+        codes = [self.category_codes.setdefault(category, len(self.category_codes)) for category in categories]
+        self.categories = np.array(codes, dtype=np.int32)
+        self.popularity = np.array([popularity.get(product_id, 0.0) for product_id in ids], dtype=np.float32)
+
+
+class VectorIndex:
+    def __init__(self, directory: str = VECTOR_INDEX_DIR, dimensions: int = VECTOR_DIMENSIONS):
+        self.directory = directory
+        self.dimensions = dimensions
+        self._snapshot: Optional[_Snapshot] = None
+        self._signatures: Dict[str, int] = {}
+        self._fitted_rows = 0
+        self._lock = threading.Lock()
+        self._hooked = False
+
+    @property
+    def loaded(self) -> bool:
+        return self._snapshot is not None
+
+    def __len__(self) -> int:
+        return len(self._snapshot.ids) if self._snapshot else 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _open_vectors(self, rows: int) -> np.ndarray:
+        return np.memmap(self._path('vectors.f32'), dtype=np.float32, mode='r', shape=(rows, self.dimensions))
+
+    def _read_persisted(self):
+        try:
+            with open(self._path('meta.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+            if (meta['version'] != INDEX_VERSION or meta['dimensions'] != self.dimensions
+                    or meta['buckets'] != HASH_BUCKETS or not meta['ids']):
+                return
+            model = np.load(self._path('model.npz'))
+            model = _Model(model['idf'], model['components'])
+            vectors = self._open_vectors(len(meta['ids']))
+        except (OSError, KeyError, ValueError) as e:
+            logging.info(f"Vector index not loaded from {self.directory}: {e}")
+            return
+        self._snapshot = _Snapshot(model, vectors, meta['ids'], meta['categories'], load_product_scores())
+        self._signatures = dict(zip(meta['ids'], meta['signatures']))
+        self._fitted_rows = meta['fitted_rows']
+
+    def _write(self, model: _Model, vectors: np.ndarray, ids: List[str], signatures: List[int],
+               categories: List[str], model_changed: bool):
+        # Файлы пишутся рядом и атомарно подменяются; уже открытый memmap старой версии остаётся валидным
+        os.makedirs(self.directory, exist_ok=True)
+        if model_changed:
+            with open(self._path('model.npz.tmp'), 'wb') as f:
+                np.savez(f, idf=model.idf, components=model.components)
+            os.replace(self._path('model.npz.tmp'), self._path('model.npz'))
+        vectors.tofile(self._path('vectors.f32.tmp'))
+        os.replace(self._path('vectors.f32.tmp'), self._path('vectors.f32'))
+        meta = {'version': INDEX_VERSION, 'dimensions': self.dimensions, 'buckets': HASH_BUCKETS,
+                'fitted_rows': self._fitted_rows, 'ids': ids, 'signatures': signatures, 'categories': categories}
+        with open(self._path('meta.json.tmp'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(self._path('meta.json.tmp'), self._path('meta.json'))
+
+    def load(self):
+        with self._lock:
+            if self._snapshot is None:
+                self._read_persisted()
+            self._sync()
+            if not self._hooked:
+                on_products_imported(self.reload)
+                on_popularity_updated(self.reload_popularity)
+                self._hooked = True
+
+    def reload(self):
+        with self._lock:
+            self._sync()
+
+    def reload_popularity(self):
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None:
+                self._snapshot = _Snapshot(snapshot.model, snapshot.vectors, snapshot.ids,
+                                           snapshot.category_names, load_product_scores())
+
+    def _sync(self):
+        started = time.perf_counter()
+        with read_cursor() as c:
+            c.execute("SELECT id, name, url, category, description FROM products ORDER BY rowid")
+            rows = [tuple(value or '' for value in row) for row in c.fetchall()]
+        ids = [row[0] for row in rows]
+        signatures = [_signature(row) for row in rows]
+        changed = [i for i, (product_id, signature) in enumerate(zip(ids, signatures))
+                   if self._signatures.get(product_id) != signature]
+        removed = len(self._signatures.keys() - set(ids))
+        snapshot = self._snapshot
+        if snapshot is not None and not changed and not removed:
+            return
+        if not rows:
+            self._snapshot, self._signatures = None, {}
+            return
+
+        categories = [row[3] for row in rows]
+        refit = snapshot is None or len(changed) + removed > REFIT_RATIO * max(self._fitted_rows, 1)
+        if refit:
+            docs = [_features(_product_text(*row[1:])) for row in rows]
+            model = _Model.fit(docs, self.dimensions)
+            vectors = model.embed(docs)
+            self._fitted_rows = len(rows)
+        else:
+            model = snapshot.model
+            position = {product_id: i for i, product_id in enumerate(snapshot.ids)}
+            changed_set = set(changed)
+            kept = [i for i in range(len(rows)) if i not in changed_set]
+            vectors = np.empty((len(rows), self.dimensions), dtype=np.float32)
+            vectors[kept] = snapshot.vectors[[position[ids[i]] for i in kept]]
+            if changed:
+                vectors[changed] = model.embed([_features(_product_text(*rows[i][1:])) for i in changed])
+
+        self._write(model, vectors, ids, signatures, categories, refit)
+        # Снимок заменяется целиком: поиск не увидит новые векторы со старыми id
+        self._snapshot = _Snapshot(model, self._open_vectors(len(rows)), ids, categories, load_product_scores())
+        self._signatures = dict(zip(ids, signatures))
+        logging.info(f"Vector index {'rebuilt' if refit else 'updated'}: {len(rows)} products, "
+                     f"{len(changed)} changed, {removed} removed in {time.perf_counter() - started:.2f}s")
+
+    def search(self, gender: str, fragrances: List[str], limit: int = 5) -> List[Tuple[str, float]]:
+        snapshot = self._snapshot
+        if snapshot is None or limit <= 0:
+            return []
+        terms = [term for fragrance in fragrances for term in [fragrance] + search_terms(fragrance)]
+        features = _features(" ".join(terms))
+        if not features:
+            return []
+        query = snapshot.model.embed([features])[0]
+        scores = snapshot.vectors @ query
+        category = snapshot.category_codes.get(GENDER_CATEGORIES.get((gender or '').lower()))
+        if category is not None:
+            scores += CATEGORY_BOOST * (snapshot.categories == category)
+        scores += POPULARITY_BOOST * snapshot.popularity
+        count = min(limit * CANDIDATES_PER_RESULT, len(snapshot.ids))
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top])]
+        candidates = np.asarray(snapshot.vectors[top])
+        picked: List[int] = []
+        for i in range(len(top)):
+            if picked and float(np.max(candidates[picked] @ candidates[i])) > DUPLICATE_SIMILARITY:
+                continue
+            picked.append(i)
+            if len(picked) == limit:
+                break
+        return [(snapshot.ids[top[i]], float(scores[top[i]])) for i in picked]
+
+
+vector_index = VectorIndex()
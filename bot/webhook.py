@@ -0,0 +1,124 @@
+import os
+import sys
+import signal
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from typing import List
+from config import (WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEB_WORKERS,
+                    STATE_BACKEND, METRICS_HOST, METRICS_PORT)
+
+logging.basicConfig(level=logging.INFO)
+
+# Запуск бота в режиме webhook: aiohttp-сервер принимает обновления от Telegram.
+# Несколько процессов слушают один порт (SO_REUSEPORT), ядро распределяет соединения
+# между ними; перед ними ставится локальный обратный прокси с TLS.
+# Общее состояние — через shared_state (sqlite при нескольких воркерах), фоновые
+# задачи выполняет только процесс-лидер.
+
+
+def _prepare_database():
+    # Схема, импорт каталога и построение векторного индекса — один раз до запуска воркеров
+    from database import init_db, close_connections
+    from product_import import import_products_from_csv
+    from vectors import vector_index
+    init_db()
+    import_products_from_csv('edpby.csv')
+    vector_index.load()
+    close_connections()
+
+
+async def _serve(worker: int, reuse_port: bool):
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+    from database import close_connections
+    from profile_cache import profiles
+    from shared_state import backend, LeaderElection
+    import metrics
+    import main as bot_app
+
+    # Каталог импортирован мастером (_prepare_database); загрузка в память — в фоне
+    warm_up = asyncio.create_task(bot_app.warm_up(import_csv=False))
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=bot_app.dp, bot=bot_app.bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, bot_app.dp, bot=bot_app.bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=reuse_port).start()
+    logging.info(f"Webhook worker {worker} (pid {os.getpid()}) listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    bot_app.freeze_startup_objects()
+    bot_app.startup.report(f"Webhook worker {worker} ready", 'ready_total')
+
+    async def on_elected() -> List[asyncio.Task]:
+        if WEBHOOK_URL:
+            await bot_app.bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+        return await bot_app.start_leader_tasks()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    # Метрики у каждого воркера свои, поэтому и порт свой
+    metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT + worker if METRICS_PORT else 0)
+    flusher = asyncio.create_task(profiles.run_flusher())
+    lag_monitor = asyncio.create_task(metrics.monitor_loop_lag())
+    election = asyncio.create_task(LeaderElection(backend, 'scheduler').run(on_elected))
+    try:
+        await stop.wait()
+    finally:
+        for task in (election, flusher, lag_monitor, warm_up):
+            task.cancel()
+        await asyncio.gather(election, flusher, lag_monitor, warm_up, return_exceptions=True)
+        await runner.cleanup()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await profiles.close()
+        await bot_app.bot.session.close()
+        close_connections()
+        logging.info(f"Webhook worker {worker} stopped")
+
+
+def _run_worker(worker: int, reuse_port: bool):
+    asyncio.run(_serve(worker, reuse_port))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Запуск бота в режиме webhook")
+    parser.add_argument('--workers', type=int, default=WEB_WORKERS, help="число процессов")
+    args = parser.parse_args(argv)
+
+    if args.workers > 1 and STATE_BACKEND == 'memory':
+        # Воркеры не видят память друг друга: состояние FSM и аренда лидера должны быть в общей базе
+        logging.warning("STATE_BACKEND=memory does not work with several workers, using sqlite")
+        os.environ['STATE_BACKEND'] = 'sqlite'
+    # Бюджет токенов и параллельность запросов к OpenAI делятся между воркерами
+    os.environ['LLM_WORKERS'] = str(args.workers)
+
+    _prepare_database()
+    if args.workers == 1:
+        _run_worker(0, False)
+        return 0
+
+    # spawn: каждый воркер импортирует модули заново, без унаследованных потоков и соединений
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=_run_worker, args=(i, True), name=f"webhook-{i}") for i in range(args.workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())